@@ -0,0 +1,79 @@
+"""
+Requests per second of GET /v1/files/{file_id}, with the shared pooled engine and with an engine built per request.
+
+    python -m benchmark.bench_files --requests 2000 --concurrency 16
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import httpx
+from fastapi import FastAPI
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import routers.files
+import tools.DB
+from routers import files_router
+from tools.DB import get_db
+from tools.file_store import LocalFileStore
+
+
+def per_request_get_db():
+    """The former get_db, which built an engine and checked the schema on every request."""
+    engine = create_engine(tools.DB.DATABASE_URL, connect_args={"check_same_thread": False})
+    tools.DB.Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def _run(app: FastAPI, file_id: str, requests: int, concurrency: int) -> float:
+    """Send the requests with the given concurrency, return the elapsed seconds."""
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        remaining = iter(range(requests))
+
+        async def worker():
+            for _ in remaining:
+                response = await client.get(f"/v1/files/{file_id}")
+                assert response.status_code == 200, response.text
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        return time.perf_counter() - start
+
+
+async def main(requests: int, concurrency: int):
+    app = FastAPI()
+    app.include_router(files_router)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        response = await client.post("/v1/files", data={"purpose": "assistants"},
+                                     files={"file": ("bench.txt", b"benchmark", "text/plain")})
+        file_id = response.json()["id"]
+
+    for variant, dependency in [("per_request_engine", per_request_get_db), ("pooled_engine", get_db)]:
+        app.dependency_overrides[get_db] = dependency
+        await _run(app, file_id, min(requests, 50), concurrency)  # warm up
+        elapsed = await _run(app, file_id, requests, concurrency)
+        print(json.dumps({"benchmark": "GET /v1/files/{file_id}", "variant": variant, "requests": requests,
+                          "concurrency": concurrency, "seconds": round(elapsed, 3),
+                          "req_per_s": round(requests / elapsed, 1)}))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000, help="Number of requests per variant.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of concurrent clients.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        tools.DB.DATABASE_URL = f"sqlite:///{os.path.join(work_dir, 'file_records.db')}"
+        routers.files.FILE_STORE = LocalFileStore(os.path.join(work_dir, "cache"))
+        asyncio.run(main(args.requests, args.concurrency))
+        tools.DB.dispose_db()
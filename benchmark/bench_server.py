@@ -0,0 +1,248 @@
+"""
+Latency and throughput of the server under a mixed workload, as JSON to diff between changes.
+
+The server is started with the stand-in model of benchmark.fake_model, or given with --url, e.g. a GPU server.
+The workload mixes text chats, chats with images, streamed chats and file upload and retrieval:
+
+    python -m benchmark.bench_server --requests 400 --concurrency 16 --mix text=4,image=2,stream=3,files=1 \
+        --output benchmark/report.json
+
+Extra arguments are passed on to the server, e.g. --max-batch-size 8.
+"""
+
+import asyncio
+import base64
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Sample:
+    """One request of the workload."""
+
+    def __init__(self, kind: str, seconds: float, ok: bool, tokens: int = 0, ttft: Optional[float] = None):
+        self.kind = kind
+        self.seconds = seconds
+        self.ok = ok
+        self.tokens = tokens
+        self.ttft = ttft
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """Nearest rank percentiles in ms."""
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    values = sorted(values)
+
+    def rank(p: float) -> float:
+        return round(values[max(math.ceil(p / 100 * len(values)) - 1, 0)] * 1000, 1)
+
+    return {"p50": rank(50), "p95": rank(95), "p99": rank(99), "mean": round(sum(values) / len(values) * 1000, 1)}
+
+
+def make_images(count: int, seed: int) -> List[str]:
+    """Noise photos as data urls, requests pick from them so the image caches see repeats."""
+    from PIL import Image
+
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        image = Image.frombytes("RGB", (64, 48), bytes(rng.getrandbits(8) for _ in range(64 * 48 * 3)))
+        buffer = io.BytesIO()
+        image.resize((1280, 960)).save(buffer, format="JPEG", quality=85)
+        images.append(f"data:image/jpeg;base64,{base64.b64encode(buffer.getvalue()).decode()}")
+    return images
+
+
+class Workload:
+    def __init__(self, client: httpx.AsyncClient, model: str, max_tokens: int, images: List[str],
+                 images_per_chat: int, file_bytes: int, rng: random.Random):
+        self.client = client
+        self.model = model
+        self.max_tokens = max_tokens
+        self.images = images
+        self.images_per_chat = images_per_chat
+        self.file_bytes = file_bytes
+        self.rng = rng
+
+    def _body(self, content, stream: bool = False) -> dict:
+        return {"model": self.model, "max_tokens": self.max_tokens, "stream": stream,
+                "messages": [{"role": "user", "content": content}]}
+
+    async def _chat(self, kind: str, body: dict) -> List[Sample]:
+        start = time.perf_counter()
+        response = await self.client.post("/v1/chat/completions", json=body)
+        seconds = time.perf_counter() - start
+        tokens = response.json().get("usage", {}).get("completion_tokens", 0) if response.status_code == 200 else 0
+        return [Sample(kind, seconds, response.status_code == 200, tokens=tokens)]
+
+    async def text(self) -> List[Sample]:
+        question = f"Question {self.rng.randrange(1 << 30)}: describe the benchmark in a few words."
+        return await self._chat("text", self._body(question))
+
+    async def image(self) -> List[Sample]:
+        content = [{"type": "image_url", "image_url": {"url": url}}
+                   for url in self.rng.sample(self.images, min(self.images_per_chat, len(self.images)))]
+        content.append({"type": "text", "text": f"Question {self.rng.randrange(1 << 30)}: what is in the pictures?"})
+        return await self._chat("image", self._body(content))
+
+    async def stream(self) -> List[Sample]:
+        body = self._body(f"Question {self.rng.randrange(1 << 30)}: tell a story.", stream=True)
+        start = time.perf_counter()
+        ttft, tokens, ok = None, 0, False
+        async with self.client.stream("POST", "/v1/chat/completions", json=body) as response:
+            async for line in response.aiter_lines():
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                chunk = json.loads(line[len("data: "):])
+                if "error" in chunk:
+                    break
+                if ttft is None and chunk["choices"][0]["delta"].get("content"):
+                    ttft = time.perf_counter() - start
+                if chunk.get("usage"):
+                    tokens, ok = chunk["usage"]["completion_tokens"], response.status_code == 200
+        return [Sample("stream", time.perf_counter() - start, ok, tokens=tokens, ttft=ttft)]
+
+    async def files(self) -> List[Sample]:
+        samples = []
+        start = time.perf_counter()
+        response = await self.client.post("/v1/files", data={"purpose": "assistants"},
+                                          files={"file": ("bench.bin", os.urandom(self.file_bytes))})
+        samples.append(Sample("files.upload", time.perf_counter() - start, response.status_code == 200))
+        if response.status_code != 200:
+            return samples
+        file_id = response.json()["id"]
+        for kind, path in [("files.retrieve", f"/v1/files/{file_id}"),
+                           ("files.content", f"/v1/files/{file_id}/content")]:
+            start = time.perf_counter()
+            response = await self.client.get(path)
+            samples.append(Sample(kind, time.perf_counter() - start, response.status_code == 200))
+        await self.client.delete(f"/v1/files/{file_id}")
+        return samples
+
+
+async def run(url: str, requests: int, concurrency: int, mix: Dict[str, int], max_tokens: int, image_pool: int,
+              images_per_chat: int, file_bytes: int, warmup: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=httpx.Timeout(600), limits=limits) as client:
+        model = (await client.get("/v1/models")).json()["data"][0]["id"]
+        workload = Workload(client, model, max_tokens, make_images(image_pool, seed), images_per_chat, file_bytes, rng)
+        kinds = [kind for kind, weight in mix.items() for _ in range(weight)]
+        jobs = [rng.choice(kinds) for _ in range(requests)]
+
+        for kind in list(mix)[:warmup and len(mix)]:
+            await getattr(workload, kind)()
+
+        samples: List[Sample] = []
+        remaining = iter(jobs)
+
+        async def worker():
+            for job in remaining:
+                try:
+                    samples.extend(await getattr(workload, job)())
+                except httpx.HTTPError:
+                    samples.append(Sample(job, 0, False))
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        seconds = time.perf_counter() - start
+
+    report = {"requests": len(samples), "errors": sum(not sample.ok for sample in samples),
+              "seconds": round(seconds, 3), "req_per_s": round(len(samples) / seconds, 2),
+              "tokens_per_s": round(sum(sample.tokens for sample in samples) / seconds, 1), "workloads": {}}
+    for kind in sorted({sample.kind for sample in samples}):
+        group = [sample for sample in samples if sample.kind == kind]
+        ok = [sample for sample in group if sample.ok]
+        report["workloads"][kind] = {
+            "requests": len(group), "errors": len(group) - len(ok), "req_per_s": round(len(group) / seconds, 2),
+            "latency_ms": percentiles([sample.seconds for sample in ok])}
+        if kind in ("text", "image", "stream"):
+            report["workloads"][kind]["tokens_per_s"] = round(sum(sample.tokens for sample in ok) / seconds, 1)
+        if kind == "stream":
+            report["workloads"][kind]["ttft_ms"] = percentiles([sample.ttft for sample in ok
+                                                                if sample.ttft is not None])
+    return report
+
+
+def start_server(port: int, work_dir: str, fake_args: List[str], server_args: List[str]) -> subprocess.Popen:
+    """The server with the stand-in model, its database, files and caches in ``work_dir``."""
+    command = [sys.executable, "-m", "benchmark.serve_fake", *fake_args, "--server-name", "127.0.0.1",
+               "--server-port", str(port), "--database-url", f"sqlite:///{os.path.join(work_dir, 'files.db')}",
+               "--file-store", os.path.join(work_dir, "cache"), "--sweep-interval", "0", *server_args]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    return subprocess.Popen(command, cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+
+def wait_ready(url: str, process: Optional[subprocess.Popen], timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"The server has exited with {process.returncode}")
+        try:
+            if httpx.get(f"{url}/readyz", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"The server at {url} is not ready in {timeout} seconds")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--url", type=str, default=None, help="Benchmark this server instead of the stand-in.")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the stand-in server.")
+    parser.add_argument("--requests", type=int, default=400, help="Number of workload requests.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of concurrent clients.")
+    parser.add_argument("--mix", type=str, default="text=4,image=2,stream=3,files=1",
+                        help="Relative weights of the text, image, stream and files requests.")
+    parser.add_argument("--max-tokens", type=int, default=64, help="max_tokens of the chats.")
+    parser.add_argument("--image-pool", type=int, default=8, help="Distinct images the image chats pick from.")
+    parser.add_argument("--images-per-chat", type=int, default=2, help="Images of each image chat.")
+    parser.add_argument("--file-size", type=int, default=64, help="Size of the uploaded files in KB.")
+    parser.add_argument("--warmup", type=int, default=1, help="1 to send one request of each kind first, 0 not to.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the workload.")
+    parser.add_argument("--output", type=str, default=None, help="Also write the report to this file.")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="Stand-in seconds per decode step.")
+    parser.add_argument("--prompt-token-latency", type=float, default=0.0001, help="Stand-in seconds per prompt token.")
+    parser.add_argument("--image-latency", type=float, default=0.05, help="Stand-in seconds per image.")
+    parser.add_argument("--answer-tokens", type=int, default=128, help="Stand-in tokens of every answer.")
+    args, server_args = parser.parse_known_args()
+    mix = {kind: int(weight) for kind, weight in (item.split("=") for item in args.mix.split(",") if item)}
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "url")}
+    config["server_args"] = server_args
+    with tempfile.TemporaryDirectory() as work_dir:
+        server, url = None, args.url
+        if url is None:
+            url = f"http://127.0.0.1:{args.port}"
+            server = start_server(args.port, work_dir, [
+                "--token-latency", str(args.token_latency), "--prompt-token-latency", str(args.prompt_token_latency),
+                "--image-latency", str(args.image_latency), "--answer-tokens", str(args.answer_tokens)], server_args)
+        try:
+            wait_ready(url, server)
+            report = asyncio.run(run(url, args.requests, args.concurrency, mix, args.max_tokens, args.image_pool,
+                                     args.images_per_chat, args.file_size * 1024, args.warmup, args.seed))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait(30)
+
+    report = {"benchmark": "server", "server": "stand-in" if args.url is None else args.url, "config": config, **report}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
@@ -0,0 +1,139 @@
+"""
+A stand-in for the Qwen-VL checkpoint, so the real server can be benchmarked without a GPU.
+
+It answers every prompt with the same text, and sleeps to emulate the time of a model:
+per prompt token and per image for the prefill, and per decode step of a batch, whatever its size.
+"""
+
+import re
+import time
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+import torch
+from transformers import GenerationConfig
+
+EOS, IM_START, IM_END = 0, 1, 2
+_FIRST_BYTE = 3  # the tokens of the bytes come after the special tokens
+_IMAGE_TAG = re.compile(r"<img>.*?</img>")
+
+# the answer and the latencies, set before the model is loaded, see benchmark.serve_fake
+ANSWER = "The quick brown fox jumps over the lazy dog. "
+ANSWER_TOKENS: int = 128  # tokens of every answer, unless max_tokens or a stop string ends it first
+TOKEN_LATENCY: float = 0.02  # seconds per decode step of a batch
+PROMPT_TOKEN_LATENCY: float = 0.0001  # seconds per prompt token not in the prefix cache
+IMAGE_LATENCY: float = 0.05  # seconds of vision tower per image
+
+
+class FakeTokenizer:
+    """One token per utf-8 byte."""
+
+    eod_id, im_start_id, im_end_id = EOS, IM_START, IM_END
+
+    def encode(self, text: str, **kwargs) -> List[int]:
+        return [_FIRST_BYTE + byte for byte in text.encode()]
+
+    def decode(self, token_ids, **kwargs) -> str:
+        if hasattr(token_ids, "tolist"):
+            token_ids = token_ids.tolist()
+        return bytes(token_id - _FIRST_BYTE for token_id in token_ids if token_id >= _FIRST_BYTE).decode(
+            errors="replace")
+
+    def from_list_format(self, items: List[dict]) -> str:
+        """The same text as the Qwen-VL tokenizer."""
+        text, images = "", 0
+        for item in items:
+            if "image" in item:
+                images += 1
+                text += f"Picture {images}: <img>{item['image']}</img>\n"
+            elif "text" in item:
+                text += item["text"]
+        return text
+
+
+def make_context(tokenizer: FakeTokenizer, query: str, history: Optional[List[Tuple[str, str]]] = None,
+                 system: str = "", max_window_size: int = 6144, chat_format: str = "chatml") -> Tuple[str, List[int]]:
+    """The chatml prompt, as the make_context of the Qwen-VL remote code."""
+    turns = [("system", system)]
+    for prompt, response in history or []:
+        turns += [("user", prompt), ("assistant", response)]
+    turns += [("user", query)]
+    tokens, raw_text = [], ""
+    for role, content in turns:
+        tokens += [IM_START] + tokenizer.encode(f"{role}\n{content}") + [IM_END] + tokenizer.encode("\n")
+        raw_text += f"<|im_start|>{role}\n{content}<|im_end|>\n"
+    tokens += [IM_START] + tokenizer.encode("assistant\n")
+    raw_text += "<|im_start|>assistant\n"
+    return raw_text, tokens[-max_window_size:]
+
+
+def get_stop_words_ids(chat_format: str, tokenizer: FakeTokenizer) -> List[List[int]]:
+    return [[IM_END], [IM_START]]
+
+
+class FakeQwen(torch.nn.Module):
+    """Generate the answer token by token, through the logits processors and the streamer like a real generate."""
+
+    def __init__(self):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.zeros(1), requires_grad=False)
+        self.config = SimpleNamespace(visual=None)
+        self.generation_config = GenerationConfig(eos_token_id=EOS, pad_token_id=EOS, max_new_tokens=512,
+                                                  do_sample=True, top_k=0, top_p=0.8)
+        self.generation_config.chat_format = "chatml"
+        self.generation_config.max_window_size = 6144
+        self.vocab_size = _FIRST_BYTE + 256
+        self.answer_ids = torch.tensor(FakeTokenizer().encode(ANSWER))
+
+    @property
+    def device(self) -> torch.device:
+        return self.weight.device
+
+    def _prefill(self, input_ids: torch.Tensor, cached: int = 0):
+        tokens = int((input_ids != EOS).sum()) - cached
+        images = sum(len(_IMAGE_TAG.findall(FakeTokenizer().decode(row))) for row in input_ids)
+        time.sleep(max(tokens, 0) * PROMPT_TOKEN_LATENCY + images * IMAGE_LATENCY)
+
+    def forward(self, input_ids: torch.Tensor, past_key_values=None, use_cache: bool = True, **kwargs):
+        """Only used for the prefill of the prefix cache, the key values are as long as the prompt."""
+        self._prefill(input_ids)
+        length = input_ids.shape[1] + (past_key_values[0][0].shape[1] if past_key_values else 0)
+        return SimpleNamespace(past_key_values=((torch.zeros(1, length), torch.zeros(1, length)),))
+
+    @torch.no_grad()
+    def generate(self, input_ids: torch.Tensor, attention_mask: Optional[torch.Tensor] = None, logits_processor=None,
+                 streamer=None, max_new_tokens: Optional[int] = None, past_key_values=None, **kwargs) -> torch.Tensor:
+        self._prefill(input_ids, cached=past_key_values[0][0].shape[1] if past_key_values else 0)
+        if streamer is not None:
+            streamer.put(input_ids)
+        max_new_tokens = max_new_tokens or self.generation_config.max_new_tokens
+        rows = input_ids.shape[0]
+        finished = torch.zeros(rows, dtype=torch.bool)
+        for step in range(max_new_tokens):
+            scores = torch.full((rows, self.vocab_size), -10.0)
+            token_id = EOS if step >= ANSWER_TOKENS else int(self.answer_ids[step % len(self.answer_ids)])
+            scores[:, token_id] = 10.0
+            scores[finished, :] = -float("inf")
+            scores[finished, EOS] = 0
+            if logits_processor is not None:
+                scores = logits_processor(input_ids, scores)
+            next_tokens = scores.argmax(dim=-1)
+            finished |= (next_tokens == EOS) | (next_tokens == IM_END)
+            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+            if streamer is not None:
+                streamer.put(next_tokens)
+            time.sleep(TOKEN_LATENCY)
+            if finished.all():
+                break
+        if streamer is not None:
+            streamer.end()
+        return input_ids
+
+
+def load_fake_model(model_path: str, device_map: Optional[str] = None, progress=None, **kwargs
+                    ) -> Tuple[FakeQwen, FakeTokenizer]:
+    """Drop-in for tools.model_loader.load_model."""
+    if progress is not None:
+        progress.source = f"fake:{model_path}"
+        progress.set("ready")
+    return FakeQwen().eval(), FakeTokenizer()
@@ -0,0 +1,37 @@
+"""
+Run the server of main.py with the stand-in model of benchmark.fake_model, no GPU needed.
+
+The latency options are the ones below, the others are passed on to main.py:
+
+    python -m benchmark.serve_fake --token-latency 0.02 --server-port 8000 --max-batch-size 8
+"""
+
+import os
+import runpy
+import sys
+from argparse import ArgumentParser
+
+import benchmark.fake_model
+import tools.model_loader
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--answer-tokens", type=int, default=benchmark.fake_model.ANSWER_TOKENS,
+                        help="Tokens of every answer, unless max_tokens ends it first. Default: %(default)r")
+    parser.add_argument("--token-latency", type=float, default=benchmark.fake_model.TOKEN_LATENCY,
+                        help="Seconds per decode step of a batch. Default: %(default)r")
+    parser.add_argument("--prompt-token-latency", type=float, default=benchmark.fake_model.PROMPT_TOKEN_LATENCY,
+                        help="Seconds per prompt token of the prefill. Default: %(default)r")
+    parser.add_argument("--image-latency", type=float, default=benchmark.fake_model.IMAGE_LATENCY,
+                        help="Seconds of vision tower per image. Default: %(default)r")
+    args, server_argv = parser.parse_known_args()
+    benchmark.fake_model.ANSWER_TOKENS = args.answer_tokens
+    benchmark.fake_model.TOKEN_LATENCY = args.token_latency
+    benchmark.fake_model.PROMPT_TOKEN_LATENCY = args.prompt_token_latency
+    benchmark.fake_model.IMAGE_LATENCY = args.image_latency
+
+    # main.py imports the loader when it is run, so it gets the stand-in
+    tools.model_loader.load_model = benchmark.fake_model.load_fake_model
+    main_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+    sys.argv = [main_path, *server_argv]
+    runpy.run_path(main_path, run_name="__main__")
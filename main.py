@@ -1,26 +1,112 @@
 import logging
+import math
 import os
-from contextlib import asynccontextmanager
-from typing import Optional
+import sys
+import asyncio
+import time
+from typing import Optional, AsyncIterator, List, Dict
 
-import torch
 import uvicorn
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 
-from routers import files_router
-from routers.files import FileNotFound
+import routers.batches
+import routers.files
+from routers import files_router, batches_router
+from routers.batches import BatchNotFound, BatchInputError, resume_batches, stop_batches
+from routers.files import FileNotFound, FileTooLarge, FileUploadError
+import tools.DB
+from tools.DB import init_db, dispose_db
 from tools.args import get_args
-from tools.logging_utils import log_set
-from tools.openai_types import ChatModelNotExists, ChatMessagesError, ChatFunctionCallNotAllow
+from tools.executor import InferenceExecutor, InferenceQueueFull, InferenceTimeout
+from tools.file_store import create_file_store
+from tools.logging_utils import RequestContextMiddleware, log_set, record_stage
+from tools.metrics import REGISTRY, STAGE_SECONDS, Counter, Gauge
+from tools.openai_types import ChatModelNotExists, ChatMessagesError, ChatFunctionCallNotAllow, ChatImageNotAvailable
 from tools.openai_types import ModelList, ChatCompletionResponse, ChatCompletionRequest
-from tools.qwen_chat import load_model, format_history
+import tools.model_loader
+from tools.model_loader import load_model
+from tools.model_registry import ModelRegistry, parse_drafts, parse_models
+import tools.qwen_chat
+from tools.qwen_chat import format_history, chat, stream_chat
+from tools.response_cache import ResponseCache, request_key
+from tools.scheduler import KeyQuotas, QuotaExceeded, parse_weights, request_api_key, request_priority
+from tools.replicas import WorkerPool, WorkersUnavailable, spawn_workers, worker_urls, stop_workers
+import tools.sweeper
+from tools.sweeper import start_sweeper
+import tools.image_preprocess
+from tools.image_preprocess import shutdown_pool
+import tools.tools
+import tools.upload
+from tools.tools import IMAGE_CACHE, close_http_client
 
+# the default model, loaded at startup, the others are loaded on their first request
 MODEL_NAME: Optional[str] = "Qwen/Qwen-VL-Chat-Int4"
-MODEL: Optional[AutoModelForCausalLM] = None
-TOKENIZER: Optional[AutoTokenizer] = None
+DEVICE: str = "cuda"
+MODEL_REGISTRY: ModelRegistry = ModelRegistry({MODEL_NAME: MODEL_NAME}, load=load_model, device_map=DEVICE)
+
+# all: serve everything, frontend: forward the chat requests to WORKER_URLS, worker: answer them
+ROLE: str = "all"
+WORKER_URLS: List[str] = []
+WORKER_POOL: Optional[WorkerPool] = None
+
+LOG_LEVEL: str = "INFO"
+LOG_FORMAT: str = "text"
+MAX_QUEUE_SIZE: int = 8
+REQUEST_TIMEOUT: Optional[float] = 600
+MAX_BATCH_SIZE: int = 4
+BATCH_WAIT: float = 0.01
+SWEEP_INTERVAL: int = 10
+# share of the inference worker and quotas of the API keys, see tools.scheduler
+KEY_WEIGHTS: Dict[str, float] = {}
+KEY_TOKEN_RATE: int = 0
+KEY_MAX_CONCURRENCY: int = 0
+EXECUTOR: Optional[InferenceExecutor] = None
+SWEEPER: Optional[asyncio.Task] = None
+# answers of the deterministic chat requests, disabled unless it has a budget
+RESPONSE_CACHE = ResponseCache(max_bytes=0)
+# the load of the default model, the server answers /healthz while it runs
+MODEL_LOAD: Optional[asyncio.Task] = None
+
+# metrics
+CACHE_HITS = Counter("qwen_cache_hits_total", "Cache hits.", labelnames=("cache",))
+CACHE_MISSES = Counter("qwen_cache_misses_total", "Cache misses.", labelnames=("cache",))
+CACHE_EVICTIONS = Counter("qwen_cache_evictions_total", "Cache entries evicted.", labelnames=("cache",))
+CACHE_BYTES = Gauge("qwen_cache_bytes", "Memory or disk held by the cache.", labelnames=("cache",))
+CACHE_HIT_RATIO = Gauge("qwen_cache_hit_ratio", "Hits over lookups since the start.", labelnames=("cache",))
+
+
+def _caches(name: str) -> list:
+    """The caches of one kind, each model has its own prefix and visual cache."""
+    if name == "image":
+        return [IMAGE_CACHE]
+    if name == "response":
+        return [RESPONSE_CACHE]
+    caches = MODEL_REGISTRY.prefix_caches if name == "prefix" else MODEL_REGISTRY.visual_caches
+    return [cache for cache in caches.values() if cache is not None]
+
+
+for _name in ("image", "prefix", "visual", "response"):
+    CACHE_HITS.set_function(lambda _name=_name: sum(cache.hits for cache in _caches(_name)), cache=_name)
+    CACHE_MISSES.set_function(lambda _name=_name: sum(cache.misses for cache in _caches(_name)), cache=_name)
+    CACHE_EVICTIONS.set_function(lambda _name=_name: sum(cache.evictions for cache in _caches(_name)), cache=_name)
+    CACHE_BYTES.set_function(lambda _name=_name: sum(cache.stats()["bytes"] for cache in _caches(_name)), cache=_name)
+    CACHE_HIT_RATIO.set_function(lambda _name=_name: sum(cache.hits for cache in _caches(_name)) / max(
+        sum(cache.hits + cache.misses for cache in _caches(_name)), 1), cache=_name)
+CACHE_HITS.set_function(lambda: sum(cache.disk_hits for cache in _caches("visual")), cache="visual_disk")
+MODELS_LOADED = Gauge("qwen_models_loaded", "Models loaded in memory.")
+MODELS_LOADED.set_function(lambda: len(MODEL_REGISTRY.loaded()))
+MODEL_BYTES = Gauge("qwen_models_bytes", "Memory held by the loaded models.")
+MODEL_BYTES.set_function(lambda: sum(entry.bytes for entry in MODEL_REGISTRY.loaded()))
+MODEL_LOADS = Counter("qwen_model_loads_total", "Models loaded, reloads included.")
+MODEL_LOADS.set_function(lambda: MODEL_REGISTRY.loads)
+MODEL_UNLOADS = Counter("qwen_model_unloads_total", "Models unloaded to stay in the memory budget.")
+MODEL_UNLOADS.set_function(lambda: MODEL_REGISTRY.unloads)
+REQUESTS_IN_FLIGHT = Gauge("qwen_chat_requests_in_flight", "Chat requests being answered, streams included.")
+# the stages of each request are also in its access log line
+STAGE_SECONDS.add_listener(lambda seconds, stage: record_stage(stage, seconds))
 
 path = os.path.dirname(__file__)
 
@@ -34,26 +120,78 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# request ids and the access log
+# noinspection PyTypeChecker
+app.add_middleware(RequestContextMiddleware)
 
 # routers
 app.include_router(files_router)  # /v1/files
+app.include_router(batches_router)  # /v1/batches
 
 
 @app.on_event("startup")
 async def startup_event():
-    # init logging
-    log_set(logging.DEBUG)
+    # init logging, DEBUG logs every request and answer, the records are written by a background thread
+    log_set(LOG_LEVEL, log_format=LOG_FORMAT)
+
+    # files database, one engine and connection pool for all requests
+    init_db()
+    # delete expired files in the background, once for the replicas sharing a front end
+    global SWEEPER
+    if ROLE != "worker":
+        SWEEPER = start_sweeper(SWEEP_INTERVAL)
+        # batches interrupted by the last shutdown, their requests go through the chat route like the others
+        await resume_batches(app)
+
+    # the model is loaded by the workers
+    global WORKER_POOL
+    if ROLE == "frontend":
+        WORKER_POOL = WorkerPool(WORKER_URLS)
+        logging.info(f"Forward chat requests to the model workers: {WORKER_URLS}")
+        return
+
+    # inference worker, keeps generation off the event loop and batches concurrent requests,
+    # interactive requests first and the API keys within their share and quotas
+    global EXECUTOR
+    EXECUTOR = InferenceExecutor(max_queue_size=MAX_QUEUE_SIZE, timeout=REQUEST_TIMEOUT,
+                                 max_batch_size=MAX_BATCH_SIZE, batch_wait=BATCH_WAIT, weights=KEY_WEIGHTS,
+                                 quotas=KeyQuotas(tokens_per_minute=KEY_TOKEN_RATE,
+                                                  max_concurrency=KEY_MAX_CONCURRENCY, weights=KEY_WEIGHTS))
+    EXECUTOR.start()
+    MODEL_REGISTRY.executor = EXECUTOR
 
-    # load model and tokenizer
-    global MODEL, TOKENIZER
-    MODEL, TOKENIZER = load_model(MODEL_NAME, trust_remote_code=True, device_map="cuda")
+    # load the default model and tokenizer in the background, /readyz is OK once it is loaded,
+    # chat requests arriving before wait for it
+    global MODEL_LOAD
+    MODEL_LOAD = asyncio.create_task(MODEL_REGISTRY.get(MODEL_NAME))
+    MODEL_LOAD.add_done_callback(_model_loaded)
+
+
+def _model_loaded(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Load model {MODEL_NAME} failed: {task.exception()!r}")
 
 
-@asynccontextmanager
 @app.on_event("shutdown")
 async def shutdown_event():
-    yield
+    if SWEEPER is not None:
+        SWEEPER.cancel()
+    stop_batches()
+    if EXECUTOR is not None:
+        EXECUTOR.shutdown()
+    if WORKER_POOL is not None:
+        await WORKER_POOL.close()
+    if MODEL_LOAD is not None and not MODEL_LOAD.done():
+        MODEL_LOAD.cancel()
+    await close_http_client()
+    shutdown_pool()
+    dispose_db()
     # GPU allocation
+    MODEL_REGISTRY.unload_all()
+    if "torch" not in sys.modules:
+        return
+    import torch
+
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
         torch.cuda.ipc_collect()
@@ -99,6 +237,71 @@ async def chat_function_call_not_allow_exception_handler(request: Request, exc:
     })
 
 
+@app.exception_handler(ChatImageNotAvailable)
+async def chat_image_not_available_exception_handler(request: Request, exc: ChatImageNotAvailable):
+    """Handle the exception when an image of the messages can not be downloaded."""
+    logging.debug(request)
+    return JSONResponse(status_code=400, content={
+        "object": "error",
+        "message": f"The image `{exc.url[:100]}` is not available: {exc.reason}",
+        "type": "InvalidRequestError",
+        "param": None,
+        "code": 400
+    })
+
+
+@app.exception_handler(InferenceQueueFull)
+async def inference_queue_full_exception_handler(request: Request, exc: InferenceQueueFull):
+    """Handle the exception when too many chat requests are waiting for the model."""
+    logging.debug(request)
+    return JSONResponse(status_code=503, headers={"Retry-After": str(exc.retry_after)}, content={
+        "object": "error",
+        "message": f"The server is overloaded, {exc.max_queue_size} requests are already waiting. Please retry later.",
+        "type": "ServiceUnavailableError",
+        "param": None,
+        "code": 503
+    })
+
+
+@app.exception_handler(QuotaExceeded)
+async def quota_exceeded_exception_handler(request: Request, exc: QuotaExceeded):
+    """Handle the exception when the API key is over its quotas."""
+    logging.debug(request)
+    return JSONResponse(status_code=429, headers={"Retry-After": str(max(math.ceil(exc.retry_after), 1))}, content={
+        "object": "error",
+        "message": f"Rate limit reached: {exc.reason}. Please retry later.",
+        "type": "RateLimitError",
+        "param": None,
+        "code": 429
+    })
+
+
+@app.exception_handler(InferenceTimeout)
+async def inference_timeout_exception_handler(request: Request, exc: InferenceTimeout):
+    """Handle the exception when the chat request is not finished in time."""
+    logging.debug(request)
+    return JSONResponse(status_code=504, content={
+        "object": "error",
+        "message": f"The request is not finished in {exc.timeout} seconds.",
+        "type": "TimeoutError",
+        "param": None,
+        "code": 504
+    })
+
+
+@app.exception_handler(WorkersUnavailable)
+async def workers_unavailable_exception_handler(request: Request, exc: WorkersUnavailable):
+    """Handle the exception when no model worker can take the chat request."""
+    logging.debug(request)
+    return JSONResponse(status_code=503, headers={"Retry-After": "1"}, content={
+        "object": "error",
+        "message": f"None of the {exc.workers} model workers is available. Please retry later.",
+        "type": "ServiceUnavailableError",
+        "param": None,
+        "code": 503
+    })
+
+
 @app.exception_handler(FileNotFound)
 async def file_not_found(request: Request, exc: FileNotFound):
     """Handle the exception when the model does not exist."""
@@ -112,23 +315,135 @@ async def file_not_found(request: Request, exc: FileNotFound):
     })
 
 
+@app.exception_handler(FileTooLarge)
+async def file_too_large(request: Request, exc: FileTooLarge):
+    """Handle the exception when the uploaded file is over the size limit."""
+    logging.debug(request)
+    return JSONResponse(status_code=413, content={
+        "object": "error",
+        "message": f"The file is larger than {exc.max_bytes} bytes.",
+        "type": "FileTooLarge",
+        "param": None,
+        "code": 413
+    })
+
+
+@app.exception_handler(FileUploadError)
+async def file_upload_error(request: Request, exc: FileUploadError):
+    """Handle the exception when the upload is not a valid form."""
+    logging.debug(request)
+    return JSONResponse(status_code=400, content={
+        "object": "error",
+        "message": exc.reason,
+        "type": "InvalidRequestError",
+        "param": None,
+        "code": 400
+    })
+
+
+@app.exception_handler(BatchNotFound)
+async def batch_not_found(request: Request, exc: BatchNotFound):
+    """Handle the exception when the batch does not exist."""
+    logging.debug(request)
+    return JSONResponse(status_code=404, content={
+        "object": "error",
+        "message": f"The batch '{exc.batch_id}' is not found",
+        "type": "BatchNotFound",
+        "param": None,
+        "code": 404
+    })
+
+
+@app.exception_handler(BatchInputError)
+async def batch_input_error(request: Request, exc: BatchInputError):
+    """Handle the exception when the input file can not be run as a batch."""
+    logging.debug(request)
+    return JSONResponse(status_code=400, content={
+        "object": "error",
+        "message": f"The batch is not created: {exc.reason}",
+        "type": "InvalidRequestError",
+        "param": "input_file_id",
+        "code": 400
+    })
+
+
+@app.get("/metrics", response_class=PlainTextResponse, tags=["Metrics"])
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/healthz", tags=["Health"])
+async def healthz():
+    """The server is up, the model may still be loading."""
+    return {"status": "ok"}
+
+
+@app.get("/readyz", tags=["Health"])
+async def readyz():
+    """The default model is loaded, or a model worker is ready on the front end; else 503 with the load progress."""
+    if ROLE == "frontend":
+        ready = await WORKER_POOL.ready() if WORKER_POOL is not None else []
+        return JSONResponse(status_code=200 if ready else 503,
+                            content={"status": "ready" if ready else "loading", "workers": ready})
+    ready = MODEL_REGISTRY.is_loaded(MODEL_NAME) and EXECUTOR is not None
+    progress = MODEL_REGISTRY.progress.get(MODEL_NAME)
+    if ready:
+        status = "ready"
+    elif MODEL_LOAD is not None and MODEL_LOAD.done() and not MODEL_LOAD.cancelled() and MODEL_LOAD.exception():
+        status = "failed"
+    else:
+        status = "loading"
+    return JSONResponse(status_code=200 if ready else 503, content={
+        "status": status, "model": MODEL_NAME, "progress": progress.to_dict() if progress is not None else None})
+
+
 @app.get("/v1/models", response_model=ModelList, tags=["Models"])
 async def list_models():
-    global MODEL_NAME
-    return ModelList(**{"data": [{"id": MODEL_NAME, "owned_by": os.path.split(MODEL_NAME)[-2]}]})
+    return ModelList(**{"data": [{"id": name, "owned_by": os.path.split(checkpoint)[-2]}
+                                 for name, checkpoint in MODEL_REGISTRY.checkpoints.items()]})
+
+
+async def _observe_stream(frames: AsyncIterator[bytes], started: float) -> AsyncIterator[bytes]:
+    """A stream is in flight until its last frame is sent."""
+    try:
+        async for frame in frames:
+            yield frame
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="total")
+        REQUESTS_IN_FLIGHT.dec()
 
 
 @app.post("/v1/chat/completions", response_model=ChatCompletionResponse, tags=["Chat"])
-async def chat_completions(request: ChatCompletionRequest):
-    logging.debug(f"Get request: {request}")
-    global MODEL, TOKENIZER
-    # verify model_name
-    if request.model != MODEL_NAME:
-        raise ChatModelNotExists(model_name=request.model)
+async def chat_completions(request: ChatCompletionRequest, raw_request: Request, response: Response):
+    if WORKER_POOL is not None:
+        return await WORKER_POOL.forward(raw_request)
+
+    started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+    streaming = False
+    try:
+        answer = await _chat_completions(request, raw_request, response)
+        streaming = isinstance(answer, StreamingResponse)
+        if streaming:
+            answer.body_iterator = _observe_stream(answer.body_iterator, started)
+        return answer
+    finally:
+        if not streaming:
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="total")
+            REQUESTS_IN_FLIGHT.dec()
+
+
+async def _chat_completions(request: ChatCompletionRequest, raw_request: Request, response: Response):
+    logging.debug("Get request: %s", request)
+    # verify model_name, and load the model on its first request
+    entry = await MODEL_REGISTRY.get(request.model)
 
     try:
-        query, history, system = format_history(request.messages, TOKENIZER)
-        logging.debug(f"Get query: {query}, history: {history}, system: {system}")
+        with STAGE_SECONDS.time(stage="format_history"):
+            query, history, system, context = await format_history(
+                request.messages, entry.tokenizer,
+                max_window_size=getattr(entry.model.generation_config, "max_window_size", 0))
+        logging.debug("Get query: %s, history: %s, system: %s", query, history, system)
     except ValueError as e:
         raise ChatMessagesError(messages=request.messages, exc=e.__str__())
 
@@ -136,31 +451,103 @@ async def chat_completions(request: ChatCompletionRequest):
     if request.functions is not None or request.tools is not None:
         raise ChatFunctionCallNotAllow(function_name="")
 
-    # seed
-    if request.seed:
-        torch.manual_seed(request.seed)
+    # the same deterministic request gets the same answer, images are compared by content
+    cache_key = None
+    cache_control = raw_request.headers.get("cache-control", "")
+    if RESPONSE_CACHE.enabled and not request.stream and "no-store" not in cache_control \
+            and (request.temperature == 0 or request.seed is not None):
+        cache_key = await run_in_threadpool(request_key, entry.name, query, history, system,
+                                            temperature=request.temperature, top_p=request.top_p, seed=request.seed,
+                                            max_tokens=request.max_tokens, stop=request.stop)
+        cached = RESPONSE_CACHE.get(cache_key) if "no-cache" not in cache_control else None
+        response.headers["X-Cache"] = "HIT" if cached is not None else "MISS"
+        if cached is not None:
+            return ChatCompletionResponse(**cached)
+
+    # the model may have been unloaded to load another while the images were downloaded
+    entry = await MODEL_REGISTRY.get(request.model)
 
-    # chat
+    # chat, X-Priority: bulk for offline requests, the API key of the Authorization header for the quotas
+    priority = request_priority(raw_request.headers)
+    api_key = request_api_key(raw_request.headers)
     if request.stream:
-        # todo: unSupported stream
-        raise HTTPException(status_code=501, detail="Stream chat is not implemented.")
-        # return StreamingResponse(stream_chat(query, history, MODEL, TOKENIZER, MODEL_NAME, append_history=False,
-        #                          top_p=request.top_p, temperature=request.temperature))
+        return StreamingResponse(stream_chat(EXECUTOR, entry.model, entry.tokenizer, query=query, history=history,
+                                             system=system, model_name=entry.name, prefix_cache=entry.prefix_cache,
+                                             stop=request.stop, max_tokens=request.max_tokens, seed=request.seed,
+                                             priority=priority, api_key=api_key, draft=entry.draft,
+                                             context=context, top_p=request.top_p, temperature=request.temperature),
+                                 media_type="text/event-stream")
     else:
-        response, _ = MODEL.chat(TOKENIZER, query=query, history=history, append_history=False,
-                                 top_p=request.top_p, temperature=request.temperature)
-        logging.debug(f"Return response: {response}")
-        return ChatCompletionResponse(**{
+        result = await chat(EXECUTOR, entry.model, entry.tokenizer, query=query, history=history, system=system,
+                            prefix_cache=entry.prefix_cache, stop=request.stop, max_tokens=request.max_tokens,
+                            seed=request.seed, priority=priority, api_key=api_key, draft=entry.draft,
+                            top_p=request.top_p, temperature=request.temperature)
+        logging.debug("Return response: %s", result.text)
+        answer = {
             "object": "chat.completion",
-            "model": MODEL_NAME,
+            "model": entry.name,
             "choices": [{
                 "index": 0,
-                "message": {"role": "assistant", "content": response},
-                "finish_reason": "stop"
-            }]})
+                "message": {"role": "assistant", "content": result.text},
+                "finish_reason": result.finish_reason
+            }],
+            "usage": result.usage(),
+            "context": context}
+        if cache_key is not None:
+            RESPONSE_CACHE.put(cache_key, answer, size=len(result.text.encode()) + 256)
+        return ChatCompletionResponse(**answer)
 
 
 if __name__ == '__main__':
     args = get_args()
     MODEL_NAME = args.checkpoint_path
-    uvicorn.run(app, host=args.server_name, port=args.server_port, workers=1)
+    DEVICE = args.device
+    tools.model_loader.SNAPSHOT_DIR = args.snapshot_dir
+    ROLE = args.role
+    LOG_LEVEL = args.log_level
+    LOG_FORMAT = args.log_format
+    MAX_QUEUE_SIZE = args.max_queue_size
+    REQUEST_TIMEOUT = args.request_timeout
+    MAX_BATCH_SIZE = args.max_batch_size
+    BATCH_WAIT = args.batch_wait
+    SWEEP_INTERVAL = args.sweep_interval
+    KEY_WEIGHTS = parse_weights(args.key_weights)
+    KEY_TOKEN_RATE = args.key_token_rate
+    KEY_MAX_CONCURRENCY = args.key_max_concurrency
+    tools.upload.UPLOAD_CHUNK_SIZE = args.upload_chunk_size * 1024
+    tools.upload.UPLOAD_MAX_BYTES = args.upload_max_size * 1024 * 1024
+    routers.batches.BATCH_CONCURRENCY = args.batch_concurrency
+    tools.sweeper.SWEEP_BATCH_SIZE = args.sweep_batch_size
+    tools.sweeper.SWEEP_MAX_BATCHES = args.sweep_max_batches
+    IMAGE_CACHE.max_bytes = args.image_cache_size * 1024 * 1024
+    IMAGE_CACHE.max_age = args.image_cache_age * 3600
+    RESPONSE_CACHE = ResponseCache(max_bytes=args.response_cache_size * 1024 * 1024, ttl=args.response_cache_ttl)
+    MODEL_REGISTRY = ModelRegistry(parse_models(args.models, default=MODEL_NAME), load=load_model, device_map=DEVICE,
+                                   max_bytes=args.model_memory_budget * 1024 * 1024,
+                                   prefix_cache_bytes=args.prefix_cache_size * 1024 * 1024,
+                                   visual_cache_bytes=args.visual_cache_size * 1024 * 1024,
+                                   visual_cache_dir=args.visual_cache_dir,
+                                   drafts=parse_drafts(args.draft_models, default=MODEL_NAME))
+    tools.qwen_chat.DRAFT_TOKENS = args.draft_tokens
+    tools.qwen_chat.CONTEXT_POLICY = args.context_policy
+    tools.qwen_chat.CONTEXT_BUDGET = args.context_budget
+    tools.qwen_chat.HISTORY_IMAGE_TURNS = args.history_image_turns
+    tools.tools.IMAGE_FETCH_TIMEOUT = args.image_fetch_timeout
+    tools.tools.IMAGE_MAX_BYTES = args.image_max_size * 1024 * 1024
+    tools.image_preprocess.IMAGE_SIZE = args.image_size
+    tools.image_preprocess.IMAGE_WORKERS = args.image_workers
+    tools.DB.DATABASE_URL = args.database_url
+    routers.files.FILE_STORE = create_file_store(args.file_store)
+
+    # one process per model worker, the front end forwards the chat requests to them
+    worker_processes = []
+    if ROLE == "frontend":
+        WORKER_URLS = [url for url in args.worker_urls.split(",") if url]
+        if args.workers > 0:
+            worker_processes = spawn_workers(args.workers, "127.0.0.1", args.server_port + 1, sys.argv[1:])
+            WORKER_URLS += worker_urls(args.workers, "127.0.0.1", args.server_port + 1)
+    try:
+        # the requests are logged by RequestContextMiddleware
+        uvicorn.run(app, host=args.server_name, port=args.server_port, workers=1, access_log=False)
+    finally:
+        stop_workers(worker_processes)
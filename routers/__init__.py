@@ -1 +1,2 @@
 from routers.files import router as files_router
+from routers.batches import router as batches_router
@@ -0,0 +1,510 @@
+"""
+https://platform.openai.com/docs/api-reference/batch
+
+A batch runs the requests of a JSONL file uploaded with the purpose ``batch`` through the chat route of this server,
+several at a time so the inference worker batches them, and saves the results as a ``batch_output`` file.
+The results are appended to a partial file as they come, an interrupted batch resumes from it at startup.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Literal, Optional, Set, Tuple
+
+import httpx
+from fastapi import APIRouter, Depends, Request, FastAPI
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+
+import routers.files
+from routers.files import FileNotFound
+from tools.DB import get_db, init_db, SessionLocal, BatchRecord, FileRecord
+from tools.metrics import Counter
+
+router = APIRouter(prefix="/v1/batches", tags=["batches"], responses={404: {"description": "Not found"}}, )
+
+BATCH_CONCURRENCY: int = 4  # requests of a batch in flight, enough to fill the batches of the inference worker
+BATCH_PROGRESS_INTERVAL: float = 1  # seconds between two saves of the request counts
+BATCH_RETRY_WAIT: float = 1  # seconds before a request refused with 503 or 429 is sent again, unless Retry-After says
+BATCH_MAX_RETRIES: int = 100  # a request still refused after this many retries fails with the last refusal
+# the requests of the batches are bulk ones, which wait for the interactive requests, under their own API key
+BATCH_HEADERS = {"X-Priority": "bulk", "Authorization": "Bearer batch"}
+BATCH_MAX_ERRORS: int = 20  # validation errors reported for a rejected input file
+COMPLETION_WINDOW = timedelta(hours=24)
+# the front ends sharing the database run each batch once, the one which claimed it, see resume_batches
+BATCH_OWNER: str = f"{socket.gethostname()}:{os.getpid()}"
+BATCH_LEASE: float = 60  # seconds without a heartbeat after which the batch is taken over by another front end
+_UNFINISHED = ("validating", "in_progress", "finalizing", "cancelling")
+_RUNNING: Dict[str, asyncio.Task] = {}
+
+BATCH_REQUESTS = Counter("qwen_batch_requests_total", "Requests of the batches answered.", labelnames=("status",))
+
+
+class BatchNotFound(Exception):
+    def __init__(self, batch_id: str = None):
+        self.batch_id = batch_id
+
+
+class BatchInputError(Exception):
+    def __init__(self, reason: str = None):
+        self.reason = reason
+
+
+class CreateBatchRequest(BaseModel):
+    input_file_id: str
+    endpoint: Literal["/v1/chat/completions"]
+    completion_window: Literal["24h"]
+    metadata: Optional[Dict[str, str]] = None
+
+
+class BatchRequestCounts(BaseModel):
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class BatchResponseModel(BaseModel):
+    id: str = Field(description="The batch identifier")
+    object: str = Field(default="batch", description="The object type, which is always batch.")
+    endpoint: str
+    errors: Optional[dict] = None
+    input_file_id: str
+    completion_window: str
+    status: Literal["validating", "failed", "in_progress", "finalizing", "completed", "expired", "cancelling",
+                    "cancelled"]
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = Field(default=None, description="Always None, failed requests are in the output.")
+    created_at: int
+    in_progress_at: Optional[int] = None
+    expires_at: Optional[int] = None
+    finalizing_at: Optional[int] = None
+    completed_at: Optional[int] = None
+    failed_at: Optional[int] = None
+    expired_at: Optional[int] = None
+    cancelled_at: Optional[int] = None
+    request_counts: BatchRequestCounts
+    metadata: Optional[Dict[str, str]] = None
+
+
+def _batch_model(record: BatchRecord) -> BatchResponseModel:
+    return BatchResponseModel(
+        id=record.id, endpoint=record.endpoint, errors=json.loads(record.errors) if record.errors else None,
+        input_file_id=record.input_file_id, completion_window=record.completion_window, status=record.status,
+        output_file_id=record.output_file_id if record.status in ("completed", "cancelled", "expired") else None,
+        created_at=record.created_at, in_progress_at=record.in_progress_at, expires_at=record.expires_at,
+        finalizing_at=record.finalizing_at, completed_at=record.completed_at, failed_at=record.failed_at,
+        expired_at=record.expired_at, cancelled_at=record.cancelled_at,
+        request_counts=BatchRequestCounts(total=record.total or 0, completed=record.completed or 0,
+                                          failed=record.failed or 0),
+        metadata=json.loads(record.batch_metadata) if record.batch_metadata else None)
+
+
+def _claim(batch_id: str, owner: str) -> bool:
+    """
+    Claim the unfinished batch for the owner, unless another front end is running it.
+    The check and the claim are one conditional update, so of the front ends claiming the batch at once one gets it.
+
+    :returns: Whether the owner runs the batch.
+    """
+    now = int(time.time())
+    db = SessionLocal()
+    try:
+        claimed = db.query(BatchRecord).filter(
+            BatchRecord.id == batch_id, BatchRecord.status.in_(_UNFINISHED),
+            or_(BatchRecord.owner.is_(None), BatchRecord.owner == owner, BatchRecord.heartbeat_at < now - BATCH_LEASE)
+        ).update({BatchRecord.owner: owner, BatchRecord.heartbeat_at: now}, synchronize_session=False)
+        db.commit()
+        return claimed == 1
+    finally:
+        db.close()
+
+
+def _release(owner: str):
+    """Release the unfinished batches of the owner, for the next front end to resume them without waiting."""
+    init_db()
+    db = SessionLocal()
+    try:
+        db.query(BatchRecord).filter(BatchRecord.owner == owner, BatchRecord.status.in_(_UNFINISHED)).update(
+            {BatchRecord.owner: None}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+async def _heartbeat(batch_id: str):
+    """Tell the other front ends the batch is still running, until cancelled."""
+    while True:
+        await asyncio.sleep(BATCH_LEASE / 4)
+        await run_in_threadpool(_update, batch_id, heartbeat_at=int(time.time()))
+
+
+def _partial_path(batch_id: str) -> str:
+    """The results received so far, not named like a file so the sweeper leaves it alone."""
+    return routers.files.FILE_STORE.upload_path(f"{batch_id}.partial")
+
+
+def _update(batch_id: str, **values) -> Optional[str]:
+    """
+    Update the batch record.
+    :returns: The status of the batch, it may have been cancelled in the meantime.
+    """
+    init_db()
+    db = SessionLocal()
+    try:
+        record = db.query(BatchRecord).filter(BatchRecord.id == batch_id).first()
+        if record is None:
+            return None
+        if record.status == "cancelling":
+            # a cancelled batch keeps its status until the runner finalizes it
+            values.pop("status", None)
+        for name, value in values.items():
+            setattr(record, name, value)
+        db.commit()
+        return record.status
+    finally:
+        db.close()
+
+
+def _get(batch_id: str) -> Optional[BatchRecord]:
+    init_db()
+    db = SessionLocal()
+    try:
+        return db.query(BatchRecord).filter(BatchRecord.id == batch_id).first()
+    finally:
+        db.close()
+
+
+def _validate(path: str, endpoint: str) -> Tuple[int, List[dict]]:
+    """
+    Check every line of the input file, without keeping them in memory.
+    :returns: The number of requests, the errors.
+    """
+    total, errors, custom_ids = 0, [], set()
+
+    def error(line: int, message: str):
+        if len(errors) < BATCH_MAX_ERRORS:
+            errors.append({"code": "invalid_request", "message": message, "param": None, "line": line})
+
+    with open(path, "rb") as input_file:
+        for number, line in enumerate(input_file, start=1):
+            if not line.strip():
+                continue
+            total += 1
+            try:
+                item = json.loads(line)
+            except ValueError:
+                error(number, "The line is not valid JSON.")
+                continue
+            if not isinstance(item, dict) or not isinstance(item.get("custom_id"), str):
+                error(number, "The custom_id is missing.")
+            elif item["custom_id"] in custom_ids:
+                error(number, f"The custom_id {item['custom_id']} is duplicated.")
+            elif item.get("method") != "POST" or item.get("url") != endpoint:
+                error(number, f"Only POST {endpoint} requests are supported in this batch.")
+            elif not isinstance(item.get("body"), dict):
+                error(number, "The body is missing.")
+            else:
+                custom_ids.add(item["custom_id"])
+    if total == 0:
+        error(0, "The input file has no request.")
+    return total, errors
+
+
+def _read_done(path: str) -> Tuple[Set[str], int, int]:
+    """
+    The requests already answered, the line being written when the batch was interrupted is dropped.
+    :returns: Their custom ids, the number completed and failed.
+    """
+    done, completed, failed = set(), 0, 0
+    if not os.path.exists(path):
+        return done, completed, failed
+    valid = 0
+    with open(path, "rb") as partial:
+        for line in partial:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            valid += len(line)
+            done.add(result["custom_id"])
+            if result["error"] is None and result["response"]["status_code"] == 200:
+                completed += 1
+            else:
+                failed += 1
+    os.truncate(path, valid)
+    return done, completed, failed
+
+
+def _finalize(batch_id: str, status: str, **values):
+    """
+    Save the results as the output file of the batch, even the partial ones of a cancelled or expired batch.
+    A batch stopped before its first result has no output file.
+    """
+    file_store = routers.files.FILE_STORE
+    record = _get(batch_id)
+    partial = _partial_path(batch_id)
+    if os.path.exists(partial) and os.path.getsize(partial) == 0:
+        os.remove(partial)
+    if os.path.exists(partial):
+        os.replace(partial, file_store.upload_path(record.output_file_id))
+        file_store.commit(record.output_file_id)
+
+    init_db()
+    db = SessionLocal()
+    try:
+        if file_store.exists(record.output_file_id):
+            path = file_store.path(record.output_file_id)
+            sha256 = hashlib.sha256()
+            with open(path, "rb") as output:
+                for chunk in iter(lambda: output.read(1024 * 1024), b""):
+                    sha256.update(chunk)
+            db.merge(FileRecord(id=record.output_file_id, filename=f"{batch_id}_output.jsonl", purpose="batch_output",
+                                created_at=int(time.time()), bytes=os.path.getsize(path), sha256=sha256.hexdigest(),
+                                expiration=datetime.now() + routers.files.FILE_EXPIRATION_DELTA,
+                                content_type="application/jsonl"))
+        else:
+            values["output_file_id"] = None
+        record = db.query(BatchRecord).filter(BatchRecord.id == batch_id).first()
+        record.status = status
+        setattr(record, {"completed": "completed_at", "cancelled": "cancelled_at", "expired": "expired_at"}[status],
+                int(time.time()))
+        for name, value in values.items():
+            setattr(record, name, value)
+        db.commit()
+    finally:
+        db.close()
+    logging.info(f"Finish batch: {batch_id}, status: {status}")
+
+
+async def _send(client: httpx.AsyncClient, endpoint: str, custom_id: str, body: dict,
+                stopped: Callable[[], Awaitable[bool]]) -> Optional[dict]:
+    """
+    Answer one request of the batch, waiting while the server is overloaded or the quotas are used,
+    up to BATCH_MAX_RETRIES times.
+
+    :param stopped: Whether the batch is cancelled or expired, checked before each retry.
+    :returns: The result line, None if the batch is stopped first.
+    """
+    body = dict(body, stream=False)
+    for retry in range(BATCH_MAX_RETRIES + 1):
+        try:
+            response = await client.post(endpoint, json=body)
+        except httpx.HTTPError as e:
+            BATCH_REQUESTS.inc(status="error")
+            return {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": custom_id, "response": None,
+                    "error": {"code": type(e).__name__, "message": str(e)}}
+        if response.status_code not in (503, 429) or retry == BATCH_MAX_RETRIES:
+            break
+        await asyncio.sleep(float(response.headers.get("Retry-After", BATCH_RETRY_WAIT)))
+        if await stopped():
+            return None
+    BATCH_REQUESTS.inc(status=str(response.status_code))
+    try:
+        content = response.json()
+    except ValueError:
+        content = {"message": response.text}
+    return {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": custom_id,
+            "response": {"status_code": response.status_code, "request_id": content.get("id"), "body": content},
+            "error": None}
+
+
+async def run_batch(app: FastAPI, batch_id: str):
+    """Run the requests of the batch not answered yet, through the routes of ``app``."""
+    record = await run_in_threadpool(_get, batch_id)
+    if record.status == "cancelling":
+        await run_in_threadpool(_finalize, batch_id, "cancelled")
+        return
+    input_path = routers.files.FILE_STORE.path(record.input_file_id)
+
+    if record.status == "validating":
+        try:
+            total, errors = await run_in_threadpool(_validate, input_path, record.endpoint)
+        except OSError as e:
+            total, errors = 0, [{"code": "file_not_found", "message": str(e), "param": "input_file_id", "line": None}]
+        if errors:
+            await run_in_threadpool(_update, batch_id, status="failed", failed_at=int(time.time()), total=total,
+                                    errors=json.dumps({"object": "list", "data": errors}))
+            logging.info(f"Reject batch: {batch_id}, errors: {len(errors)}")
+            return
+        await run_in_threadpool(_update, batch_id, status="in_progress", in_progress_at=int(time.time()), total=total)
+
+    partial_path = _partial_path(batch_id)
+    done, completed, failed = await run_in_threadpool(_read_done, partial_path)
+    counts = {"completed": completed, "failed": failed}
+    logging.info(f"Start batch: {batch_id}, total: {record.total}, done: {len(done)}")
+
+    stopping: Optional[str] = None
+    last_saved = time.monotonic()
+    read_lock = asyncio.Lock()
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://batch", timeout=None,
+                               headers=BATCH_HEADERS)
+
+    async def save_progress():
+        nonlocal last_saved, stopping
+        last_saved = time.monotonic()
+        status = await run_in_threadpool(_update, batch_id, **counts)
+        if status == "cancelling":
+            stopping = "cancelled"
+        elif record.expires_at is not None and time.time() > record.expires_at:
+            stopping = "expired"
+
+    async def stopped() -> bool:
+        # the workers may all be waiting for the server, the cancellation is checked while they retry
+        if stopping is None and time.monotonic() - last_saved > BATCH_PROGRESS_INTERVAL:
+            await save_progress()
+        return stopping is not None
+
+    async def worker():
+        while stopping is None:
+            async with read_lock:
+                line = await run_in_threadpool(input_file.readline)
+            if not line:
+                return
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if item["custom_id"] in done:
+                continue
+            result = await _send(client, record.endpoint, item["custom_id"], item["body"], stopped)
+            if result is None:
+                return
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            counts["completed" if result["error"] is None and result["response"]["status_code"] == 200
+                   else "failed"] += 1
+            if time.monotonic() - last_saved > BATCH_PROGRESS_INTERVAL:
+                await save_progress()
+
+    try:
+        with open(input_path, "rb") as input_file, open(partial_path, "a", encoding="utf-8") as output:
+            await asyncio.gather(*(worker() for _ in range(BATCH_CONCURRENCY)))
+    finally:
+        await client.aclose()
+    await save_progress()
+
+    if stopping is None:
+        await run_in_threadpool(_update, batch_id, status="finalizing", finalizing_at=int(time.time()))
+    await run_in_threadpool(_finalize, batch_id, stopping or "completed", **counts)
+
+
+def start_batch(app: FastAPI, batch_id: str):
+    """Run the batch in the background, must be called from the event loop."""
+    if batch_id in _RUNNING:
+        return
+    task = asyncio.create_task(run_batch(app, batch_id))
+    _RUNNING[batch_id] = task
+    heartbeat = asyncio.create_task(_heartbeat(batch_id))
+
+    def done(_task: asyncio.Task):
+        _RUNNING.pop(batch_id, None)
+        heartbeat.cancel()
+        if not _task.cancelled() and _task.exception() is not None:
+            logging.error(f"Batch {batch_id} stopped: {_task.exception()!r}")
+
+    task.add_done_callback(done)
+
+
+async def resume_batches(app: FastAPI):
+    """
+    Resume the unfinished batches no front end is running, i.e. stopped by the last shutdown,
+    or whose front end has not sent a heartbeat for BATCH_LEASE seconds.
+    Each batch is claimed first, so the front ends sharing the database and starting at once do not run it twice.
+    """
+    init_db()
+
+    def unfinished() -> List[str]:
+        db = SessionLocal()
+        try:
+            return [row.id for row in db.query(BatchRecord.id).filter(BatchRecord.status.in_(_UNFINISHED))]
+        finally:
+            db.close()
+
+    for batch_id in await run_in_threadpool(unfinished):
+        if batch_id in _RUNNING or not await run_in_threadpool(_claim, batch_id, BATCH_OWNER):
+            continue
+        logging.info(f"Resume batch: {batch_id}")
+        start_batch(app, batch_id)
+
+
+def stop_batches():
+    """Stop the running batches, their results so far are kept and they resume at the next startup."""
+    if not _RUNNING:
+        return
+    for task in list(_RUNNING.values()):
+        task.cancel()
+    _release(BATCH_OWNER)
+
+
+@router.post("", response_model=BatchResponseModel)
+async def create_batch(body: CreateBatchRequest, request: Request, db: Session = Depends(get_db)):
+    """Creates and executes a batch from an uploaded file of requests."""
+    file_record = await run_in_threadpool(lambda: db.query(FileRecord).filter(
+        and_(FileRecord.id == body.input_file_id, FileRecord.expiration > datetime.now())).first())
+    if file_record is None or not routers.files.FILE_STORE.exists(body.input_file_id):
+        raise FileNotFound(file_id=body.input_file_id)
+    if file_record.purpose != "batch":
+        raise BatchInputError(reason=f"The purpose of the input file must be batch, not {file_record.purpose}.")
+
+    now = datetime.now()
+    batch_record = BatchRecord(id=f"batch_{uuid.uuid4().hex}", status="validating", endpoint=body.endpoint,
+                               input_file_id=body.input_file_id, output_file_id=f"file-{uuid.uuid4().hex}",
+                               completion_window=body.completion_window, created_at=int(now.timestamp()),
+                               expires_at=int((now + COMPLETION_WINDOW).timestamp()), total=0, completed=0, failed=0,
+                               batch_metadata=json.dumps(body.metadata) if body.metadata else None,
+                               owner=BATCH_OWNER, heartbeat_at=int(now.timestamp()))
+    # the input file is kept until the batch expires
+    file_record.expiration = max(file_record.expiration, now + COMPLETION_WINDOW)
+    db.add(batch_record)
+    await run_in_threadpool(db.commit)
+    logging.info(f"Create batch: {batch_record.id}, input file: {body.input_file_id}")
+
+    start_batch(request.app, batch_record.id)
+    return _batch_model(batch_record)
+
+
+# the handlers below are sync, so FastAPI runs them and their queries in its threadpool, off the event loop
+@router.get("")
+def list_batches(limit: int = 20, after: Optional[str] = None, db: Session = Depends(get_db)):
+    """List your organization's batches, the newest first."""
+    query = db.query(BatchRecord).order_by(BatchRecord.created_at.desc(), BatchRecord.id.desc())
+    if after is not None:
+        cursor = db.query(BatchRecord).filter(BatchRecord.id == after).first()
+        if cursor is not None:
+            query = query.filter(BatchRecord.created_at <= cursor.created_at, BatchRecord.id != after)
+    records = query.limit(limit + 1).all()
+    data = [_batch_model(record) for record in records[:limit]]
+    return {"object": "list", "data": data, "first_id": data[0].id if data else None,
+            "last_id": data[-1].id if data else None, "has_more": len(records) > limit}
+
+
+@router.get("/{batch_id}", response_model=BatchResponseModel)
+def retrieve_batch(batch_id: str, db: Session = Depends(get_db)):
+    """Retrieves a batch, with the number of requests answered so far."""
+    record = db.query(BatchRecord).filter(BatchRecord.id == batch_id).first()
+    if record is None:
+        raise BatchNotFound(batch_id=batch_id)
+    return _batch_model(record)
+
+
+@router.post("/{batch_id}/cancel", response_model=BatchResponseModel)
+def cancel_batch(batch_id: str, db: Session = Depends(get_db)):
+    """Cancels an in-progress batch, the requests answered so far are saved to its output file."""
+    record = db.query(BatchRecord).filter(BatchRecord.id == batch_id).first()
+    if record is None:
+        raise BatchNotFound(batch_id=batch_id)
+    if record.status in ("validating", "in_progress"):
+        # the runner sees it at its next progress save, and finalizes the batch
+        record.status = "cancelling"
+        db.commit()
+        logging.info(f"Cancel batch: {batch_id}")
+    return _batch_model(record)
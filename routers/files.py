@@ -1,25 +1,28 @@
 """https://platform.openai.com/docs/api-reference/files"""
 
 import logging
-import os
 import time
 import uuid
 from datetime import datetime, timedelta
 from typing import Literal, Optional
 
-import aiofiles
-from fastapi import APIRouter, UploadFile, File, Form
+from fastapi import APIRouter, Request
 from fastapi import Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse, FileResponse
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from sqlalchemy import and_
 from sqlalchemy.orm import Session
 
 from tools.DB import get_db, FileRecord
+from tools.file_store import FileStore, LocalFileStore
+from tools.upload import receive_upload, UploadTooLarge, UploadMalformed
 
 router = APIRouter(prefix="/v1/files", tags=["files"], responses={404: {"description": "Not found"}}, )
 
 FILE_CACHE_DIR = "cache"
+# the uploaded files, share it between replicas, see tools.file_store
+FILE_STORE: FileStore = LocalFileStore(FILE_CACHE_DIR)
 FILE_EXPIRATION_DELTA = timedelta(hours=6)
 
 
@@ -28,6 +31,16 @@ class FileNotFound(FileNotFoundError):
         self.file_id = file_id
 
 
+class FileTooLarge(Exception):
+    def __init__(self, max_bytes: int = None):
+        self.max_bytes = max_bytes
+
+
+class FileUploadError(Exception):
+    def __init__(self, reason: str = None):
+        self.reason = reason
+
+
 class FileResponseModel(BaseModel):
     id: str = Field(default_factory=lambda: f"file-{uuid.uuid4().hex}", description="The file identifier")
     object: str = Field(default="file", description="The object type, which is always file.")
@@ -35,8 +48,10 @@ class FileResponseModel(BaseModel):
     created_at: Optional[int] = Field(default_factory=lambda: int(time.time()),
                                       description="The Unix timestamp (in seconds) for when the file was created.")
     filename: str = Field(description="The name of the file.")
-    purpose: Literal["fine-tune", "fine-tune-results", "assistants", "assistants_output"] = Field(
-        description="The intended purpose of the file. Supported values are fine-tune, fine-tune-results, assistants, and assistants_output.")
+    purpose: Literal["fine-tune", "fine-tune-results", "assistants", "assistants_output", "batch",
+                     "batch_output"] = Field(
+        description="The intended purpose of the file. Supported values are fine-tune, fine-tune-results, "
+                    "assistants, assistants_output, batch and batch_output.")
 
 
 class FileDeleteResponse(BaseModel):
@@ -47,44 +62,47 @@ class FileDeleteResponse(BaseModel):
 
 def check_file_exists(file_id: str):
     """检查文件是否存在"""
-    if not os.path.exists(os.path.join(FILE_CACHE_DIR, file_id)):
+    if not FILE_STORE.exists(file_id):
         raise FileNotFound(file_id=file_id)
 
 
 def remove_file(file_id: str):
     """删除文件"""
-    try:
-        os.remove(os.path.join(FILE_CACHE_DIR, file_id))
-    except FileNotFoundError:
-        pass
+    FILE_STORE.remove(file_id)
 
 
-@router.post("", response_model=FileResponseModel)
-async def upload_file(
-        file: UploadFile = File(...),
-        purpose: str = Form(...),
-        db: Session = Depends(get_db)):
-    """文件上传接口"""
-    logging.info(f"Start uploading file: {file.filename}, file type: {file.content_type}, purpose: {purpose}")
+@router.post("", response_model=FileResponseModel, openapi_extra={"requestBody": {"required": True, "content": {
+    "multipart/form-data": {"schema": {"type": "object", "required": ["file", "purpose"], "properties": {
+        "file": {"type": "string", "format": "binary"}, "purpose": {"type": "string"}}}}}}})
+async def upload_file(request: Request, db: Session = Depends(get_db)):
+    """文件上传接口, 文件直接从请求流写入缓存目录"""
+    file_id = f"file-{uuid.uuid4().hex}"
+    logging.info(f"Start uploading file: {file_id}")
 
-    # 保存文件信息
-    file_object = FileResponseModel(bytes=file.size, filename=file.filename, purpose=purpose)
+    # 流式保存文件, 同时计算 sha256
+    try:
+        fields, upload = await receive_upload(request, FILE_STORE.upload_path(file_id))
+    except UploadTooLarge as e:
+        raise FileTooLarge(max_bytes=e.max_bytes)
+    except UploadMalformed as e:
+        raise FileUploadError(reason=e.reason)
 
-    # 异步保存文件
-    os.makedirs(FILE_CACHE_DIR, exist_ok=True)
-    async with aiofiles.open(os.path.join(FILE_CACHE_DIR, file_object.id), "wb") as buffer:
-        data = await file.read(1024)
-        while data:
-            await buffer.write(data)
-            data = await file.read(1024)
+    # 保存文件信息
+    try:
+        file_object = FileResponseModel(id=file_id, bytes=upload.size, filename=upload.filename,
+                                        purpose=fields.get("purpose"))
+    except ValidationError:
+        remove_file(file_id)
+        raise FileUploadError(reason=f"Invalid purpose: {fields.get('purpose')}")
 
     file_record = FileRecord(id=file_object.id, filename=file_object.filename, purpose=file_object.purpose,
-                             created_at=file_object.created_at, bytes=file_object.bytes,
-                             expiration=datetime.now() + FILE_EXPIRATION_DELTA, content_type=file.content_type)
+                             created_at=file_object.created_at, bytes=file_object.bytes, sha256=upload.sha256,
+                             expiration=datetime.now() + FILE_EXPIRATION_DELTA, content_type=upload.content_type)
+    await run_in_threadpool(FILE_STORE.commit, file_id)
     db.add(file_record)
-    db.commit()
+    await run_in_threadpool(db.commit)
 
-    logging.info(f"Finish uploading file: {file.filename}, saved as: {file_object.id}")
+    logging.info(f"Finish uploading file: {upload.filename}, saved as: {file_object.id}, bytes: {upload.size}")
     return file_object
 
 
@@ -108,8 +126,9 @@ async def list_files():
     # return file_objects
 
 
+# the handlers below are sync, so FastAPI runs them and their queries in its threadpool, off the event loop
 @router.get("/{file_id}")
-async def retrieve_file(file_id: str, db: Session = Depends(get_db)):
+def retrieve_file(file_id: str, db: Session = Depends(get_db)):
     """Returns information about a specific file."""
     logging.info(f"Start retrieving file: {file_id}")
 
@@ -127,7 +146,7 @@ async def retrieve_file(file_id: str, db: Session = Depends(get_db)):
 
 
 @router.delete("/{file_id}")
-async def delete_file(file_id: str, db: Session = Depends(get_db)):
+def delete_file(file_id: str, db: Session = Depends(get_db)):
     """Deletes a specific file."""
     logging.info(f"Start deleting file: {file_id}")
 
@@ -148,7 +167,7 @@ async def delete_file(file_id: str, db: Session = Depends(get_db)):
 
 
 @router.get("/{file_id}/content")
-async def retrieve_file_content(file_id: str, db: Session = Depends(get_db)):
+def retrieve_file_content(file_id: str, db: Session = Depends(get_db)):
     """Returns the content of a specific file."""
     logging.info(f"Start retrieving file content: {file_id}")
 
@@ -161,5 +180,5 @@ async def retrieve_file_content(file_id: str, db: Session = Depends(get_db)):
     check_file_exists(file_id=file_id)
 
     logging.info(f"Finish retrieving file content: {file_id}")
-    return FileResponse(path=os.path.join(FILE_CACHE_DIR, file_record.id), filename=file_record.filename,
+    return FileResponse(path=FILE_STORE.path(file_record.id), filename=file_record.filename,
                         media_type=file_record.content_type)
@@ -0,0 +1,48 @@
+"""Assisted greedy decoding answers as plain greedy generate, see tools.qwen_generate.assisted_generate."""
+
+import pytest
+
+import tools.qwen_chat
+import tools.qwen_generate
+from tools.prefix_cache import PrefixCache
+from tests.tiny_model import TinyQwen, TinyQwenLayout, answer, conversation, load
+
+QUERIES = ["Hi", "What is in the picture?", "Tell me a long story about a cat and a dog."]
+
+
+def one_by_one(model, tokenizer, draft, prefix_cache=None, **kwargs):
+    """The answers to QUERIES, each alone, as assisted generation answers single conversations."""
+    return [answer(model, tokenizer, [conversation(query, **kwargs)], prefix_cache, draft)[0] for query in QUERIES]
+
+
+@pytest.mark.parametrize("seed", range(0, 30, 3))
+@pytest.mark.parametrize("draft_tokens", [1, 4])
+@pytest.mark.parametrize("repetition_penalty", [1.0, 1.3])
+@pytest.mark.parametrize("model_class", [TinyQwen, TinyQwenLayout])
+def test_assisted_equals_greedy(seed, draft_tokens, repetition_penalty, model_class, monkeypatch):
+    monkeypatch.setattr(tools.qwen_chat, "DRAFT_TOKENS", draft_tokens)
+    model, tokenizer = load(seed, model_class=model_class, repetition_penalty=repetition_penalty)
+    draft, _ = load(seed + 1)
+    assert one_by_one(model, tokenizer, draft) == one_by_one(model, tokenizer, None)
+
+
+def test_assisted_with_prefix_cache_and_stops():
+    model, tokenizer = load(0)
+    same, _ = load(0)
+    other, _ = load(1)
+    for kwargs in [{}, {"max_tokens": 1}, {"max_tokens": 7}, {"stop": "e"}]:
+        expected = one_by_one(model, tokenizer, None, **kwargs)
+        for draft in (same, other):
+            prefix_cache = PrefixCache(max_bytes=1 << 26)
+            assert one_by_one(model, tokenizer, draft, prefix_cache, **kwargs) == expected
+            # the second time from the prefix cache
+            assert one_by_one(model, tokenizer, draft, prefix_cache, **kwargs) == expected
+
+
+def test_acceptance_is_counted(monkeypatch):
+    monkeypatch.setattr(tools.qwen_generate, "_ASSISTED", {"drafted": 0, "accepted": 0})
+    model, tokenizer = load(0)
+    same, _ = load(0)
+    one_by_one(model, tokenizer, same)
+    assert tools.qwen_generate._ASSISTED["drafted"] > 0
+    assert tools.qwen_generate._ASSISTED["accepted"] == tools.qwen_generate._ASSISTED["drafted"]
@@ -0,0 +1,134 @@
+"""Batches stop retrying once cancelled or out of retries, and run on one front end, see routers.batches."""
+
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+import routers.batches
+import routers.files
+import tools.DB
+from routers.batches import _batch_model, _claim, _get, _release, _send, _update, resume_batches, run_batch
+from tools.DB import BatchRecord, SessionLocal, init_db
+from tools.file_store import LocalFileStore
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    tools.DB.dispose_db()
+    monkeypatch.setattr(tools.DB, "DATABASE_URL", f"sqlite:///{tmp_path / 'files.db'}")
+    monkeypatch.setattr(routers.files, "FILE_STORE", LocalFileStore(str(tmp_path / "files")))
+    monkeypatch.setattr(routers.batches, "BATCH_RETRY_WAIT", 0.01)
+    monkeypatch.setattr(routers.batches, "BATCH_PROGRESS_INTERVAL", 0.05)
+    yield
+    tools.DB.dispose_db()
+
+
+def overloaded_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat():
+        return JSONResponse({"object": "error", "message": "busy"}, status_code=503)
+
+    return app
+
+
+def create_batch(status: str, lines: int = 0) -> str:
+    init_db()
+    input_file_id = "file-input"
+    with open(routers.files.FILE_STORE.upload_path(input_file_id), "w") as input_file:
+        for number in range(lines):
+            input_file.write(json.dumps({"custom_id": str(number), "method": "POST", "url": "/v1/chat/completions",
+                                         "body": {"model": "m", "messages": []}}) + "\n")
+    db = SessionLocal()
+    try:
+        db.add(BatchRecord(id="batch_test", status=status, endpoint="/v1/chat/completions",
+                           input_file_id=input_file_id, output_file_id="file-output", completion_window="24h",
+                           created_at=int(time.time()), expires_at=int(time.time()) + 3600, total=lines,
+                           completed=0, failed=0))
+        db.commit()
+    finally:
+        db.close()
+    return "batch_test"
+
+
+def test_send_fails_with_the_last_refusal_after_the_retries(monkeypatch):
+    monkeypatch.setattr(routers.batches, "BATCH_MAX_RETRIES", 3)
+    monkeypatch.setattr(routers.batches, "BATCH_RETRY_WAIT", 0)
+
+    async def main():
+        transport = httpx.ASGITransport(app=overloaded_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await _send(client, "/v1/chat/completions", "a", {}, stopped=lambda: asyncio.sleep(0, False))
+
+    result = asyncio.run(main())
+    assert result["response"]["status_code"] == 503
+    assert result["response"]["body"]["message"] == "busy"
+
+
+def test_send_stops_retrying_once_the_batch_is_stopped():
+    async def main():
+        transport = httpx.ASGITransport(app=overloaded_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await _send(client, "/v1/chat/completions", "a", {}, stopped=lambda: asyncio.sleep(0, True))
+
+    assert asyncio.run(main()) is None
+
+
+def test_batch_refused_by_the_server_can_be_cancelled(stores):
+    batch_id = create_batch("in_progress", lines=3)
+
+    async def main():
+        task = asyncio.create_task(run_batch(overloaded_app(), batch_id))
+        await asyncio.sleep(0.3)
+        assert not task.done()
+        routers.batches._update(batch_id, status="cancelling")
+        await asyncio.wait_for(task, 5)
+
+    asyncio.run(main())
+    record = _get(batch_id)
+    assert record.status == "cancelled"
+    assert record.output_file_id is None
+    assert _batch_model(record).output_file_id is None
+
+
+def test_batch_cancelled_before_running_has_no_output_file(stores):
+    batch_id = create_batch("cancelling")
+    asyncio.run(run_batch(FastAPI(), batch_id))
+    record = _get(batch_id)
+    assert record.status == "cancelled"
+    assert _batch_model(record).output_file_id is None
+
+
+def test_batch_is_claimed_by_one_of_the_front_ends(stores):
+    batch_id = create_batch("in_progress")
+    with ThreadPoolExecutor(8) as pool:
+        claimed = list(pool.map(lambda owner: _claim(batch_id, owner), [f"front-{index}" for index in range(8)]))
+    assert claimed.count(True) == 1
+    owner = f"front-{claimed.index(True)}"
+    assert _get(batch_id).owner == owner
+    assert _claim(batch_id, owner) and not _claim(batch_id, "other")
+    # the owner has stopped sending heartbeats
+    _update(batch_id, heartbeat_at=int(time.time() - routers.batches.BATCH_LEASE - 1))
+    assert _claim(batch_id, "other") and not _claim(batch_id, owner)
+
+
+def test_batch_is_resumed_once(stores, monkeypatch):
+    batch_id = create_batch("in_progress")
+    started = []
+    monkeypatch.setattr(routers.batches, "start_batch", lambda app, batch_id: started.append(batch_id))
+    for owner in ["front-0", "front-1"]:
+        monkeypatch.setattr(routers.batches, "BATCH_OWNER", owner)
+        asyncio.run(resume_batches(FastAPI()))
+    assert started == [batch_id]
+    # stopped on shutdown, the batch is resumed at once by the next front end
+    _release("front-0")
+    asyncio.run(resume_batches(FastAPI()))
+    assert started == [batch_id, batch_id]
+    assert _get(batch_id).owner == "front-1"
@@ -0,0 +1,59 @@
+"""Left padded batched generation answers as the unbatched one, see tools.qwen_generate.generate_batch."""
+
+import asyncio
+
+import pytest
+
+import tools.qwen_generate
+from tools.executor import InferenceExecutor
+from tools.qwen_chat import chat
+from tools.qwen_generate import generate_batch
+from tests.tiny_model import answer, conversation, load
+
+QUERIES = ["Hi", "What is in the picture?", "Tell me a long story about a cat and a dog, in a few words."]
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_padded_rows_answer_as_single_rows(seed):
+    model, tokenizer = load(seed)
+    single = [answer(model, tokenizer, [conversation(query)])[0] for query in QUERIES]
+    batched = answer(model, tokenizer, [conversation(query) for query in QUERIES])
+    assert batched == single
+    assert all(tokens == model.generation_config.max_new_tokens for _, _, tokens in single)
+
+
+def test_rows_stop_at_their_own_max_tokens():
+    model, tokenizer = load(0)
+    max_tokens = [3, None, 10]
+    single = [answer(model, tokenizer, [conversation(query, max_tokens=tokens)])[0]
+              for query, tokens in zip(QUERIES, max_tokens)]
+    batched = answer(model, tokenizer, [conversation(query, max_tokens=tokens)
+                                        for query, tokens in zip(QUERIES, max_tokens)])
+    assert batched == single
+    assert [tokens for _, _, tokens in batched] == [3, model.generation_config.max_new_tokens, 10]
+    assert [reason for _, reason, _ in batched] == ["length"] * 3
+
+
+def test_executor_gathers_concurrent_chats(monkeypatch):
+    model, tokenizer = load(0)
+    sizes = []
+
+    def recorded(*args):
+        sizes.append(len(args[-1]))
+        return generate_batch(*args)
+
+    monkeypatch.setattr(tools.qwen_generate, "generate_batch", recorded)
+
+    async def main():
+        executor = InferenceExecutor(max_queue_size=8, max_batch_size=4, batch_wait=0.5)
+        executor.start()
+        try:
+            return await asyncio.gather(*[chat(executor, model, tokenizer, query, [("hi", "hello")],
+                                               "You are a helpful assistant.") for query in QUERIES])
+        finally:
+            executor.shutdown()
+
+    results = asyncio.run(main())
+    assert sizes == [len(QUERIES)]
+    assert [result.text for result in results] == [answer(model, tokenizer, [conversation(query)])[0][0]
+                                                   for query in QUERIES]
@@ -0,0 +1,69 @@
+"""The history given to the model within the context budget, see tools.qwen_chat._fit_context."""
+
+import pytest
+
+import tools.qwen_chat
+from tools.openai_types import ChatMessage
+from tools.qwen_chat import IMAGE_TOKENS, _fit_context
+from tests.tiny_model import CharTokenizer
+
+
+def turns(count: int, images: bool = True):
+    content = [{"type": "text", "text": "a question"}]
+    if images:
+        content.append({"type": "image_url", "image_url": {"url": "https://example.com/image.png"}})
+    return [(ChatMessage(role="user", content=content), ChatMessage(role="assistant", content="an answer"))
+            for _ in range(count)]
+
+
+def fit(history, budget: int = 0, policy: str = "drop", image_turns: int = -1, monkeypatch=None):
+    monkeypatch.setattr(tools.qwen_chat, "CONTEXT_POLICY", policy)
+    monkeypatch.setattr(tools.qwen_chat, "HISTORY_IMAGE_TURNS", image_turns)
+    return _fit_context("system", history, ChatMessage(role="user", content="the query"), CharTokenizer(), budget)
+
+
+@pytest.mark.parametrize("count,image_turns", [(3, 0), (3, 1), (6, 2), (5, 5), (2, 4)])
+def test_images_older_than_the_last_turns_are_stripped(count, image_turns, monkeypatch):
+    first, stripped, report = fit(turns(count), image_turns=image_turns, monkeypatch=monkeypatch)
+    assert first == 0
+    assert stripped == set(range(max(count - image_turns, 0)))
+    assert report["stripped_images"] == len(stripped)
+
+
+def test_history_under_the_budget_is_kept(monkeypatch):
+    first, stripped, report = fit(turns(10), budget=100000, monkeypatch=monkeypatch)
+    assert (first, stripped, report["saved_tokens"], report["dropped_turns"]) == (0, set(), 0, 0)
+
+
+def test_turns_are_dropped_by_blocks(monkeypatch):
+    history = turns(10)
+    _, _, full = fit(history, monkeypatch=monkeypatch)
+    turn = (full["estimated_prompt_tokens"] - fit([], monkeypatch=monkeypatch)[2]["estimated_prompt_tokens"]) // 10
+    # 3 turns fit, the turns are dropped up to the block boundary at 8
+    first, _, report = fit(history, budget=full["estimated_prompt_tokens"] - 7 * turn, monkeypatch=monkeypatch)
+    assert first == 8
+    assert report["saved_tokens"] == 8 * turn
+    assert report["estimated_prompt_tokens"] == full["estimated_prompt_tokens"] - 8 * turn
+
+
+def test_newest_turns_which_fit_are_kept_past_the_last_block(monkeypatch):
+    history = turns(10)
+    _, _, full = fit(history, monkeypatch=monkeypatch)
+    fixed = fit([], monkeypatch=monkeypatch)[2]["estimated_prompt_tokens"]
+    turn = (full["estimated_prompt_tokens"] - fixed) // 10
+    assert turn > IMAGE_TOKENS
+    # only the newest turn fits, the block of the last 2 turns is over the budget
+    first, _, report = fit(history, budget=fixed + turn + turn // 2, monkeypatch=monkeypatch)
+    assert first == 9
+    assert report["dropped_turns"] == 9
+    assert report["estimated_prompt_tokens"] <= fixed + turn + turn // 2
+
+
+def test_compact_strips_images_before_dropping(monkeypatch):
+    history = turns(8)
+    _, _, full = fit(history, monkeypatch=monkeypatch)
+    first, stripped, report = fit(history, budget=full["estimated_prompt_tokens"] - 3 * IMAGE_TOKENS, policy="compact",
+                                  monkeypatch=monkeypatch)
+    assert first == 0
+    assert stripped == {0, 1, 2, 3}
+    assert report["stripped_images"] == 4
@@ -0,0 +1,114 @@
+"""The images of the messages are decoded or fetched within their size and time limits, see tools.tools."""
+
+import asyncio
+import hashlib
+import os
+from base64 import b64encode
+
+import httpx
+import pytest
+from fastapi import FastAPI, Response
+from fastapi.responses import StreamingResponse
+
+import tools.image_preprocess
+import tools.tools
+from tools.image_cache import ImageCache
+from tools.openai_types import ChatImageNotAvailable
+from tools.tools import decode_data_url, download_images
+
+CONTENT = os.urandom(10_000)
+
+
+@pytest.mark.parametrize("payload, content", [
+    (b64encode(CONTENT).decode(), CONTENT),
+    (b64encode(CONTENT[:-1]).decode(), CONTENT[:-1]),
+    # the line breaks of a MIME encoded payload fall anywhere in the decoded chunks
+    ("\n".join(b64encode(CONTENT[start:start + 57]).decode() for start in range(0, len(CONTENT), 57)), CONTENT),
+])
+def test_data_url_is_decoded_in_chunks(payload, content, monkeypatch):
+    monkeypatch.setattr(tools.tools, "DATA_URL_CHUNK", 1000)
+    extension, data, digest = decode_data_url(f"data:image/png;base64,{payload}")
+    assert (extension, bytes(data)) == ("png", content)
+    assert digest == hashlib.sha256(content).hexdigest()[:32]
+
+
+@pytest.mark.parametrize("url", [
+    "data:text/plain;base64,aGk=",
+    "data:image/png,hi",
+    f"data:image/png;base64,{b64encode(CONTENT).decode()[:-1]}",
+])
+def test_invalid_data_url_is_not_available(url):
+    with pytest.raises(ChatImageNotAvailable):
+        decode_data_url(url)
+
+
+def test_too_large_data_url_is_not_available(monkeypatch):
+    monkeypatch.setattr(tools.tools, "IMAGE_MAX_BYTES", len(CONTENT) - 1)
+    with pytest.raises(ChatImageNotAvailable):
+        decode_data_url(f"data:image/png;base64,{b64encode(CONTENT).decode()}")
+
+
+def image_host(expected: int = 1) -> FastAPI:
+    """A stand-in image host, its png images are only sent once the expected number of requests are in flight."""
+    app = FastAPI()
+    arrived, everyone = [], asyncio.Event()
+
+    @app.get("/{name}.png")
+    async def image(name: str):
+        arrived.append(name)
+        if len(arrived) == expected:
+            everyone.set()
+        await everyone.wait()
+        return Response(name.encode(), media_type="image/png")
+
+    @app.get("/slow.jpg")
+    async def slow():
+        await asyncio.sleep(60)
+
+    @app.get("/large.jpg")
+    async def large():
+        # no Content-Length, only the streamed size can reject it
+        return StreamingResponse((b"x" * 1024 for _ in range(100)), media_type="image/jpeg")
+
+    @app.get("/lying.jpg")
+    async def lying():
+        return Response(b"x", media_type="image/jpeg", headers={"content-length": "a lot"})
+
+    return app
+
+
+def download(app: FastAPI, names, tmp_path, monkeypatch) -> dict:
+    """Download the images of the host, return name -> content of the downloaded file, or the error."""
+    monkeypatch.setattr(tools.image_preprocess, "IMAGE_SIZE", 0)
+    monkeypatch.setattr(tools.tools, "IMAGE_FETCH_TIMEOUT", 1)
+    monkeypatch.setattr(tools.tools, "IMAGE_MAX_BYTES", 50 * 1024)
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app)) as client:
+            try:
+                paths = await download_images([f"http://images.test/{name}" for name in names],
+                                              cache=ImageCache(str(tmp_path)), client=client)
+            except ChatImageNotAvailable as e:
+                return e
+        return {url.rsplit("/", 1)[1]: open(path, "rb").read() for url, path in paths.items()}
+
+    return asyncio.run(main())
+
+
+def test_images_are_fetched_concurrently(tmp_path, monkeypatch):
+    # fetched one after the other, the first image would wait for the others until the timeout
+    names = [f"cat{index}.png" for index in range(8)]
+    assert download(image_host(expected=len(names)), names, tmp_path, monkeypatch) == \
+        {name: name[:-len(".png")].encode() for name in names}
+
+
+@pytest.mark.parametrize("name, reason", [
+    ("slow.jpg", "not downloaded in 1 seconds"),
+    ("large.jpg", f"larger than {50 * 1024} bytes"),
+    ("lying.jpg", "invalid Content-Length header"),
+])
+def test_image_is_not_available(name, reason, tmp_path, monkeypatch):
+    error = download(image_host(), [name], tmp_path, monkeypatch)
+    assert isinstance(error, ChatImageNotAvailable)
+    assert error.reason == reason
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,46 @@
+"""Records are redacted and written by the listener thread, not by the caller, see tools.logging_utils."""
+
+import json
+import logging
+import threading
+
+import pytest
+
+import tools.logging_utils
+from tools.logging_utils import REQUEST_ID, log_set, log_stop
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    yield tmp_path / "log.jsonl"
+    log_stop()
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def test_records_are_redacted_on_the_listener_thread(log_file, monkeypatch):
+    threads = []
+    redact = tools.logging_utils.redact
+
+    def recorded(message):
+        threads.append(threading.current_thread())
+        return redact(message)
+
+    monkeypatch.setattr(tools.logging_utils, "redact", recorded)
+    monkeypatch.setattr(tools.logging_utils, "LOG_MAX_CHARS", 200)
+    log_set(logging.DEBUG, log_save=True, save_path=str(log_file), log_format="json")
+    payload = "A" * 100_000
+    token = REQUEST_ID.set("request-1")
+    try:
+        logging.debug("image: data:image/png;base64,%s and %s", payload, "x" * 1000)
+    finally:
+        REQUEST_ID.reset(token)
+    log_stop()
+
+    assert threads and threading.current_thread() not in threads
+    lines = [json.loads(line) for line in log_file.read_text().splitlines()]
+    assert [line["request_id"] for line in lines] == ["request-1"]
+    redacted = f"image: data:image/png;base64,<{len(payload)} chars> and {'x' * 1000}"
+    assert lines[0]["message"] == f"{redacted[:200]}... <{len(redacted) - 200} more chars>"
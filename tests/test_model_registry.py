@@ -0,0 +1,51 @@
+"""Models are unloaded after their generations and before the next model is loaded, see tools.model_registry."""
+
+import asyncio
+import time
+
+from tools.executor import InferenceExecutor
+from tools.model_registry import ModelRegistry, model_bytes
+from tests.tiny_model import load
+
+
+def test_unload_waits_for_the_generations_of_the_model():
+    events = []
+
+    def load_model(checkpoint, device_map=None, progress=None):
+        events.append(f"load {checkpoint}")
+        return load(0)
+
+    def generate(model, seconds, cancel_event=None):
+        time.sleep(seconds)
+        events.append("generated")
+        return model
+
+    async def main():
+        executor = InferenceExecutor(max_queue_size=8)
+        executor.start()
+        try:
+            registry = ModelRegistry({"a": "a", "b": "b"}, load=load_model, device_map=None)
+            registry.executor = executor
+            entry = await registry.get("a")
+            registry.max_bytes = model_bytes(entry.model)  # one model at a time
+            job = executor.enqueue(generate, entry.model, 0.5)
+            entry.prefix_cache.put([1, 2, 3], ((entry.model.transformer.wte.weight[:1],),))
+            await registry.get("b")
+            assert job.future.done()
+            assert [entry.name for entry in registry.loaded()] == ["b"]
+            assert registry.unloads == 1
+            assert entry.prefix_cache.stats()["entries"] == 0
+        finally:
+            executor.shutdown()
+
+    asyncio.run(main())
+    assert events == ["load a", "generated", "load b"]
+
+
+def test_no_prefix_cache_with_a_budget_of_0():
+    registry = ModelRegistry({"a": "a"}, load=lambda checkpoint, device_map=None, progress=None: load(0),
+                             device_map=None, prefix_cache_bytes=0)
+    entry = asyncio.run(registry.get("a"))
+    assert entry.prefix_cache is None
+    asyncio.run(registry.unload("a"))
+    assert not registry.is_loaded("a")
@@ -0,0 +1,57 @@
+"""A conversation answers the same with the past key values of its earlier turns, see tools.qwen_generate._prefill."""
+
+import pytest
+import torch
+
+from tools.prefix_cache import PrefixCache
+from tests.tiny_model import EOS, IMAGE_START, TinyQwen, TinyQwenLayout, TinyQwenVL, answer, conversation, load, \
+    make_context
+
+
+def talk(model, tokenizer, queries, prefix_cache=None):
+    """Answer the queries as the turns of one conversation, each turn sent with the history of the earlier ones."""
+    history, answers = [], []
+    for query in queries:
+        # short answers, so twelve turns fit in the positions of the model
+        answers.append(answer(model, tokenizer, [conversation(query, history=list(history), max_tokens=8)],
+                              prefix_cache)[0])
+        history.append((query, answers[-1][0]))
+    return answers
+
+
+@pytest.mark.parametrize("model_class", [TinyQwen, TinyQwenLayout])
+def test_cached_turns_answer_as_uncached(model_class):
+    model, tokenizer = load(0, model_class=model_class)
+    queries = ["Go on."] * 12
+    prefix_cache = PrefixCache(max_bytes=1 << 26)
+    assert talk(model, tokenizer, queries, prefix_cache) == talk(model, tokenizer, queries)
+    stats = prefix_cache.stats()
+    assert stats["hits"] == len(queries) - 1 and stats["reused_tokens"] > 0
+
+
+def test_cached_turns_with_images_answer_as_uncached():
+    model, tokenizer = load(0, model_class=TinyQwenVL)
+    queries = [f"<img>cat{turn}.png</img>What is new?" if turn % 2 else f"Turn {turn}, go on."
+               for turn in range(12)]
+    uncached = talk(model, tokenizer, queries)
+    model.transformer.visual.encoded.clear()
+    prefix_cache = PrefixCache(max_bytes=1 << 26)
+    assert talk(model, tokenizer, queries, prefix_cache) == uncached
+    assert prefix_cache.stats()["hits"] == len(queries) - 1
+    # the images of the earlier turns come from the cache, each image is encoded once
+    assert model.transformer.visual.encoded == [f"cat{turn}.png" for turn in range(1, 12, 2)]
+
+
+def test_prefix_ending_inside_an_image_is_not_reused():
+    model, tokenizer = load(0, model_class=TinyQwenVL)
+    item = conversation("<img>dog.png</img>What is this?")
+    expected = answer(model, tokenizer, [item])
+    _, context = make_context(tokenizer, item["query"], item["history"], item["system"])
+    prefix = context[:context.index(IMAGE_START) + 3]
+    with torch.no_grad():
+        # the past key values of other tokens, which would change the answer if they were reused
+        past_key_values = model(input_ids=torch.tensor([[EOS] * len(prefix)]), use_cache=True).past_key_values
+    prefix_cache = PrefixCache(max_bytes=1 << 26)
+    prefix_cache.put(prefix, past_key_values)
+    assert answer(model, tokenizer, [item], prefix_cache) == expected
+    assert prefix_cache.stats()["hits"] == 1
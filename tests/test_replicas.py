@@ -0,0 +1,138 @@
+"""The front end skips busy and unreachable workers, the replicas share the uploaded files, see tools.replicas."""
+
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+import routers.files
+import tools.DB
+from routers import files_router
+from tools.file_store import LocalFileStore
+from tools.replicas import WorkerPool, WorkersUnavailable
+from tools.tools import download_img_from_url
+
+
+class Unreachable(httpx.AsyncBaseTransport):
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        raise httpx.ConnectError("Connection refused", request=request)
+
+
+def worker_app(name: str, busy: bool = False) -> FastAPI:
+    """A stand-in model worker, 503 when its queue is full, streams when asked to."""
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request):
+        if busy:
+            return JSONResponse({"object": "error", "message": "busy"}, status_code=503)
+        body = await request.json()
+        if body.get("stream"):
+            frames = [f"data: {json.dumps({'worker': name, 'index': index})}\n\n" for index in range(3)]
+            return StreamingResponse(iter([*frames, "data: [DONE]\n\n"]), media_type="text/event-stream")
+        return {"worker": name}
+
+    return app
+
+
+def front_end(pool: WorkerPool) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request):
+        try:
+            return await pool.forward(request)
+        except WorkersUnavailable as e:
+            return JSONResponse({"object": "error", "workers": e.workers}, status_code=503)
+
+    return app
+
+
+def forward(workers: dict, body: dict) -> httpx.Response:
+    """Send the body through a front end to the workers, which are {url: app or None when unreachable}."""
+    async def main():
+        pool = WorkerPool(list(workers))
+        await pool.close()
+        pool._client = httpx.AsyncClient(mounts={url: httpx.ASGITransport(app=app) if app is not None else Unreachable()
+                                                 for url, app in workers.items()})
+        try:
+            transport = httpx.ASGITransport(app=front_end(pool))
+            async with httpx.AsyncClient(transport=transport, base_url="http://front") as client:
+                response = await client.post("/v1/chat/completions", json=body)
+            assert all(count == 0 for count in pool.in_flight.values())
+            return response
+        finally:
+            await pool.close()
+
+    return asyncio.run(main())
+
+
+def test_busy_and_unreachable_workers_are_skipped():
+    response = forward({"http://w0": worker_app("w0", busy=True), "http://w1": None,
+                        "http://w2": worker_app("w2")}, {"model": "m"})
+    assert response.status_code == 200
+    assert response.json()["worker"] == "w2"
+
+
+def test_stream_is_relayed():
+    response = forward({"http://w0": None, "http://w1": worker_app("w1")}, {"model": "m", "stream": True})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    frames = [frame[len("data: "):] for frame in response.text.split("\n\n") if frame]
+    assert frames[-1] == "[DONE]"
+    assert [json.loads(frame) for frame in frames[:-1]] == [{"worker": "w1", "index": index} for index in range(3)]
+
+
+def test_last_refusal_is_returned_when_every_worker_is_busy():
+    response = forward({"http://w0": worker_app("w0", busy=True), "http://w1": worker_app("w1", busy=True)},
+                       {"model": "m"})
+    assert response.status_code == 503
+    assert response.json()["message"] == "busy"
+
+
+def test_no_reachable_worker():
+    response = forward({"http://w0": None, "http://w1": None}, {"model": "m"})
+    assert response.status_code == 503
+    assert response.json()["workers"] == 2
+
+
+@pytest.fixture
+def replica(tmp_path, monkeypatch):
+    """Switch to another replica, with its own file store and database connections on the shared directory."""
+    monkeypatch.setattr(tools.DB, "DATABASE_URL", f"sqlite:///{tmp_path / 'files.db'}")
+    app = FastAPI()
+    app.include_router(files_router)
+
+    def switch() -> httpx.AsyncClient:
+        tools.DB.dispose_db()
+        routers.files.FILE_STORE = LocalFileStore(str(tmp_path / "files"))
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://replica")
+
+    monkeypatch.setattr(routers.files, "FILE_STORE", routers.files.FILE_STORE)
+    yield switch
+    tools.DB.dispose_db()
+
+
+def test_file_uploaded_through_one_replica_is_read_through_another(replica):
+    content = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 64
+
+    async def main():
+        async with replica() as client:
+            response = await client.post("/v1/files", data={"purpose": "assistants"},
+                                         files={"file": ("image.png", content, "image/png")})
+            assert response.status_code == 200
+            file_id = response.json()["id"]
+        async with replica() as client:
+            record = (await client.get(f"/v1/files/{file_id}")).json()
+            downloaded = (await client.get(f"/v1/files/{file_id}/content")).content
+        path = await download_img_from_url(f"http://127.0.0.1:8000/v1/files/{file_id}/content")
+        return record, downloaded, path
+
+    record, downloaded, path = asyncio.run(main())
+    assert record["bytes"] == len(content) and record["filename"] == "image.png"
+    assert downloaded == content
+    with open(path, "rb") as image:
+        assert image.read() == content
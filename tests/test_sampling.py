@@ -0,0 +1,45 @@
+"""Seeded sampling is per row, see tools.qwen_generate.SamplingLogitsProcessor."""
+
+import torch
+
+from tests.tiny_model import answer, conversation, load
+
+GENERATION_KWARGS = {"temperature": 1.5, "top_p": 0.95}  # flat enough for the seeds to matter
+
+
+def texts(model, tokenizer, conversations):
+    return [text for text, _, _ in answer(model, tokenizer, conversations, generation_kwargs=GENERATION_KWARGS)]
+
+
+def test_seed_gives_the_same_answer_alone_and_batched():
+    model, tokenizer = load(0, do_sample=True)
+    alone = texts(model, tokenizer, [conversation("Tell me a story.", seed=1234)])[0]
+    assert texts(model, tokenizer, [conversation("Tell me a story.", seed=1234)])[0] == alone
+    batched = texts(model, tokenizer, [conversation("Hi", seed=7), conversation("Tell me a story.", seed=1234),
+                                       conversation("What is in the picture?")])
+    assert batched[1] == alone
+
+
+def test_seeds_of_a_batch_are_independent():
+    model, tokenizer = load(0, do_sample=True)
+    seeds = [1, 2, 3, 4]
+    batched = texts(model, tokenizer, [conversation("Tell me a story.", seed=seed) for seed in seeds])
+    # the same prompt with different seeds gives different answers
+    assert len(set(batched)) == len(seeds)
+    # each row is the answer of its seed alone, whatever the seeds of the other rows
+    assert batched == [texts(model, tokenizer, [conversation("Tell me a story.", seed=seed)])[0] for seed in seeds]
+    reseeded = texts(model, tokenizer, [conversation("Tell me a story.", seed=seed) for seed in [1, 20, 3, 40]])
+    assert reseeded[0] == batched[0] and reseeded[2] == batched[2]
+    assert reseeded[1] != batched[1] and reseeded[3] != batched[3]
+
+
+def test_interleaved_seeds_reproduce_whatever_the_global_seed():
+    model, tokenizer = load(0, do_sample=True)
+    alone = {seed: texts(model, tokenizer, [conversation("Tell me a story.", seed=seed)])[0] for seed in [1, 2, 3]}
+    unseeded = []
+    for seeds in [[1, 2, 3, None], [None, 3, 1, 2], [2, None, 1, 3], [3, 1, None, 2], [None, 2, 3, 1]]:
+        torch.manual_seed(0)  # a reset global seed must not replay the answers of unseeded requests
+        answers = texts(model, tokenizer, [conversation("Tell me a story.", seed=seed) for seed in seeds])
+        assert all(text == alone[seed] for seed, text in zip(seeds, answers) if seed is not None)
+        unseeded.extend(text for seed, text in zip(seeds, answers) if seed is None)
+    assert len(set(unseeded)) == len(unseeded)
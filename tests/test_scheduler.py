@@ -0,0 +1,121 @@
+"""The order of the queued jobs and the quotas of the API keys, see tools.scheduler."""
+
+import queue
+from types import SimpleNamespace
+
+import pytest
+
+import tools.scheduler
+from tools.scheduler import FairQueue, KeyQuotas, QuotaExceeded
+
+
+def job(name: str, api_key: str = "a", cost: int = 10, priority: str = "interactive") -> SimpleNamespace:
+    return SimpleNamespace(name=name, api_key=api_key, cost=cost, priority=priority, batch_key=None)
+
+
+def take_all(jobs: FairQueue) -> list:
+    return [jobs.get(timeout=0).name for _ in range(jobs.qsize())]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The time of the scheduler, which only moves when the test says so."""
+    clock = SimpleNamespace(now=1000.0)
+    clock.monotonic = lambda: clock.now
+    monkeypatch.setattr(tools.scheduler, "time", clock)
+    return clock
+
+
+def test_keys_share_the_queue_by_start_time():
+    jobs = FairQueue(maxsize=16)
+    for name in ["a1", "a2", "a3", "a4"]:
+        jobs.put_nowait(job(name, "a"))
+    # queued after all the jobs of a, b still gets every other turn
+    for name in ["b1", "b2"]:
+        jobs.put_nowait(job(name, "b"))
+    assert take_all(jobs) == ["a1", "b1", "a2", "b2", "a3", "a4"]
+
+
+def test_keys_share_the_queue_by_weight():
+    jobs = FairQueue(maxsize=16, weights={"heavy": 2})
+    for name in ["h1", "h2", "h3", "h4"]:
+        jobs.put_nowait(job(name, "heavy"))
+    for name in ["l1", "l2"]:
+        jobs.put_nowait(job(name, "light"))
+    assert take_all(jobs) == ["h1", "h2", "l1", "h3", "h4", "l2"]
+
+
+def test_idle_key_starts_at_the_virtual_time():
+    jobs = FairQueue(maxsize=16)
+    for name in ["a1", "a2", "a3"]:
+        jobs.put_nowait(job(name, "a"))
+    assert [jobs.get().name, jobs.get().name] == ["a1", "a2"]
+    # no credit for the time b was idle, it would otherwise go before a3
+    jobs.put_nowait(job("b1", "b", cost=25))
+    assert take_all(jobs) == ["a3", "b1"]
+
+
+def test_interactive_jobs_go_before_bulk_ones():
+    jobs = FairQueue(maxsize=16)
+    jobs.put_nowait(job("bulk", "a", priority="bulk"))
+    jobs.put_nowait(job("interactive", "b", cost=1000))
+    assert take_all(jobs) == ["interactive", "bulk"]
+
+
+def test_bulk_jobs_fill_their_share_of_the_queue(monkeypatch):
+    monkeypatch.setattr(tools.scheduler, "BULK_QUEUE_SHARE", 0.5)
+    jobs = FairQueue(maxsize=4)
+    for index in range(2):
+        jobs.put_nowait(job(f"bulk{index}", priority="bulk"))
+    with pytest.raises(queue.Full):
+        jobs.put_nowait(job("bulk2", priority="bulk"))
+    # the rest of the queue is kept for the interactive jobs
+    for index in range(2):
+        jobs.put_nowait(job(f"interactive{index}"))
+    with pytest.raises(queue.Full):
+        jobs.put_nowait(job("interactive2"))
+    assert jobs.qsize("bulk") == 2 and jobs.qsize("interactive") == 2
+
+
+def test_token_bucket_refills_at_the_token_rate(clock):
+    quotas = KeyQuotas(tokens_per_minute=600)
+    quotas.admit("a")
+    quotas.release("a", tokens=700)
+    with pytest.raises(QuotaExceeded) as exceeded:
+        quotas.admit("a")
+    # 100 tokens below zero, at 10 tokens per second
+    assert exceeded.value.retry_after == pytest.approx(10.1)
+    # the other keys have their own bucket
+    quotas.admit("b")
+
+    clock.now += 10
+    with pytest.raises(QuotaExceeded) as exceeded:
+        quotas.admit("a")
+    assert exceeded.value.retry_after == pytest.approx(0.1)
+    clock.now += 0.2
+    quotas.admit("a")
+
+
+def test_token_bucket_holds_a_minute_of_tokens(clock):
+    quotas = KeyQuotas(tokens_per_minute=600, weights={"heavy": 2})
+    quotas.admit("a")
+    quotas.admit("heavy")
+    # a bucket idle for an hour is only full
+    clock.now += 3600
+    quotas.release("a", tokens=600)
+    quotas.release("heavy", tokens=1199)
+    with pytest.raises(QuotaExceeded):
+        quotas.admit("a")
+    quotas.admit("heavy")
+
+
+def test_concurrency_quota_retries_after_the_given_time():
+    quotas = KeyQuotas(max_concurrency=2, weights={"heavy": 1.5})
+    for api_key, limit in [("a", 2), ("heavy", 3)]:
+        for _ in range(limit):
+            quotas.admit(api_key)
+        with pytest.raises(QuotaExceeded) as exceeded:
+            quotas.admit(api_key, retry_after=7)
+        assert exceeded.value.retry_after == 7
+        quotas.release(api_key)
+        quotas.admit(api_key)
@@ -0,0 +1,35 @@
+"""Streamed chunks leave out the unset fields, the last one has an empty delta, see tools.qwen_chat.stream_chat."""
+
+import asyncio
+import json
+
+from tools.executor import InferenceExecutor
+from tools.qwen_chat import chat, stream_chat
+from tests.tiny_model import load
+
+
+def test_stream_chunks_leave_out_unset_fields():
+    model, tokenizer = load(0)
+    history, system = [("hi", "hello")], "You are a helpful assistant."
+
+    async def main():
+        executor = InferenceExecutor(max_queue_size=8)
+        executor.start()
+        try:
+            frames = [frame async for frame in stream_chat(executor, model, tokenizer, "what is new", history, system,
+                                                           model_name="tiny", context={"dropped_turns": 0})]
+            return frames, await chat(executor, model, tokenizer, "what is new", history, system)
+        finally:
+            executor.shutdown()
+
+    frames, result = asyncio.run(main())
+    assert frames[-1] == b"data: [DONE]\n\n"
+    chunks = [json.loads(frame.decode()[len("data: "):]) for frame in frames[:-1]]
+    assert all("null" not in json.dumps(chunk) for chunk in chunks)
+    assert chunks[0]["choices"] == [{"index": 0, "delta": {"role": "assistant", "content": ""}}]
+    assert all(set(chunk["choices"][0]["delta"]) == {"content"} for chunk in chunks[1:-1])
+    assert "".join(chunk["choices"][0]["delta"]["content"] for chunk in chunks[1:-1]) == result.text
+    assert chunks[-1]["choices"] == [{"index": 0, "delta": {}, "finish_reason": result.finish_reason}]
+    assert chunks[-1]["usage"] == result.usage()
+    assert chunks[-1]["context"] == {"dropped_turns": 0}
+    assert all("usage" not in chunk and "context" not in chunk for chunk in chunks[:-1])
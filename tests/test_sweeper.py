@@ -0,0 +1,36 @@
+"""The sweeper runs every interval minutes, also for intervals cron can't express, see tools.sweeper."""
+
+import asyncio
+
+import tools.sweeper
+from tools.sweeper import start_sweeper
+
+
+def test_sweeper_runs_every_interval_and_survives_failures(monkeypatch):
+    sleeps, runs = [], []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+        await sleep(0)
+
+    async def sweep():
+        runs.append(len(runs))
+        if len(runs) == 1:
+            raise OSError("disk gone")
+
+    monkeypatch.setattr(tools.sweeper.asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(tools.sweeper, "sweep", sweep)
+
+    async def main():
+        assert start_sweeper(0) is None
+        task = start_sweeper(90)
+        while len(runs) < 3:
+            await sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled()
+
+    asyncio.run(main())
+    assert len(runs) >= 3
+    assert set(sleeps) == {90 * 60}
@@ -0,0 +1,79 @@
+"""A rejected or disconnected upload never leaves its temp file behind, see tools.upload.receive_upload."""
+
+import asyncio
+import hashlib
+
+from starlette.requests import ClientDisconnect, Request
+
+from tools.upload import UploadMalformed, UploadTooLarge, receive_upload
+
+BOUNDARY = "boundary"
+
+
+def form(content: bytes) -> bytes:
+    return (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"purpose\"\r\n\r\nassistants\r\n"
+            f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.bin\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + content + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+def upload(body: bytes, dest_path: str, chunk: int = 1024, disconnect_after: int = None,
+           content_length: str = None, max_bytes: int = None):
+    """
+    Receive the body sent in chunks, the client disconnects after disconnect_after chunks when set.
+
+    :returns: The result of receive_upload, or the exception it raised, and the number of chunks it read.
+    """
+    chunks = [body[start:start + chunk] for start in range(0, len(body), chunk)]
+    if disconnect_after is not None:
+        chunks = chunks[:disconnect_after]
+    sent = []
+
+    async def receive():
+        if len(sent) < len(chunks):
+            sent.append(chunks[len(sent)])
+            return {"type": "http.request", "body": sent[-1], "more_body": True}
+        if disconnect_after is not None:
+            return {"type": "http.disconnect"}
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    headers = [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())]
+    if content_length is not None:
+        headers.append((b"content-length", content_length.encode()))
+    request = Request({"type": "http", "method": "POST", "path": "/v1/files", "query_string": b"",
+                       "headers": headers}, receive)
+    try:
+        result = asyncio.run(receive_upload(request, dest_path, max_bytes=max_bytes, chunk_size=4096))
+    except Exception as e:
+        result = e
+    return result, len(sent)
+
+
+def test_upload_is_streamed_to_dest_path(tmp_path):
+    content = bytes(range(256)) * 100
+    (fields, file), _ = upload(form(content), str(tmp_path / "file"))
+    assert fields == {"purpose": "assistants"}
+    assert (file.filename, file.size, file.sha256) == ("a.bin", len(content), hashlib.sha256(content).hexdigest())
+    assert (tmp_path / "file").read_bytes() == content
+    assert [path.name for path in tmp_path.iterdir()] == ["file"]
+
+
+def test_malformed_content_length_is_rejected(tmp_path):
+    error, _ = upload(form(b"x"), str(tmp_path / "file"), content_length="12 bytes")
+    assert isinstance(error, UploadMalformed)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_too_large_file_is_rejected_mid_stream(tmp_path):
+    body = form(b"x" * 100_000)
+    # sent without a Content-Length, so only the streamed size can reject it
+    error, chunks = upload(body, str(tmp_path / "file"), max_bytes=10_000)
+    assert isinstance(error, UploadTooLarge)
+    # the rest of the body is not read
+    assert chunks < len(body) // 1024
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_disconnected_client_leaves_no_temp_file(tmp_path):
+    error, chunks = upload(form(b"x" * 100_000), str(tmp_path / "file"), disconnect_after=50)
+    assert isinstance(error, ClientDisconnect) and chunks == 50
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,30 @@
+"""Images are encoded once per content, whatever their path, see tools.visual_cache.VisualCache."""
+
+import os
+
+import torch
+
+from tools.visual_cache import VisualCache
+
+
+def test_same_content_is_encoded_once(tmp_path):
+    encoded = []
+
+    def encode(image_paths):
+        encoded.extend(image_paths)
+        return torch.stack([torch.full((2, 4), float(os.path.getsize(path))) for path in image_paths])
+
+    cached_encode = VisualCache().wrap(encode, device=torch.device("cpu"))
+    first, copy, other = tmp_path / "upload.png", tmp_path / "copy.png", tmp_path / "other.png"
+    first.write_bytes(b"cat" * 100)
+    copy.write_bytes(b"cat" * 100)
+    other.write_bytes(b"dog" * 200)
+
+    assert cached_encode([str(first), str(other)]).shape == (2, 2, 4)
+    assert cached_encode([str(copy), str(other), str(first)])[0, 0, 0] == 300
+    assert encoded == [str(first), str(other)]
+    # a new version of the file is a new image
+    first.write_bytes(b"bird" * 100)
+    os.utime(first, (1, 1))
+    assert cached_encode([str(first)])[0, 0, 0] == 400
+    assert encoded == [str(first), str(other), str(first)]
@@ -0,0 +1,149 @@
+"""
+A tiny random GPT-2 standing in for Qwen-VL on CPU, with the make_context and get_stop_words_ids of its remote code.
+
+tools.qwen_generate looks these up in the module of the model class, which is this one.
+"""
+
+import re
+import threading
+import zlib
+from typing import List, Optional, Tuple
+
+import torch
+from transformers import GenerationConfig, GPT2Config, GPT2LMHeadModel
+
+from tools.prefix_cache import PrefixCache
+from tools.qwen_generate import generate_batch
+
+EOS, IM_START, IM_END = 0, 1, 2
+_FIRST_CHAR = 3  # the tokens of the characters come after the special tokens
+_CHARS = 95
+# as in Qwen-VL, an image is its start token, the url bytes padded with the token after the end token, and its end token
+IMAGE_START = 128
+IMAGE_SPAN = 16  # the url and padding tokens of an image
+_IMAGE = re.compile(r"<img>(.*?)</img>")
+
+
+class CharTokenizer:
+    """One token per printable ascii character."""
+
+    eod_id, im_start_id, im_end_id = EOS, IM_START, IM_END
+
+    def encode(self, text: str, **kwargs) -> List[int]:
+        token_ids = []
+        for index, part in enumerate(_IMAGE.split(text)):
+            if index % 2:
+                url = list(part.encode())
+                token_ids += [IMAGE_START, *url, *[IMAGE_START + 2] * (IMAGE_SPAN - len(url)), IMAGE_START + 1]
+            else:
+                token_ids += [_FIRST_CHAR + (ord(char) - 32) % _CHARS for char in part]
+        return token_ids
+
+    def decode(self, token_ids, **kwargs) -> str:
+        if hasattr(token_ids, "tolist"):
+            token_ids = token_ids.tolist()
+        return "".join(chr(32 + token_id - _FIRST_CHAR) for token_id in token_ids if token_id >= _FIRST_CHAR)
+
+
+def make_context(tokenizer: CharTokenizer, query: str, history: Optional[List[Tuple[str, str]]] = None,
+                 system: str = "", max_window_size: int = 6144, chat_format: str = "chatml") -> Tuple[str, List[int]]:
+    turns = [("system", system), *[turn for prompt, response in history or []
+                                   for turn in [("user", prompt), ("assistant", response)]], ("user", query)]
+    tokens = [token for role, content in turns
+              for token in [IM_START, *tokenizer.encode(f"{role}\n{content}"), IM_END]]
+    return "", tokens + [IM_START, *tokenizer.encode("assistant\n")]
+
+
+def get_stop_words_ids(chat_format: str, tokenizer: CharTokenizer) -> List[List[int]]:
+    return [[IM_END], [IM_START]]
+
+
+class TinyQwen(GPT2LMHeadModel):
+    vocab_size = _FIRST_CHAR + _CHARS
+    n_positions = 512
+
+    def generate(self, inputs=None, stop_words_ids=None, **kwargs):
+        # the stop words are processed by the Qwen-VL generate, the stop tokens end the answers here
+        return super().generate(inputs, **kwargs)
+
+
+class TinyQwenLayout(TinyQwen):
+    """The past key values as [batch, seq, heads, dim] like Qwen, instead of [batch, heads, seq, dim]."""
+
+    def forward(self, input_ids=None, past_key_values=None, attention_mask=None, **kwargs):
+        if past_key_values is not None:
+            past_key_values = tuple(tuple(tensor.transpose(1, 2) for tensor in layer) for layer in past_key_values)
+        outputs = super().forward(input_ids=input_ids, past_key_values=past_key_values,
+                                  attention_mask=attention_mask, **kwargs)
+        if outputs.past_key_values is not None:
+            outputs.past_key_values = tuple(tuple(tensor.transpose(1, 2) for tensor in layer)
+                                            for layer in outputs.past_key_values)
+        return outputs
+
+
+class TinyVisual:
+    """A vision tower, each image is encoded into fixed random embeddings of its url."""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.encoded: List[str] = []
+
+    def encode(self, image_paths: List[str]) -> torch.Tensor:
+        self.encoded.extend(image_paths)
+        return torch.stack([torch.randn(IMAGE_SPAN, self.dim, generator=torch.Generator().manual_seed(zlib.crc32(
+            path.encode()))) for path in image_paths])
+
+
+class TinyQwenVL(TinyQwenLayout):
+    """Puts the embeddings of the images in the forward without past key values only, like Qwen-VL."""
+
+    vocab_size = IMAGE_START + 3
+    n_positions = 1024  # room for the image tokens of long conversations
+
+    def __init__(self, config: GPT2Config):
+        super().__init__(config)
+        self.config.visual = {"image_start_id": IMAGE_START}
+        self.transformer.visual = TinyVisual(config.n_embd)
+
+    def forward(self, input_ids=None, past_key_values=None, attention_mask=None, inputs_embeds=None, **kwargs):
+        if past_key_values is None and input_ids is not None and (input_ids == IMAGE_START).any():
+            inputs_embeds = self.transformer.wte(input_ids)
+            for row, start in (input_ids == IMAGE_START).nonzero().tolist():
+                url = input_ids[row, start + 1:start + IMAGE_SPAN + 1].tolist()
+                image_path = bytes(url[:url.index(IMAGE_START + 2)]).decode()
+                inputs_embeds[row, start + 1:start + IMAGE_SPAN + 1] = self.transformer.visual.encode([image_path])[0]
+            input_ids = None
+        return super().forward(input_ids=input_ids, past_key_values=past_key_values, attention_mask=attention_mask,
+                               inputs_embeds=inputs_embeds, **kwargs)
+
+
+def load(seed: int = 0, model_class: type = TinyQwen, do_sample: bool = False,
+         repetition_penalty: float = 1.0) -> Tuple[TinyQwen, CharTokenizer]:
+    """A random model, the same for the same seed, whose answers run to max_new_tokens."""
+    torch.manual_seed(seed)
+    model = model_class(GPT2Config(n_layer=2, n_embd=32, n_head=2, vocab_size=model_class.vocab_size,
+                                   n_positions=model_class.n_positions))
+    with torch.no_grad():
+        # the scores of the other tokens are 0, below the best character of almost every step
+        model.transformer.wte.weight[:_FIRST_CHAR] = 0
+        model.transformer.wte.weight[_FIRST_CHAR + _CHARS:] = 0
+    model.generation_config = GenerationConfig(eos_token_id=EOS, pad_token_id=EOS, max_new_tokens=24,
+                                               do_sample=do_sample, repetition_penalty=repetition_penalty)
+    model.generation_config.chat_format = "chatml"
+    model.generation_config.max_window_size = 6144
+    return model.eval(), CharTokenizer()
+
+
+def conversation(query: str, **kwargs) -> dict:
+    """The keyword arguments of a conversation of generate_batch."""
+    return dict(dict(query=query, history=[("hi", "hello")], system="You are a helpful assistant.",
+                     cancel_event=threading.Event()), **kwargs)
+
+
+def answer(model: TinyQwen, tokenizer: CharTokenizer, conversations: List[dict],
+           prefix_cache: Optional[PrefixCache] = None, draft: Optional[TinyQwen] = None,
+           generation_kwargs: Optional[dict] = None) -> List[Tuple[str, str, int]]:
+    """The text, finish reason and completion tokens of the answers to the conversations, generated as one batch."""
+    return [(result.text, result.finish_reason, result.completion_tokens)
+            for result in generate_batch(model, tokenizer, prefix_cache, draft, generation_kwargs or {},
+                                         conversations)]
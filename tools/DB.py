@@ -1,9 +1,18 @@
-from sqlalchemy import Column, String, DateTime, create_engine, Integer
+from typing import Optional
+
+from sqlalchemy import Column, String, DateTime, create_engine, Integer, event, inspect, text
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import declarative_base, Session
 from sqlalchemy.orm import sessionmaker
 
-DATABASE_PATH = "./file_records.db"
+# any SQLAlchemy url, replicas share the file records through a database server, e.g. postgresql://...
+DATABASE_URL = "sqlite:///./file_records.db"
+DATABASE_POOL_SIZE = 8
+DATABASE_BUSY_TIMEOUT = 5000  # ms, how long a connection waits for the write lock
+
 Base = declarative_base()
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+_engine: Optional[Engine] = None
 
 
 class FileRecord(Base):
@@ -16,16 +25,89 @@ class FileRecord(Base):
     created_at = Column(Integer, index=True)
     content_type = Column(String, index=True)
     expiration = Column(DateTime, index=True)
+    sha256 = Column(String, index=True)
+
+
+class BatchRecord(Base):
+    __tablename__ = "batch_records"
+
+    id = Column(String, primary_key=True, index=True)
+    status = Column(String, index=True)
+    endpoint = Column(String)
+    input_file_id = Column(String, index=True)
+    output_file_id = Column(String)
+    completion_window = Column(String)
+    created_at = Column(Integer, index=True)
+    in_progress_at = Column(Integer)
+    finalizing_at = Column(Integer)
+    completed_at = Column(Integer)
+    failed_at = Column(Integer)
+    expired_at = Column(Integer)
+    cancelled_at = Column(Integer)
+    expires_at = Column(Integer)
+    total = Column(Integer, default=0)
+    completed = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    errors = Column(String)  # json, why the batch has failed
+    batch_metadata = Column("metadata", String)  # json
+    owner = Column(String)  # the front end running the batch, see routers.batches.BATCH_OWNER
+    heartbeat_at = Column(Integer)  # the last time its owner said it was running it
+
+
+def _migrate(engine: Engine):
+    """Add the columns introduced after the tables were created, create_all leaves existing tables as they are."""
+    added = {FileRecord.__tablename__: {"sha256": "VARCHAR"},
+             BatchRecord.__tablename__: {"owner": "VARCHAR", "heartbeat_at": "INTEGER"}}
+    for table, new_columns in added.items():
+        columns = {column["name"] for column in inspect(engine).get_columns(table)}
+        with engine.begin() as connection:
+            for name, column_type in new_columns.items():
+                if name not in columns:
+                    connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}"))
+
+
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    """WAL lets readers run while a request is writing, busy_timeout makes writers wait instead of failing."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={DATABASE_BUSY_TIMEOUT}")
+    cursor.close()
+
+
+def init_db() -> Engine:
+    """
+    Create the engine, its connection pool and the tables once, at startup.
+    :returns: The shared engine.
+    """
+    global _engine
+    if _engine is None:
+        sqlite = DATABASE_URL.startswith("sqlite")
+        connect_args = {"check_same_thread": False, "timeout": DATABASE_BUSY_TIMEOUT / 1000} if sqlite else {}
+        _engine = create_engine(DATABASE_URL, pool_size=DATABASE_POOL_SIZE, max_overflow=DATABASE_POOL_SIZE,
+                                pool_pre_ping=True, connect_args=connect_args)
+        if sqlite:
+            event.listen(_engine, "connect", _set_sqlite_pragma)
+        Base.metadata.create_all(bind=_engine)
+        _migrate(_engine)
+        SessionLocal.configure(bind=_engine)
+    return _engine
+
+
+def dispose_db():
+    """Close the pooled connections."""
+    global _engine
+    if _engine is not None:
+        _engine.dispose()
+        _engine = None
 
 
 def get_db() -> Session:
     """
     Get the session for the database.
-    :returns: A new SQLAlchemy session.
+    :returns: A new SQLAlchemy session from the shared connection pool.
     """
-    engine = create_engine(f"sqlite:///{DATABASE_PATH}", connect_args={"check_same_thread": False})
-    Base.metadata.create_all(bind=engine)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    init_db()
     db = SessionLocal()
     try:
         yield db
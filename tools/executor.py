@@ -0,0 +1,229 @@
+import asyncio
+import contextvars
+import logging
+import math
+import queue
+import threading
+import time
+from typing import Any, Callable, Optional, Hashable, List, Mapping, Set
+
+from tools.logging_utils import record_stage
+from tools.metrics import STAGE_SECONDS, Gauge
+from tools.scheduler import PRIORITIES, QUEUE_SIZE as CLASS_QUEUE_SIZE, REJECTED, WAIT_SECONDS, FairQueue, \
+    KeyQuotas, Priority
+
+QUEUE_SIZE = Gauge("qwen_inference_queue_size", "Jobs waiting for the inference worker.")
+
+
+class InferenceQueueFull(Exception):
+    def __init__(self, max_queue_size: int = None, retry_after: float = 1):
+        self.max_queue_size = max_queue_size
+        self.retry_after = retry_after
+
+
+class InferenceTimeout(Exception):
+    def __init__(self, timeout: float = None):
+        self.timeout = timeout
+
+
+class _Job:
+    """A blocking call waiting for the inference worker."""
+
+    def __init__(self, fn: Callable, args: tuple, kwargs: dict, loop: asyncio.AbstractEventLoop,
+                 cancel_event: threading.Event, batch_key: Optional[Hashable] = None,
+                 priority: Priority = "interactive", api_key: str = "", cost: int = 1):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.loop = loop
+        self.future = loop.create_future()
+        self.cancel_event = cancel_event
+        self.batch_key = batch_key
+        self.priority = priority
+        self.api_key = api_key
+        self.cost = cost
+        self.enqueued_at: float = time.perf_counter()
+        # the request id and stages of the caller, for the log
+        self.context = contextvars.copy_context()
+
+
+def _set_result(future: asyncio.Future, result: Any):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exc: BaseException):
+    if not future.done():
+        future.set_exception(exc)
+
+
+class InferenceExecutor:
+    """
+    Run blocking model calls on a dedicated worker thread behind a bounded queue,
+    so the event loop keeps serving other routes while a generation is running.
+
+    Jobs queued with the same ``batch_key`` are gathered for up to ``batch_wait`` seconds
+    and run together as ``fn(*args, [kwargs, ...])``, which must return one result per job.
+
+    The jobs are taken in the order of tools.scheduler.FairQueue, and admitted within the quotas of their API key.
+    Results with a ``total_tokens`` attribute count against the token rate of the key.
+    """
+
+    def __init__(self, max_queue_size: int = 8, timeout: Optional[float] = None, max_batch_size: int = 1,
+                 batch_wait: float = 0, quotas: Optional[KeyQuotas] = None,
+                 weights: Optional[Mapping[str, float]] = None):
+        """
+        :param max_queue_size: The number of jobs allowed to wait for the worker, extra jobs are rejected.
+        :param timeout: The default per-request timeout in seconds (queue wait included), None to wait forever.
+        :param max_batch_size: The max number of jobs run together, 1 to disable batching.
+        :param batch_wait: How long in seconds the first job of a batch waits for others,
+            larger values trade latency for throughput, 0 only batches the jobs already queued.
+        :param quotas: The quotas of the API keys, None for no limit.
+        :param weights: API key -> weight of its share of the worker, 1 for the others.
+        """
+        self.max_queue_size = max_queue_size
+        self.timeout = timeout
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.quotas = quotas or KeyQuotas()
+        self._queue = FairQueue(maxsize=max_queue_size, weights=weights)
+        self._thread: Optional[threading.Thread] = None
+        self._active: Set[_Job] = set()  # queued or running, only used from the event loop
+        self._batch_seconds: float = 1.0  # moving average of the run time of a batch, for Retry-After
+        QUEUE_SIZE.set_function(self._queue.qsize)
+        for priority in PRIORITIES:
+            CLASS_QUEUE_SIZE.set_function(lambda priority=priority: self._queue.qsize(priority), priority=priority)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, name="inference-worker", daemon=True)
+            self._thread.start()
+
+    def shutdown(self):
+        if self._thread is not None:
+            self._queue.close()
+            self._thread.join()
+            self._thread = None
+
+    def retry_after(self) -> int:
+        """Seconds until the queued jobs are likely to have run."""
+        batches = math.ceil((self._queue.qsize() + 1) / max(self.max_batch_size, 1))
+        return max(math.ceil(batches * self._batch_seconds), 1)
+
+    def _next_batch(self) -> List[Optional[_Job]]:
+        """Take the next job, and the jobs which can run together with it, the others stay in their place."""
+        first = self._queue.get()
+        if first is None or first.batch_key is None or self.max_batch_size <= 1:
+            return [first]
+
+        batch = [first]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                job = self._queue.take(first.batch_key, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if job is None:
+                break
+            batch.append(job)
+        return batch
+
+    def _finish(self, job: _Job, result: Any = None):
+        self.quotas.release(job.api_key, tokens=getattr(result, "total_tokens", 0))
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            if batch[0] is None:
+                break
+            # the caller has gone away while the job was queued
+            for job in batch:
+                if job.cancel_event.is_set():
+                    self._finish(job)
+                    job.loop.call_soon_threadsafe(job.future.cancel)
+            batch = [job for job in batch if not job.cancel_event.is_set()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            for job in batch:
+                job.context.run(STAGE_SECONDS.observe, started - job.enqueued_at, stage="queue")
+                WAIT_SECONDS.observe(started - job.enqueued_at, priority=job.priority)
+            first = batch[0]
+            try:
+                if first.batch_key is None:
+                    results = [first.fn(*first.args, cancel_event=first.cancel_event, **first.kwargs)]
+                else:
+                    results = first.fn(*first.args, [dict(job.kwargs, cancel_event=job.cancel_event)
+                                                     for job in batch])
+                    logging.debug("Run batch, size: %d", len(batch))
+            except BaseException as e:
+                for job in batch:
+                    self._finish(job)
+                    job.loop.call_soon_threadsafe(_set_exception, job.future, e)
+            else:
+                seconds = time.perf_counter() - started
+                self._batch_seconds = 0.8 * self._batch_seconds + 0.2 * seconds
+                for job, result in zip(batch, results):
+                    self._finish(job, result)
+                    job.context.run(record_stage, "generate", seconds)
+                    job.loop.call_soon_threadsafe(_set_result, job.future, result)
+
+    def enqueue(self, fn: Callable, *args, batch_key: Optional[Hashable] = None,
+                cancel_event: Optional[threading.Event] = None, priority: Priority = "interactive",
+                api_key: str = "", cost: int = 1, **kwargs) -> _Job:
+        """
+        Queue ``fn(*args, **kwargs)`` for the worker thread without waiting, must be called from the event loop.
+
+        :param batch_key: Jobs with the same key share ``fn`` and ``args`` and may be run in one call,
+            None to run alone.
+        :param cancel_event: Passed to ``fn`` as ``cancel_event`` and set when the request times out or is cancelled,
+            ``fn`` should poll it to stop early.
+        :param priority: Interactive jobs run before bulk ones.
+        :param api_key: The client, the keys share the worker in proportion to their weights.
+        :param cost: The work of the job compared to the others, e.g. its max tokens.
+        :raises InferenceQueueFull: The queue is full.
+        :raises QuotaExceeded: The API key is over its quotas.
+        """
+        self.quotas.admit(api_key, priority=priority, retry_after=self.retry_after())
+        job = _Job(fn, args, kwargs, asyncio.get_running_loop(), cancel_event or threading.Event(), batch_key,
+                   priority=priority, api_key=api_key, cost=cost)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self.quotas.release(api_key)
+            REJECTED.inc(priority=priority, reason="queue_full")
+            logging.warning(f"Inference queue is full, max_queue_size: {self.max_queue_size}, priority: {priority}")
+            raise InferenceQueueFull(max_queue_size=self.max_queue_size, retry_after=self.retry_after())
+        self._active.add(job)
+        job.future.add_done_callback(lambda _: self._active.discard(job))
+        return job
+
+    async def drain(self, match: Callable[[_Job], bool]):
+        """Wait until the queued and running jobs which ``match`` are done, e.g. the generations of a model."""
+        futures = [job.future for job in self._active if match(job)]
+        if futures:
+            await asyncio.wait(futures)
+
+    async def wait(self, job: _Job, timeout: Optional[float] = None) -> Any:
+        """
+        Wait for the result of a queued job.
+
+        :param timeout: Override the default per-request timeout.
+        :raises InferenceTimeout: The result is not ready in time.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(asyncio.shield(job.future), timeout)
+        except asyncio.TimeoutError:
+            job.cancel_event.set()
+            raise InferenceTimeout(timeout=timeout)
+        except asyncio.CancelledError:
+            job.cancel_event.set()
+            raise
+
+    async def submit(self, fn: Callable, *args, batch_key: Optional[Hashable] = None,
+                     cancel_event: Optional[threading.Event] = None, timeout: Optional[float] = None, **kwargs) -> Any:
+        """Queue ``fn(*args, **kwargs)`` for the worker thread and wait for the result, see enqueue and wait."""
+        job = self.enqueue(fn, *args, batch_key=batch_key, cancel_event=cancel_event, **kwargs)
+        return await self.wait(job, timeout=timeout)
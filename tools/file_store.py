@@ -0,0 +1,89 @@
+"""Where the uploaded files are kept, the records of the files are in the database, see tools.DB."""
+
+import os
+from abc import ABC, abstractmethod
+from typing import List, Optional
+from urllib.parse import urlparse
+
+
+class FileStore(ABC):
+    """
+    Storage of the uploaded files, shared by the replicas.
+
+    An upload is written to ``upload_path`` and handed over with ``commit``,
+    readers get a local path of the file with ``path``.
+    """
+
+    @abstractmethod
+    def upload_path(self, file_id: str) -> str:
+        """The local path the upload of the file is written to."""
+
+    @abstractmethod
+    def commit(self, file_id: str):
+        """Make the file written to ``upload_path`` available to every replica."""
+
+    @abstractmethod
+    def path(self, file_id: str) -> str:
+        """A local path to read the file from."""
+
+    @abstractmethod
+    def exists(self, file_id: str) -> bool:
+        """Whether the file is committed."""
+
+    @abstractmethod
+    def remove(self, file_id: str) -> Optional[int]:
+        """Remove the file, return the bytes reclaimed, None if it is already gone."""
+
+    @abstractmethod
+    def stale(self, deadline: float) -> List[str]:
+        """The files and leftover uploads not modified since ``deadline``, a unix timestamp."""
+
+
+class LocalFileStore(FileStore):
+    """A directory, replicas on other machines share it through a network mount."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def upload_path(self, file_id: str) -> str:
+        os.makedirs(self.root, exist_ok=True)
+        return self.path(file_id)
+
+    def commit(self, file_id: str):
+        # the upload is renamed into place once complete, nothing left to do
+        pass
+
+    def path(self, file_id: str) -> str:
+        return os.path.join(self.root, file_id)
+
+    def exists(self, file_id: str) -> bool:
+        return os.path.exists(self.path(file_id))
+
+    def remove(self, file_id: str) -> Optional[int]:
+        try:
+            size = os.path.getsize(self.path(file_id))
+            os.remove(self.path(file_id))
+            return size
+        except FileNotFoundError:
+            return None
+
+    def stale(self, deadline: float) -> List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return [entry.name for entry in os.scandir(self.root)
+                if (entry.name.startswith("file-") or entry.name.endswith(".tmp"))
+                and entry.is_file() and entry.stat().st_mtime < deadline]
+
+
+def create_file_store(url: str) -> FileStore:
+    """
+    Create the file store from its url.
+
+    :param url: A directory, or ``file://`` followed by a directory.
+    """
+    if "://" not in url:
+        return LocalFileStore(url)
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        return LocalFileStore(parsed.netloc + parsed.path)
+    raise ValueError(f"Unsupported file store: {url}")
@@ -0,0 +1,168 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, List
+from uuid import uuid4
+
+# the saved images are named after the sha256 of their content, see ImageCache.put
+_CONTENT_ADDRESSED = re.compile(r"^image_(?P<digest>[0-9a-f]{32})\.")
+# the digests of the other images, e.g. the uploaded files, by path, mtime and size
+_DIGESTS: Dict[Tuple[str, float, int], str] = {}
+_MAX_DIGESTS = 4096
+
+
+def image_digest(path: str) -> str:
+    """The sha256 of the image file, read from the name of the cached images, else hashed once per file version."""
+    match = _CONTENT_ADDRESSED.match(os.path.basename(path))
+    if match:
+        return match.group("digest")
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    if key not in _DIGESTS:
+        if len(_DIGESTS) >= _MAX_DIGESTS:
+            _DIGESTS.clear()
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        _DIGESTS[key] = sha256.hexdigest()[:32]
+    return _DIGESTS[key]
+
+
+class ImageCache:
+    """
+    Content addressed image files, the same image is saved once however many times and from whichever url it is sent.
+
+    Urls are mapped to files by their hash, so a repeated url is neither downloaded nor decoded again.
+    Files are evicted in LRU order once the cache is over ``max_bytes`` or unused for ``max_age`` seconds.
+    """
+
+    # files used this recently are kept even over budget, a queued request may still have to read them
+    EVICT_GRACE = 60
+
+    def __init__(self, cache_dir: str, max_bytes: int = 1 << 30, max_age: float = 6 * 3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self._files: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()  # path -> (bytes, last used), LRU first
+        self._urls: Dict[str, str] = {}  # url hash -> path
+        self._bytes: int = 0
+        self._lock = threading.Lock()
+        self._loaded: bool = False
+
+    @staticmethod
+    def _hash(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def _load(self):
+        """Pick up the images saved by a previous run."""
+        self._loaded = True
+        if not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith("image_") and not entry.name.endswith(".tmp") and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        for mtime, path, size in sorted(entries):
+            self._files[path] = (size, mtime)
+            self._bytes += size
+
+    def _touch(self, path: str):
+        self._files[path] = (self._files[path][0], time.time())
+        self._files.move_to_end(path)
+
+    def get(self, url: str) -> Optional[str]:
+        """Return the saved image of the url, None if it is not cached."""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            path = self._urls.get(self._hash(url.encode()))
+            if path is not None and path in self._files and os.path.exists(path):
+                self.hits += 1
+                self._touch(path)
+                return path
+            self.misses += 1
+            return None
+
+    def put(self, data: bytes, extension: str, url: Optional[str] = None) -> str:
+        """Save the image, or reuse the file of the same content, and return its path."""
+        path = os.path.join(self.cache_dir, f"image_{self._hash(data)[:32]}.{extension}")
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if path not in self._files or not os.path.exists(path):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = f"{path}.{uuid4().hex[:8]}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self._bytes += len(data) - self._files.get(path, (0, 0))[0]
+                self._files[path] = (len(data), time.time())
+            self._touch(path)
+            if url is not None:
+                self._urls[self._hash(url.encode())] = path
+        self.evict()
+        return path
+
+    def lookup(self, path: str) -> bool:
+        """Whether the file is cached, e.g. a preprocessed image, and mark it as used."""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if path in self._files and os.path.exists(path):
+                self._touch(path)
+                return True
+            return False
+
+    def add(self, path: str):
+        """Account for a file written to the cache directory by someone else, e.g. a preprocessed image."""
+        size = os.path.getsize(path)
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            self._bytes += size - self._files.get(path, (0, 0))[0]
+            self._files[path] = (size, time.time())
+            self._touch(path)
+        self.evict()
+
+    def evict(self) -> List[str]:
+        """Remove the least recently used images over the size budget or older than max_age, return their paths."""
+        now = time.time()
+        removed = []
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            for path, (size, last_used) in list(self._files.items()):
+                if last_used > now - self.EVICT_GRACE:
+                    break
+                if self._bytes <= self.max_bytes and last_used > now - self.max_age:
+                    break
+                del self._files[path]
+                self._bytes -= size
+                removed.append(path)
+            if removed:
+                removed_paths = set(removed)
+                self._urls = {key: path for key, path in self._urls.items() if path not in removed_paths}
+                self.evictions += len(removed)
+
+        for path in removed:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if removed:
+            logging.debug(f"Evict {len(removed)} cached images, cache size: {self._bytes} bytes")
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "files": len(self._files), "bytes": self._bytes}
@@ -0,0 +1,110 @@
+"""
+Decode, rotate and downsize the images to the model resolution in a process pool, while they are downloaded.
+
+The inference thread then only reads small files, which the Qwen-VL resize leaves as they are.
+The images sent inline as data: urls are preprocessed from memory, only the small image is written.
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Union
+from uuid import uuid4
+
+from PIL import Image, ImageOps
+
+from tools.image_cache import ImageCache, image_digest
+from tools.metrics import STAGE_SECONDS
+from tools.openai_types import ChatImageNotAvailable
+
+IMAGE_SIZE: int = 448  # the input resolution of the Qwen-VL vision tower, 0 to pass the images on as they are sent
+IMAGE_WORKERS: int = 2  # processes decoding the images, 0 to decode them in the threadpool
+_POOL: Optional[ProcessPoolExecutor] = None
+
+
+def normalize_image(source: Union[str, bytes], destination: str, size: int):
+    """
+    Save the image as a ``size`` x ``size`` RGB png, upright according to its EXIF orientation.
+
+    JPEGs are decoded at the smallest scale still larger than ``size``, the resize is the bicubic one of Qwen-VL.
+
+    :param source: The path of the image, or its content.
+    """
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as image:
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image).convert("RGB").resize((size, size), Image.BICUBIC)
+    tmp_path = f"{destination}.{uuid4().hex[:8]}.tmp"
+    image.save(tmp_path, format="PNG")
+    os.replace(tmp_path, destination)
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        # spawned, the server process has threads which should not be forked
+        _POOL = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _POOL
+
+
+def shutdown_pool():
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown(cancel_futures=True)
+        _POOL = None
+
+
+async def preprocess_image(path: str, url: str, cache: ImageCache) -> str:
+    """
+    The preprocessed image, made once per image content and kept in the image cache.
+
+    :param path: The downloaded or uploaded image.
+    :param url: The url of the image, for the error message.
+    :raises ChatImageNotAvailable: The file is not an image.
+    """
+    if IMAGE_SIZE <= 0:
+        return path
+    return await _preprocess(path, await asyncio.to_thread(image_digest, path), url, cache)
+
+
+async def preprocess_image_data(data: bytes, digest: str, extension: str, url: str, cache: ImageCache) -> str:
+    """
+    The preprocessed image of an image content, see preprocess_image, the content itself is only saved
+    when the images are passed on as they are sent.
+
+    :param digest: The sha256 of the content, as in the names of the image cache.
+    :param extension: The extension of the file, if the content is saved.
+    """
+    if IMAGE_SIZE <= 0:
+        return await asyncio.to_thread(cache.put, data, extension)
+    return await _preprocess(data, digest, url, cache)
+
+
+async def _preprocess(source: Union[str, bytes], digest: str, url: str, cache: ImageCache) -> str:
+    name = hashlib.sha256(f"{digest}:{IMAGE_SIZE}".encode()).hexdigest()[:32]
+    destination = os.path.join(cache.cache_dir, f"image_{name}.png")
+    if cache.lookup(destination):
+        return destination
+
+    os.makedirs(cache.cache_dir, exist_ok=True)
+    try:
+        with STAGE_SECONDS.time(stage="preprocess"):
+            if IMAGE_WORKERS > 0:
+                await asyncio.get_running_loop().run_in_executor(_get_pool(), normalize_image, source, destination,
+                                                                 IMAGE_SIZE)
+            else:
+                await asyncio.to_thread(normalize_image, source, destination, IMAGE_SIZE)
+    except BrokenProcessPool:
+        # a worker has died, e.g. out of memory, the next image gets a new pool
+        shutdown_pool()
+        raise
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+        # PIL raises these for truncated or unsupported files
+        logging.info(f"Preprocess image failed, url: {url[:64]}, error: {e!r}")
+        raise ChatImageNotAvailable(url=url, reason="not a valid image")
+    await asyncio.to_thread(cache.add, destination)
+    return destination
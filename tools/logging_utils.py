@@ -1,6 +1,26 @@
+import atexit
+import copy
 import ctypes
+import json
 import logging
 import os
+import queue
+import re
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, Union
+from uuid import uuid4
+
+from starlette.datastructures import Headers, MutableHeaders
+
+# the request being answered, and the seconds of its stages, see RequestContextMiddleware
+REQUEST_ID: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+REQUEST_STAGES: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_stages", default=None)
+LOG_MAX_CHARS: int = 4096  # longer messages are truncated, after the base64 payloads are redacted
+_BASE64 = re.compile(r"(;base64,)[A-Za-z0-9+/=]{128,}")
+_REQUEST_ID = re.compile(r"^[\w.:-]{1,64}$")
+_LISTENER: Optional[QueueListener] = None
 
 
 # Windows CMD颜色
@@ -41,20 +61,116 @@ class ColorHandler(logging.StreamHandler):
             self.stream.write(f"{color}{message}\033[0m\n")
 
 
-def log_set(log_level=logging.INFO, log_save: bool = False, save_path: str = "log.log"):
+def redact(message: str) -> str:
+    """Replace the base64 payloads, e.g. of the data: image urls, by their length, and truncate long messages."""
+    message = _BASE64.sub(lambda match: f"{match.group(1)}<{len(match.group(0)) - 8} chars>", message)
+    if len(message) > LOG_MAX_CHARS:
+        message = f"{message[:LOG_MAX_CHARS]}... <{len(message) - LOG_MAX_CHARS} more chars>"
+    return message
+
+
+def record_stage(stage: str, seconds: float):
+    """Add the seconds of a stage to the log line of the current request, if any."""
+    stages = REQUEST_STAGES.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0) + seconds
+
+
+class _ContextQueueHandler(QueueHandler):
+    """Hand the records to the listener thread, which formats and writes them, so the callers never block on IO."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the message is made here, the caller may change the objects of its arguments once it returns,
+        # it is redacted by the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.request_id = REQUEST_ID.get()
+        return record
+
+
+class _RedactingListener(QueueListener):
+    """Redact the messages on the listener thread, the regex over a long message is not run by the caller."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = redact(record.msg)
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the request id and the fields given as ``extra``."""
+
+    FIELDS = ("method", "path", "status", "duration_ms", "stages")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                "message": record.getMessage()}
+        if getattr(record, "request_id", None) is not None:
+            line["request_id"] = record.request_id
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                line[field] = getattr(record, field)
+        if record.exc_text:
+            line["exception"] = record.exc_text
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+    def formatTime(self, record: logging.LogRecord, datefmt: Optional[str] = None) -> str:
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}"
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        record.request_id_text = f" [{record.request_id}]" if getattr(record, "request_id", None) else ""
+        text = super().format(record)
+        if hasattr(record, "duration_ms"):
+            text += f" {record.duration_ms} ms, stages: {record.stages}"
+        return text
+
+
+def log_stop():
+    """Write the queued records and stop the listener thread."""
+    global _LISTENER
+    if _LISTENER is not None:
+        _LISTENER.stop()
+        _LISTENER = None
+
+
+def log_set(log_level: Union[int, str] = logging.INFO, log_save: bool = False, save_path: str = "log.log",
+            log_format: str = "text"):
+    """
+    Log to the console, and to ``save_path``, through a queue and a listener thread.
+
+    :param log_level: DEBUG logs every request and answer, with the base64 payloads redacted.
+    :param log_format: text, colored on the console, or json, one object per line.
+    """
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+    # records below the level are dropped before their message is formatted
+    logger.setLevel(log_level)
 
     # Remove all handlers
+    log_stop()
     for handler in logger.handlers[:]:
         logger.removeHandler(handler)
+    # the uvicorn loggers go through the queue too, instead of writing from the event loop,
+    # but for the access log, which is replaced by RequestContextMiddleware
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logging.getLogger(name).handlers.clear()
+        logging.getLogger(name).propagate = name != "uvicorn.access"
 
     # console
-    handler = ColorHandler()
+    if log_format == "json":
+        handler = logging.StreamHandler()
+        formatter = JsonFormatter()
+    else:
+        handler = ColorHandler()
+        formatter = _TextFormatter("%(asctime)s - %(name)s - %(levelname)s%(request_id_text)s - %(message)s",
+                                   datefmt='%Y-%m-%d %H:%M:%S')
     handler.setLevel(log_level)
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s", datefmt='%Y-%m-%d %H:%M:%S')
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    handlers = [handler]
 
     # file
     if log_save:
@@ -62,7 +178,56 @@ def log_set(log_level=logging.INFO, log_save: bool = False, save_path: str = "lo
         file_header = logging.FileHandler(save_path, mode, encoding="utf-8")
         file_header.setLevel(log_level)
         file_header.setFormatter(formatter)
-        logger.addHandler(file_header)
+        handlers.append(file_header)
+
+    global _LISTENER
+    records = queue.SimpleQueue()
+    logger.addHandler(_ContextQueueHandler(records))
+    _LISTENER = _RedactingListener(records, *handlers, respect_handler_level=True)
+    _LISTENER.start()
+    atexit.register(log_stop)
+
+
+class RequestContextMiddleware:
+    """
+    Give every request an id, its X-Request-ID header or a new one, which is sent back and added to its log records,
+    and log one access line per request with its status, duration and the seconds of its stages.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_id = Headers(scope=scope).get("x-request-id", "")
+        if not _REQUEST_ID.match(request_id):
+            request_id = uuid4().hex[:16]
+        id_token = REQUEST_ID.set(request_id)
+        stages_token = REQUEST_STAGES.set({})
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(scope=message)
+                if "x-request-id" not in headers:
+                    headers["X-Request-ID"] = request_id
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            stages = {stage: round(seconds * 1000, 1) for stage, seconds in REQUEST_STAGES.get().items()}
+            logging.getLogger("access").info(
+                "%s %s %d", scope["method"], scope["path"], status,
+                extra={"method": scope["method"], "path": scope["path"], "status": status,
+                       "duration_ms": round((time.perf_counter() - started) * 1000, 1), "stages": stages})
+            REQUEST_STAGES.reset(stages_token)
+            REQUEST_ID.reset(id_token)
 
 
 if __name__ == '__main__':
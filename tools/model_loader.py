@@ -0,0 +1,100 @@
+"""Load the models, optionally through a local safetensors snapshot which is memory mapped on the next loads."""
+
+import logging
+import os
+import re
+import shutil
+import time
+from typing import Literal, Tuple, Optional
+from uuid import uuid4
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+# where the snapshots of the checkpoints are saved, None to always load from the checkpoint
+SNAPSHOT_DIR: Optional[str] = None
+_SNAPSHOT_COMPLETE = ".complete"
+
+
+class LoadProgress:
+    """The stage of a model load, reported by /readyz."""
+
+    def __init__(self):
+        self.stage: Literal["pending", "weights", "tokenizer", "snapshot", "ready", "failed"] = "pending"
+        self.source: Optional[str] = None
+        self.error: Optional[str] = None
+        self.started_at: float = time.time()
+        self.stage_started_at: float = self.started_at
+        self.finished_at: Optional[float] = None
+
+    def set(self, stage: str):
+        logging.info(f"Load model, stage: {stage}, seconds: {time.time() - self.started_at:.1f}")
+        self.stage = stage
+        self.stage_started_at = time.time()
+        if stage in ("ready", "failed"):
+            self.finished_at = self.stage_started_at
+
+    def to_dict(self) -> dict:
+        return {"stage": self.stage, "source": self.source, "error": self.error,
+                "seconds": round((self.finished_at or time.time()) - self.started_at, 1),
+                "stage_seconds": round(time.time() - self.stage_started_at, 1)}
+
+
+def snapshot_path(model_path: str) -> Optional[str]:
+    if SNAPSHOT_DIR is None:
+        return None
+    return os.path.join(SNAPSHOT_DIR, re.sub(r"[^\w.-]", "_", model_path))
+
+
+def _has_snapshot(model_path: str) -> bool:
+    path = snapshot_path(model_path)
+    return path is not None and os.path.exists(os.path.join(path, _SNAPSHOT_COMPLETE))
+
+
+def save_snapshot(model: AutoModelForCausalLM, tokenizer: AutoTokenizer, model_path: str):
+    """Save the model as safetensors next to the remote code, the directory is renamed into place once complete."""
+    path = snapshot_path(model_path)
+    tmp_path = f"{path}.{uuid4().hex[:8]}.tmp"
+    try:
+        model.save_pretrained(tmp_path, safe_serialization=True)
+        tokenizer.save_pretrained(tmp_path)
+        open(os.path.join(tmp_path, _SNAPSHOT_COMPLETE), "w").close()
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logging.warning(f"Snapshot of {model_path} not saved: {e!r}")
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_model(_model_path: str, device_map: Literal["cuda", "cpu", "auto"] = "auto", trust_remote_code: bool = True,
+               progress: Optional[LoadProgress] = None) -> Tuple[AutoModelForCausalLM, AutoTokenizer]:
+    """
+    Load model and tokenizer from Hugging Face model hub, or from their snapshot.
+
+    The first load of a checkpoint saves its snapshot when SNAPSHOT_DIR is set,
+    the next loads memory map its safetensors files instead of reading the checkpoint again.
+    """
+    from transformers.generation import GenerationConfig
+
+    progress = progress or LoadProgress()
+    snapshot = _has_snapshot(_model_path)
+    source = snapshot_path(_model_path) if snapshot else _model_path
+    progress.source = source
+    try:
+        progress.set("weights")
+        _model = AutoModelForCausalLM.from_pretrained(source, trust_remote_code=trust_remote_code,
+                                                      device_map=device_map, local_files_only=snapshot)
+        progress.set("tokenizer")
+        _tokenizer = AutoTokenizer.from_pretrained(source, trust_remote_code=trust_remote_code,
+                                                   local_files_only=snapshot)
+        _model.generation_config = GenerationConfig.from_pretrained(source, trust_remote_code=trust_remote_code,
+                                                                    local_files_only=snapshot)
+        if SNAPSHOT_DIR is not None and not snapshot:
+            progress.set("snapshot")
+            save_snapshot(_model, _tokenizer, _model_path)
+    except Exception as e:
+        progress.error = repr(e)
+        progress.set("failed")
+        raise
+    progress.set("ready")
+    return _model, _tokenizer
@@ -0,0 +1,227 @@
+import asyncio
+import gc
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from fastapi.concurrency import run_in_threadpool
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from tools.executor import InferenceExecutor
+from tools.model_loader import LoadProgress
+from tools.openai_types import ChatModelNotExists
+from tools.prefix_cache import PrefixCache
+
+if TYPE_CHECKING:
+    # imports torch, only needed once a model is loaded
+    from tools.visual_cache import VisualCache
+
+
+def model_bytes(model: AutoModelForCausalLM) -> int:
+    """Memory held by the parameters and buffers of the model."""
+    return sum(tensor.numel() * tensor.element_size() for tensor in [*model.parameters(), *model.buffers()])
+
+
+def parse_models(models: str, default: str) -> Dict[str, str]:
+    """
+    Parse the served models from their comma separated list.
+
+    :param models: Checkpoint names or paths, each served under its name, or ``name=checkpoint``.
+    :param default: The default model, always served.
+    :returns: Model name -> checkpoint.
+    """
+    checkpoints = {default: default}
+    for item in filter(None, (item.strip() for item in models.split(","))):
+        name, _, checkpoint = item.rpartition("=")
+        checkpoints[name or checkpoint] = checkpoint
+    return checkpoints
+
+
+def parse_drafts(drafts: str, default: str) -> Dict[str, str]:
+    """
+    Parse the draft models from their comma separated list.
+
+    :param drafts: ``name=checkpoint`` items, the draft of the served model ``name``, or a checkpoint alone
+        for the draft of the default model.
+    :returns: Model name -> checkpoint of its draft.
+    """
+    parsed = {}
+    for item in filter(None, (item.strip() for item in drafts.split(","))):
+        name, _, checkpoint = item.rpartition("=")
+        parsed[name or default] = checkpoint
+    return parsed
+
+
+class LoadedModel:
+    """A model with its tokenizer, caches and optional draft model."""
+
+    def __init__(self, name: str, model: AutoModelForCausalLM, tokenizer: AutoTokenizer,
+                 prefix_cache: Optional[PrefixCache], visual_cache: "VisualCache",
+                 draft: Optional[AutoModelForCausalLM] = None):
+        self.name = name
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_cache = prefix_cache
+        self.visual_cache = visual_cache
+        self.draft = draft
+        self.bytes = model_bytes(model) + (model_bytes(draft) if draft is not None else 0)
+        self.loaded_at = time.time()
+
+
+class ModelRegistry:
+    """
+    The models which can be served, each is loaded on its first request.
+
+    Once the loaded models are over ``max_bytes``, the least recently used ones are unloaded,
+    after their queued and running generations, before the next model is loaded.
+    Their caches are kept but emptied, so the cache counters keep counting across reloads.
+    """
+
+    def __init__(self, checkpoints: Dict[str, str], load: Callable[..., Tuple[AutoModelForCausalLM, AutoTokenizer]],
+                 device_map: str = "cuda", max_bytes: int = 0, prefix_cache_bytes: int = 1024 * 1024 * 1024,
+                 visual_cache_bytes: int = 512 * 1024 * 1024, visual_cache_dir: Optional[str] = None,
+                 drafts: Optional[Dict[str, str]] = None):
+        """
+        :param checkpoints: Model name -> checkpoint name or path.
+        :param load: Load the model and tokenizer of a checkpoint, e.g. model_loader.load_model.
+        :param max_bytes: The memory budget of the loaded models, 0 for no limit.
+        :param prefix_cache_bytes: The prefix cache budget of each model.
+        :param visual_cache_bytes: The visual cache budget of each model.
+        :param visual_cache_dir: Each model saves its visual encoder outputs to a sub directory,
+            None to keep them in memory only.
+        :param drafts: Model name -> checkpoint of a smaller model with the same tokens, loaded and unloaded with it,
+            which speeds up its greedy answers.
+        """
+        self.checkpoints = checkpoints
+        self.load = load
+        self.device_map = device_map
+        self.max_bytes = max_bytes
+        self.prefix_cache_bytes = prefix_cache_bytes
+        self.visual_cache_bytes = visual_cache_bytes
+        self.visual_cache_dir = visual_cache_dir
+        self.drafts = drafts or {}
+        self.executor: Optional[InferenceExecutor] = None  # the inference worker, set once it is started
+        self.prefix_caches: Dict[str, Optional[PrefixCache]] = {}  # None when the budget is 0
+        self.visual_caches: Dict[str, "VisualCache"] = {}
+        self.progress: Dict[str, LoadProgress] = {}  # the last load of each model
+        self.loads: int = 0
+        self.unloads: int = 0
+        self._loaded: "OrderedDict[str, LoadedModel]" = OrderedDict()  # LRU first
+        self._sizes: Dict[str, int] = {}  # bytes of the models loaded before
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def names(self) -> List[str]:
+        return list(self.checkpoints)
+
+    def loaded(self) -> List[LoadedModel]:
+        return list(self._loaded.values())
+
+    def _caches(self, name: str) -> Tuple[Optional[PrefixCache], "VisualCache"]:
+        if name not in self.prefix_caches:
+            from tools.visual_cache import VisualCache
+            cache_dir = None
+            if self.visual_cache_dir is not None:
+                cache_dir = os.path.join(self.visual_cache_dir, re.sub(r"[^\w.-]", "_", name))
+            # no cache at all with a budget of 0, so the prompt is prefilled in one piece and never stored
+            self.prefix_caches[name] = PrefixCache(self.prefix_cache_bytes) if self.prefix_cache_bytes > 0 else None
+            self.visual_caches[name] = VisualCache(max_bytes=self.visual_cache_bytes, cache_dir=cache_dir)
+        return self.prefix_caches[name], self.visual_caches[name]
+
+    def _loaded_bytes(self) -> int:
+        return sum(entry.bytes for entry in self._loaded.values())
+
+    async def _evict(self, needed: int = 0, keep: Optional[str] = None):
+        """Unload the least recently used models until ``needed`` more bytes fit in the budget."""
+        if self.max_bytes <= 0:
+            return
+        for name in list(self._loaded):
+            if self._loaded_bytes() + needed <= self.max_bytes:
+                break
+            if name != keep:
+                await self.unload(name)
+
+    @staticmethod
+    def _free_memory():
+        gc.collect()
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    async def unload(self, name: str):
+        """Unload the model once its queued and running generations are done, they keep it in memory until then."""
+        entry = self._loaded.pop(name, None)
+        if entry is None:
+            return
+        if self.executor is not None:
+            model = entry.model
+            await self.executor.drain(lambda job: any(arg is model for arg in job.args))
+            del model
+        if entry.prefix_cache is not None:
+            entry.prefix_cache.clear()
+        entry.visual_cache.clear()
+        del entry
+        await run_in_threadpool(self._free_memory)
+        self.unloads += 1
+        logging.info(f"Unload model {name}, loaded: {list(self._loaded)}")
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._loaded
+
+    def _load(self, name: str, progress: LoadProgress) -> LoadedModel:
+        model, tokenizer = self.load(self.checkpoints[name], device_map=self.device_map, progress=progress)
+        prefix_cache, visual_cache = self._caches(name)
+        if not visual_cache.install(model):
+            logging.warning(f"Model {name} has no vision tower to cache")
+        draft = None
+        if name in self.drafts:
+            draft, _ = self.load(self.drafts[name], device_map=self.device_map)
+            if getattr(draft.config, "vocab_size", None) != getattr(model.config, "vocab_size", None):
+                # the tokens of the draft would not be the ones of the model
+                logging.warning(f"Draft model {self.drafts[name]} of {name} has another vocabulary, not used")
+                draft = None
+            elif getattr(model.config, "use_flash_attn", False) is True:
+                # the flash attention of the Qwen remote code is only causal without past key values
+                logging.warning(f"Model {name} uses flash attention, which cannot check several draft tokens at once,"
+                                " draft model not used")
+                draft = None
+        return LoadedModel(name, model, tokenizer, prefix_cache, visual_cache, draft=draft)
+
+    async def get(self, name: str) -> LoadedModel:
+        """
+        The loaded model, loaded first if needed.
+        :raises ChatModelNotExists: The model is not one of the checkpoints.
+        """
+        if name not in self.checkpoints:
+            raise ChatModelNotExists(model_name=name)
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+            return self._loaded[name]
+
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            if name not in self._loaded:
+                # a model not loaded before is guessed as large as the largest one
+                await self._evict(needed=self._sizes.get(name, max(self._sizes.values(), default=0)))
+                start = time.perf_counter()
+                self.progress[name] = LoadProgress()
+                entry = await run_in_threadpool(self._load, name, self.progress[name])
+                self._loaded[name] = entry
+                self._sizes[name] = entry.bytes
+                self.loads += 1
+                logging.info(f"Load model {name} in {time.perf_counter() - start:.1f}s, bytes: {entry.bytes}")
+                await self._evict(keep=name)
+            self._loaded.move_to_end(name)
+            return self._loaded[name]
+
+    def unload_all(self):
+        """Unload all the models at once, once the inference worker is stopped."""
+        for entry in self._loaded.values():
+            if entry.prefix_cache is not None:
+                entry.prefix_cache.clear()
+            entry.visual_cache.clear()
+        self._loaded.clear()
+        self._free_memory()
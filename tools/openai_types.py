@@ -28,8 +28,17 @@ class ModelList(BaseModel):
 
 
 class ChatContentImageImageUrl(BaseModel):
+    # a plain str, without constraints, is validated as the very object parsed from the JSON body,
+    # data: urls can be megabytes
     url: str
 
+    def __repr_args__(self):
+        # the requests are logged at DEBUG, without a copy of the base64 payload
+        if self.url.startswith("data:"):
+            yield "url", f"{self.url[:self.url.find(',', 0, 256) + 1]}<{len(self.url)} chars>"
+        else:
+            yield "url", self.url
+
 
 class ChatContentImage(BaseModel):
     type: Literal["text", "image_url"]
@@ -56,9 +65,9 @@ class ChatCompletionRequest(BaseModel):
     temperature: Optional[float] = Field(default=1, ge=0, le=2)
     top_p: Optional[float] = Field(default=1, ge=0, le=1)
     seed: Optional[int] = None
-    max_tokens: Optional[int] = None
+    max_tokens: Optional[int] = Field(default=None, ge=1)
     stream: Optional[bool] = False
-    stop: Optional[List[str]] = None
+    stop: Optional[Union[str, List[str]]] = None
     functions: Optional[list] = None
     tools: Optional[list] = None
 
@@ -72,7 +81,7 @@ class ChatCompletionResponseChoice(BaseModel):
 class ChatCompletionResponseStreamChoice(BaseModel):
     index: int
     delta: DeltaMessage
-    finish_reason: Optional[Literal["stop"]] = None
+    finish_reason: Optional[Literal["stop", "length"]] = None
 
 
 class ChatCompletionResponse(BaseModel):
@@ -83,6 +92,8 @@ class ChatCompletionResponse(BaseModel):
     created: Optional[int] = Field(default_factory=lambda: int(time.time()))
     usage: Optional[Dict[str, int]] = Field(default=None)
     object: Literal["chat.completion", "chat.completion.chunk"] = Field(default="chat.completion")
+    # the history left out by the context policy, see tools.qwen_chat.format_history
+    context: Optional[Dict[str, Union[str, int]]] = Field(default=None)
 
 
 class ChatModelNotExists(Exception):
@@ -99,3 +110,9 @@ class ChatMessagesError(Exception):
 class ChatFunctionCallNotAllow(Exception):
     def __init__(self, function_name: str = None):
         self.function_name = function_name
+
+
+class ChatImageNotAvailable(Exception):
+    def __init__(self, url: str, reason: str = None):
+        self.url = url
+        self.reason = reason
@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+from typing import Tuple, List, Optional, Any
+
+PastKeyValues = Tuple[Tuple[Any, ...], ...]
+
+
+def past_key_values_bytes(past_key_values: PastKeyValues) -> int:
+    """The memory held by the key and value tensors of all the layers."""
+    return sum(tensor.numel() * tensor.element_size() for layer in past_key_values for tensor in layer)
+
+
+class PrefixCache:
+    """
+    LRU cache of the past key values of prompt prefixes, keyed by their token ids and bounded by the memory they hold.
+
+    A new turn of a conversation starts with the prompt of the previous turn, so only its new tokens are prefilled.
+    Thread safe: used from the inference worker thread, and cleared from the event loop when the model is unloaded.
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30):
+        self.max_bytes = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.reused_tokens: int = 0
+        self._entries: "OrderedDict[Tuple[int, ...], Tuple[PastKeyValues, int]]" = OrderedDict()  # LRU first
+        self._bytes: int = 0
+        self._lock = threading.Lock()
+
+    def longest_prefix(self, token_ids: List[int]) -> Tuple[int, Optional[PastKeyValues]]:
+        """Find the longest cached prefix of the tokens, return its length and past key values."""
+        best: Optional[Tuple[int, ...]] = None
+        with self._lock:
+            for key in self._entries:
+                if len(key) <= len(token_ids) and (best is None or len(key) > len(best)) \
+                        and tuple(token_ids[:len(key)]) == key:
+                    best = key
+            if best is None:
+                self.misses += 1
+                return 0, None
+            self.hits += 1
+            self.reused_tokens += len(best)
+            self._entries.move_to_end(best)
+            return len(best), self._entries[best][0]
+
+    def put(self, token_ids: List[int], past_key_values: PastKeyValues):
+        size = past_key_values_bytes(past_key_values)
+        if size > self.max_bytes:
+            return
+        key = tuple(token_ids)
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (past_key_values, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "reused_tokens": self.reused_tokens, "entries": len(self._entries), "bytes": self._bytes}
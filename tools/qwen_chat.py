@@ -1,21 +1,39 @@
+"""
+The chat requests on the event loop side: formatting the messages, queueing the generation and streaming it back.
+
+The generation itself, which needs torch, is in tools.qwen_generate and is only imported once a chat is queued.
+"""
+
+import asyncio
+import json
 import logging
-from typing import Tuple, Literal, List, Optional
+import threading
+from typing import Tuple, Literal, List, Optional, Set, Callable, Awaitable, AsyncIterator, Dict, Sequence, Union, Any
 
 from transformers import AutoModelForCausalLM, AutoTokenizer
-from transformers.generation import GenerationConfig
 
+from tools.executor import InferenceExecutor, InferenceTimeout
+from tools.metrics import STAGE_SECONDS, Counter
 from tools.openai_types import ChatMessage, ChatCompletionResponse, ChatContentImage
-from tools.tools import download_img_from_url
+from tools.openai_types import ChatCompletionResponseStreamChoice, DeltaMessage
+from tools.prefix_cache import PrefixCache
+from tools.scheduler import Priority
+from tools.tools import download_images
 
+DRAFT_TOKENS: int = 5  # tokens a draft model proposes at first, then more while they are accepted, fewer otherwise
 
-def load_model(_model_path: str, device_map: Literal["cuda", "cpu", "auto"] = "auto", trust_remote_code: bool = True
-               ) -> Tuple[AutoModelForCausalLM, AutoTokenizer]:
-    """Load model and tokenizer from Hugging Face model hub."""
-    _model = AutoModelForCausalLM.from_pretrained(_model_path,
-                                                  trust_remote_code=trust_remote_code, device_map=device_map)
-    _tokenizer = AutoTokenizer.from_pretrained(_model_path, trust_remote_code=trust_remote_code)
-    _model.generation_config = GenerationConfig.from_pretrained(_model_path, trust_remote_code=trust_remote_code)
-    return _model, _tokenizer
+ContextPolicy = Literal["off", "drop", "compact"]
+CONTEXT_POLICY: ContextPolicy = "drop"  # how a conversation over the budget is cut, see _fit_context
+CONTEXT_BUDGET: int = 0  # max tokens of the prompt, 0 for the max_window_size of the model
+HISTORY_IMAGE_TURNS: int = -1  # the turns of the history before the last ones lose their images, -1 to keep them all
+IMAGE_TOKENS: int = 264  # an image of the prompt: 256 visual tokens, their tags and its "Picture N: " caption
+IMAGE_PLACEHOLDER = "[image]\n"  # the text of a removed image
+_ROLE_TOKENS = 5  # <|im_start|>role\n ... <|im_end|>\n
+# the turns are cut by blocks, so the next requests of the conversation keep the prompt prefix of the prefix cache
+_CUT_TURNS = 4
+
+CONTEXT_SAVED_TOKENS = Counter("qwen_context_saved_tokens_total", "Prompt tokens left out by the context policy.",
+                               labelnames=("policy",))
 
 
 def sort_list(_data: List[ChatContentImage]):
@@ -23,8 +41,19 @@ def sort_list(_data: List[ChatContentImage]):
     return sorted(_data, key=lambda item: item.type not in ['image_url', 'box'])
 
 
-def _create_query(_query: ChatMessage, **kwargs):
-    """Create the query for the model.chat function."""
+def _image_urls(_message: ChatMessage) -> List[str]:
+    if isinstance(_message.content, str):
+        return []
+    return [content.image_url.url for content in _message.content if content.type == "image_url"]
+
+
+def _create_query(_query: ChatMessage, _images: Dict[str, str], _strip_images: bool = False):
+    """
+    Create the query for the model.chat function.
+
+    :param _images: The downloaded images, url -> path.
+    :param _strip_images: Replace the images with IMAGE_PLACEHOLDER.
+    """
     if isinstance(_query.content, str):
         return [{"text": _query.content}]
     else:
@@ -33,18 +62,85 @@ def _create_query(_query: ChatMessage, **kwargs):
             if content.type == "text":
                 _query_list.append({"text": content.text})
             elif content.type == "image_url":
-                _img_path = download_img_from_url(content.image_url.url, **kwargs)
-                logging.debug(f"Save Image, path: {_img_path}")
-                _query_list.append({"image": _img_path})
+                _query_list.append({"text": IMAGE_PLACEHOLDER} if _strip_images
+                                   else {"image": _images[content.image_url.url]})
         return _query_list
 
 
-def format_history(_messages: List[ChatMessage], _tokenizer: AutoTokenizer, **kwargs) -> tuple[
-    str, Optional[List[Tuple[str, str]]], str]:
+def _message_tokens(_message: ChatMessage, _tokenizer: AutoTokenizer, _strip_images: bool = False) -> int:
+    """The tokens of the message in the prompt, its images counted as IMAGE_TOKENS."""
+    if not isinstance(_message.content, list):
+        return _ROLE_TOKENS + len(_tokenizer.encode(_message.content or ""))
+    tokens = _ROLE_TOKENS
+    for content in _message.content:
+        if content.type == "text":
+            tokens += len(_tokenizer.encode(content.text))
+        elif content.type == "image_url":
+            tokens += len(_tokenizer.encode(IMAGE_PLACEHOLDER)) if _strip_images else IMAGE_TOKENS
+    return tokens
+
+
+def _fit_context(_system: str, _turns: List[Tuple[ChatMessage, ChatMessage]], _query: ChatMessage,
+                 _tokenizer: AutoTokenizer, _budget: int) -> Tuple[int, Set[int], Dict[str, Any]]:
+    """
+    Choose the turns of the history given to the model, the system prompt and the query are always given.
+
+    The turns before the last HISTORY_IMAGE_TURNS lose their images. Then while the prompt is over the budget,
+    the "compact" policy removes the images of the oldest turns, and the "drop" and "compact" policies
+    drop the oldest turns. Both by blocks of turns, so that the prompt prefix changes only every few turns,
+    unless no block boundary fits the budget: the turns are then dropped one by one, down to the newest ones which fit.
+
+    :param _turns: The prompt and response of each turn of the history, oldest first.
+    :param _budget: Max tokens of the prompt, 0 for no limit.
+    :returns: The index of the first turn kept, the indexes of the turns without their images,
+        and the report of the response: policy, estimated_prompt_tokens, saved_tokens, dropped_turns and
+        stripped_images. The token counts are estimated from the messages, the usage has the exact prompt tokens.
+    """
+    full = [_message_tokens(prompt, _tokenizer) + _message_tokens(response, _tokenizer)
+            for prompt, response in _turns]
+    bare = [_message_tokens(prompt, _tokenizer, True) + _message_tokens(response, _tokenizer)
+            for prompt, response in _turns]
+    fixed = 2 * _ROLE_TOKENS + len(_tokenizer.encode(_system)) + _message_tokens(_query, _tokenizer)
+    before = fixed + sum(full)
+
+    blocks = range(0, len(_turns), _CUT_TURNS)
+    stripped = set()
+    if HISTORY_IMAGE_TURNS >= 0:
+        stripped = set(range(max(len(_turns) - HISTORY_IMAGE_TURNS, 0)))
+
+    def total(first: int = 0) -> int:
+        return fixed + sum(bare[i] if i in stripped else full[i] for i in range(first, len(_turns)))
+
+    first = 0
+    if _budget > 0 and CONTEXT_POLICY == "compact":
+        for start in blocks:
+            if total() <= _budget:
+                break
+            stripped.update(range(start, min(start + _CUT_TURNS, len(_turns))))
+    if _budget > 0 and CONTEXT_POLICY != "off":
+        first = next((start for start in blocks if total(start) <= _budget), None)
+        if first is None:
+            # the newest block is over the budget on its own
+            first = next((index for index in range(len(_turns)) if total(index) <= _budget), len(_turns))
+    stripped = {i for i in stripped if i >= first and full[i] != bare[i]}
+
+    prompt_tokens = total(first)
+    CONTEXT_SAVED_TOKENS.inc(before - prompt_tokens, policy=CONTEXT_POLICY)
+    return first, stripped, {
+        "policy": CONTEXT_POLICY, "estimated_prompt_tokens": prompt_tokens, "saved_tokens": before - prompt_tokens,
+        "dropped_turns": first, "stripped_images": sum(len(_image_urls(_turns[i][0])) for i in stripped)}
+
+
+async def format_history(_messages: List[ChatMessage], _tokenizer: AutoTokenizer, max_window_size: int = 0,
+                         **kwargs) -> tuple[str, Optional[List[Tuple[str, str]]], str, Dict[str, Any]]:
     """
     Format the OpenAI API style chat messages to Qwen-VL model.chat style.
 
-    :returns: query, history, system
+    The history is cut to CONTEXT_BUDGET tokens, see _fit_context,
+    then the images of the query and of the history left are downloaded concurrently.
+
+    :param max_window_size: The context window of the model, the budget when CONTEXT_BUDGET is 0.
+    :returns: query, history, system, and the report of the context policy
     """
     _system: str = "You are a helpful assistant."
     _query: str
@@ -54,37 +150,232 @@ def format_history(_messages: List[ChatMessage], _tokenizer: AutoTokenizer, **kw
     if _messages[0].role == "system":
         _system = _messages.pop(0).content
 
-    # query
+    # context budget
     assert _messages[-1].role == "user", ValueError("The last message should be from the user.")
-    _query = _tokenizer.from_list_format(_create_query(_messages.pop(-1), **kwargs))
+    it = iter(_messages[:-1])
+    _turns = list(zip(it, it))
+    _first, _stripped, _context = await asyncio.to_thread(_fit_context, _system, _turns, _messages[-1], _tokenizer,
+                                                          CONTEXT_BUDGET or max_window_size)
+    _turns = [(prompt, response, index in _stripped) for index, (prompt, response) in enumerate(_turns)][_first:]
+
+    # images
+    _urls = [url for prompt, response, strip in _turns if not strip
+             for url in [*_image_urls(prompt), *_image_urls(response)]] + _image_urls(_messages[-1])
+    if _urls:
+        with STAGE_SECONDS.time(stage="image"):
+            _images = await download_images(_urls, **kwargs)
+        logging.debug("Save Images, paths: %s", list(_images.values()))
+    else:
+        _images = {}
+
+    # query
+    _query = _tokenizer.from_list_format(_create_query(_messages.pop(-1), _images))
 
     # history
-    if len(_messages) > 0:
+    if len(_turns) > 0:
         _history = []
-        it = iter(_messages)
-        for prompt, response in zip(it, it):
-            _history.append((_tokenizer.from_list_format(_create_query(prompt, **kwargs)), response.content))
+        for prompt, response, strip in _turns:
+            _history.append((_tokenizer.from_list_format(_create_query(prompt, _images, strip)), response.content))
+
+    return _query, _history, _system, _context
+
+
+class IncrementalDecoder:
+    """
+    Decode the generated tokens of one answer incrementally.
+
+    Only the tokens between the last two offsets are decoded at each step instead of the whole answer,
+    and the text is held back while it ends with an incomplete utf-8 sequence or the beginning of a stop string.
+    """
+
+    def __init__(self, tokenizer: AutoTokenizer, stop_token_ids: Set[int], on_text: Callable[[str], None] = None,
+                 stop: Sequence[str] = (), max_tokens: Optional[int] = None):
+        """
+        :param stop: The answer ends before the first of these strings, which is not part of the text.
+        :param max_tokens: The answer ends with finish_reason "length" once it has this many tokens.
+        """
+        self.tokenizer = tokenizer
+        self.stop_token_ids = stop_token_ids
+        self.on_text = on_text
+        self.stop = [text for text in stop if text]
+        self.max_tokens = max_tokens
+        self.token_ids: List[int] = []
+        self.text: str = ""
+        self.finish_reason: Optional[Literal["stop", "length"]] = None
+        self._prefix_offset: int = 0
+        self._read_offset: int = 0
+        self._held: str = ""  # may be the beginning of a stop string
+
+    @property
+    def stopped(self) -> bool:
+        return self.finish_reason is not None
+
+    def _decode_delta(self, final: bool = False) -> str:
+        prefix_text = self.tokenizer.decode(self.token_ids[self._prefix_offset:self._read_offset])
+        new_text = self.tokenizer.decode(self.token_ids[self._prefix_offset:])
+        if len(new_text) > len(prefix_text) and (final or not new_text.endswith("\ufffd")):
+            self._prefix_offset = self._read_offset
+            self._read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def _emit(self, delta: str):
+        if delta:
+            self.text += delta
+            if self.on_text is not None:
+                self.on_text(delta)
+
+    def _check_stop(self, delta: str, final: bool = False) -> str:
+        """Cut the text at the first stop string, and hold back its possible beginning until the next delta."""
+        if not self.stop:
+            return delta
+        text = self._held + delta
+        positions = [position for position in (text.find(stop) for stop in self.stop) if position != -1]
+        if positions:
+            self.finish_reason = "stop"
+            self._held = ""
+            return text[:min(positions)]
+        held = 0
+        if not final:
+            for stop in self.stop:
+                for size in range(min(len(stop) - 1, len(text)), held, -1):
+                    if text.endswith(stop[:size]):
+                        held = size
+                        break
+        self._held = text[len(text) - held:]
+        return text[:len(text) - held]
+
+    def add(self, token_ids: List[int]):
+        if self.stopped:
+            return
+        for token_id in token_ids:
+            if token_id in self.stop_token_ids:
+                self.finish_reason = "stop"
+                break
+            self.token_ids.append(token_id)
+            if self.max_tokens is not None and len(self.token_ids) >= self.max_tokens:
+                self.finish_reason = "length"
+                break
+        self._emit(self._check_stop(self._decode_delta(final=self.stopped), final=self.stopped))
+
+    def end(self):
+        if not self.stopped:
+            self._emit(self._check_stop(self._decode_delta(final=True), final=True))
+
+
+class ChatResult:
+    def __init__(self, text: str, finish_reason: Literal["stop", "length"], prompt_tokens: int = 0,
+                 completion_tokens: int = 0):
+        self.text = text
+        self.finish_reason = finish_reason
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def usage(self) -> Dict[str, int]:
+        return {"prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens,
+                "total_tokens": self.total_tokens}
+
+
+def _enqueue_chat(executor: InferenceExecutor, model: AutoModelForCausalLM, tokenizer: AutoTokenizer, query: str,
+                  history: Optional[List[Tuple[str, str]]], system: str, cancel_event: threading.Event,
+                  on_text: Callable[[str], None] = None, prefix_cache: Optional[PrefixCache] = None,
+                  stop: Union[str, List[str], None] = None, max_tokens: Optional[int] = None,
+                  seed: Optional[int] = None, priority: Priority = "interactive", api_key: str = "",
+                  draft: Optional[AutoModelForCausalLM] = None, **kwargs):
+    from tools.qwen_generate import generate_batch
+
+    # requests with the same generation parameters can share a generate call, stop, max_tokens and seed are per row
+    batch_key = (id(model), tuple(sorted(kwargs.items())))
+    # the fair share of the clients is counted in the tokens they may generate
+    cost = max_tokens or getattr(model.generation_config, "max_new_tokens", None) or 512
+    return executor.enqueue(generate_batch, model, tokenizer, prefix_cache, draft, kwargs, batch_key=batch_key,
+                            cancel_event=cancel_event, priority=priority, api_key=api_key, cost=cost,
+                            query=query, history=history, system=system, on_text=on_text,
+                            stop=[stop] if isinstance(stop, str) else stop, max_tokens=max_tokens, seed=seed)
+
+
+async def chat(executor: InferenceExecutor, model: AutoModelForCausalLM, tokenizer: AutoTokenizer, query: str,
+               history: Optional[List[Tuple[str, str]]], system: str, prefix_cache: Optional[PrefixCache] = None,
+               stop: Union[str, List[str], None] = None, max_tokens: Optional[int] = None, seed: Optional[int] = None,
+               priority: Priority = "interactive", api_key: str = "", draft: Optional[AutoModelForCausalLM] = None,
+               **kwargs) -> ChatResult:
+    """
+    Chat with the model on the inference worker.
+
+    :param prefix_cache: The past key values of earlier prompts, None to prefill the whole prompt.
+    :param stop: The answer ends before the first of these strings.
+    :param max_tokens: The max number of tokens of the answer, None for the default of the generation config.
+    :param seed: The same seed gives the same answer, whichever requests run at the same time, None for a random one.
+    :param priority: The class of the request, interactive ones run before bulk ones.
+    :param api_key: The client, the clients share the model in proportion to their weights and within their quotas.
+    :param draft: A small model with the same tokens, proposing the tokens of greedy answers, which the model checks
+        several at a time. The answer is the same, sooner.
+    :param kwargs: Generation parameters, e.g. top_p and temperature.
+    """
+    job = _enqueue_chat(executor, model, tokenizer, query, history, system, cancel_event=threading.Event(),
+                        prefix_cache=prefix_cache, stop=stop, max_tokens=max_tokens, seed=seed, priority=priority,
+                        api_key=api_key, draft=draft, **kwargs)
+    return await executor.wait(job)
+
+
+def _sse(data: str) -> bytes:
+    return bytes(f"data: {data}\n\n", "utf-8")
+
+
+async def _stream_frames(result: Awaitable[ChatResult], deltas: asyncio.Queue, cancel_event: threading.Event,
+                         model_name: str, context: Optional[Dict[str, Any]] = None) -> AsyncIterator[bytes]:
+    task = asyncio.ensure_future(result)
+    # all the deltas are put before the result is set, so None is always the last item
+    task.add_done_callback(lambda _: deltas.put_nowait(None))
 
-    return _query, _history, _system
+    chunk = ChatCompletionResponse(object="chat.completion.chunk", model=model_name, choices=[
+        ChatCompletionResponseStreamChoice(index=0, delta=DeltaMessage(role="assistant", content=""))])
+    try:
+        yield _sse(chunk.model_dump_json(exclude_none=True))
+        while (delta := await deltas.get()) is not None:
+            chunk.choices = [ChatCompletionResponseStreamChoice(index=0, delta=DeltaMessage(content=delta))]
+            yield _sse(chunk.model_dump_json(exclude_none=True))
+        chat_result = await task
+        chunk.choices = [ChatCompletionResponseStreamChoice(index=0, delta=DeltaMessage(),
+                                                            finish_reason=chat_result.finish_reason)]
+        chunk.usage = chat_result.usage()
+        chunk.context = context
+        yield _sse(chunk.model_dump_json(exclude_none=True))
+    except InferenceTimeout as e:
+        yield _sse(json.dumps({"error": {"message": f"The request is not finished in {e.timeout} seconds.",
+                                         "type": "TimeoutError", "param": None, "code": 504}}))
+    finally:
+        # client disconnected or generation failed, stop the worker
+        cancel_event.set()
+        task.cancel()
+    yield _sse("[DONE]")
 
 
-async def stream_chat(query: str, history: List[Tuple[str, str]], model: AutoModelForCausalLM,
-                      tokenizer: AutoTokenizer, model_name: str = "", **kwargs):
+def stream_chat(executor: InferenceExecutor, model: AutoModelForCausalLM, tokenizer: AutoTokenizer, query: str,
+                history: Optional[List[Tuple[str, str]]], system: str, model_name: str = "",
+                prefix_cache: Optional[PrefixCache] = None, stop: Union[str, List[str], None] = None,
+                max_tokens: Optional[int] = None, seed: Optional[int] = None, priority: Priority = "interactive",
+                api_key: str = "", draft: Optional[AutoModelForCausalLM] = None,
+                context: Optional[Dict[str, Any]] = None, **kwargs) -> AsyncIterator[bytes]:
     """
-    Stream chat with the model.
+    Stream chat with the model as OpenAI style server-sent events, see chat.
+    The last chunk has the usage, and the ``context`` report of format_history.
 
-    todo: unSupported Stream Chat
+    The generation is queued right away,
+    so InferenceQueueFull and QuotaExceeded are raised before the response is started.
     """
-    answer = ""
-    for index, chunk in enumerate(model.chat_stream(tokenizer, query=query, history=history, **kwargs)):
-        yield bytes(ChatCompletionResponse(**{
-            "object": "chat.completion.chunk",
-            "model": model_name,
-            "choices": [{
-                "index": index,
-                "delta": {"role": "assistant", "content": chunk.replace(answer, "")},
-            }]}).model_dump_json(), "utf-8")
-        answer = chunk
+    loop = asyncio.get_running_loop()
+    deltas = asyncio.Queue()
+    cancel_event = threading.Event()
+    job = _enqueue_chat(executor, model, tokenizer, query, history, system, cancel_event=cancel_event,
+                        on_text=lambda text: loop.call_soon_threadsafe(deltas.put_nowait, text),
+                        prefix_cache=prefix_cache, stop=stop, max_tokens=max_tokens, seed=seed, priority=priority,
+                        api_key=api_key, draft=draft, **kwargs)
+    return _stream_frames(executor.wait(job), deltas, cancel_event, model_name, context)
 
 
 if __name__ == '__main__':
@@ -99,4 +390,4 @@ if __name__ == '__main__':
     ]
     # messages = [ChatMessage(**message) for message in messages]
     # _, tokenizer = load_model("Qwen/Qwen-VL-Chat-Int4")
-    # query, history, system = format_history(messages, tokenizer)
+    # query, history, system, context = format_history(messages, tokenizer)
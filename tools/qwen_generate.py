@@ -0,0 +1,353 @@
+"""The generation on the inference worker thread, see tools.qwen_chat for the event loop side."""
+
+import logging
+import sys
+import time
+from typing import List, Optional, Callable, Set, Tuple
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers.generation import LogitsProcessor, LogitsProcessorList, GenerationConfig
+from transformers.generation import TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+from transformers.generation.streamers import BaseStreamer
+
+import tools.qwen_chat
+from tools.metrics import STAGE_SECONDS, Counter, Gauge, Histogram
+from tools.prefix_cache import PrefixCache, PastKeyValues
+from tools.qwen_chat import IncrementalDecoder, ChatResult
+
+PROMPT_TOKENS = Counter("qwen_prompt_tokens_total", "Tokens of the prompts, padding excluded.")
+COMPLETION_TOKENS = Counter("qwen_completion_tokens_total", "Tokens generated for the answers.")
+DECODE_TOKENS_PER_SECOND = Histogram("qwen_decode_tokens_per_second", "Decode speed of each answer.",
+                                     buckets=(1, 2.5, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200))
+_ASSISTED = {"drafted": 0, "accepted": 0}
+DRAFTED_TOKENS = Counter("qwen_assisted_drafted_tokens_total", "Tokens proposed by the draft models.")
+DRAFTED_TOKENS.set_function(lambda: _ASSISTED["drafted"])
+ACCEPTED_TOKENS = Counter("qwen_assisted_accepted_tokens_total", "Tokens of the draft models accepted by the models.")
+ACCEPTED_TOKENS.set_function(lambda: _ASSISTED["accepted"])
+ACCEPTANCE_RATE = Gauge("qwen_assisted_acceptance_rate", "Accepted over proposed draft tokens since the start.")
+ACCEPTANCE_RATE.set_function(lambda: _ASSISTED["accepted"] / max(_ASSISTED["drafted"], 1))
+
+
+def _generation_utils(model: AutoModelForCausalLM):
+    """The module of the remote modeling code, which holds make_context and get_stop_words_ids of Qwen-VL."""
+    return sys.modules[type(model).__module__]
+
+
+class ForceEosLogitsProcessor(LogitsProcessor):
+    """Force the eos token for the rows that should stop, e.g. cancelled requests, the other rows keep generating."""
+
+    def __init__(self, should_stop: Callable[[int], bool], eos_token_id: int):
+        self.should_stop = should_stop
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        for row in range(scores.shape[0]):
+            if self.should_stop(row):
+                scores[row, :] = -float("inf")
+                scores[row, self.eos_token_id] = 0
+        return scores
+
+
+class SamplingLogitsProcessor(LogitsProcessor):
+    """
+    Sample the next token of each row with the generator of the row, and leave only that token for a greedy generate.
+
+    The global RNG is left alone, so a seeded row gets the same answer whichever rows it is batched with,
+    and the other rows are not made deterministic by its seed.
+    """
+
+    def __init__(self, seeds: List[Optional[int]], warpers: LogitsProcessorList):
+        """
+        :param seeds: The seed of each row, None for a random one.
+        :param warpers: Temperature, top k and top p, applied before sampling.
+        """
+        self.seeds = seeds
+        self.warpers = warpers
+        self.generators: Optional[List[torch.Generator]] = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.generators is None:
+            self.generators = [torch.Generator(device=scores.device) for _ in self.seeds]
+            for generator, seed in zip(self.generators, self.seeds):
+                if seed is None:
+                    generator.seed()
+                else:
+                    generator.manual_seed(seed)
+        probs = torch.softmax(self.warpers(input_ids, scores).float(), dim=-1)
+        next_tokens = torch.cat([torch.multinomial(probs[row], num_samples=1, generator=generator)
+                                 for row, generator in enumerate(self.generators)])
+        sampled = torch.full_like(scores, -float("inf"))
+        sampled.scatter_(1, next_tokens[:, None], 0)
+        return sampled
+
+
+def _sampler(generation_config: GenerationConfig, batch: List[dict], temperature: Optional[float] = None,
+             top_p: Optional[float] = None) -> Optional[SamplingLogitsProcessor]:
+    """The sampling of the batch, None for greedy decoding: the config does not sample, or the temperature is 0."""
+    temperature = generation_config.temperature if temperature is None else temperature
+    top_p = generation_config.top_p if top_p is None else top_p
+    if not generation_config.do_sample or not temperature or not top_p:
+        return None
+    warpers = LogitsProcessorList()
+    if temperature != 1:
+        warpers.append(TemperatureLogitsWarper(temperature))
+    if generation_config.top_k:
+        warpers.append(TopKLogitsWarper(top_k=generation_config.top_k))
+    if top_p < 1:
+        warpers.append(TopPLogitsWarper(top_p=top_p))
+    return SamplingLogitsProcessor([item.get("seed") for item in batch], warpers)
+
+
+class TokenStreamer(BaseStreamer):
+    """
+    Route the tokens of a batched generate call to the decoder of each row.
+
+    The time to the first new token is the prefill, vision tower included, the rest is the decode.
+    """
+
+    def __init__(self, decoders: List[IncrementalDecoder]):
+        self.decoders = decoders
+        self._prompt_skipped: bool = False
+        self.started_at: float = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.ended_at: Optional[float] = None
+
+    def put(self, value):
+        # the first call is the prompt
+        if not self._prompt_skipped:
+            self._prompt_skipped = True
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        for decoder, token_ids in zip(self.decoders, value.reshape(len(self.decoders), -1).tolist()):
+            decoder.add(token_ids)
+
+    def end(self):
+        self.ended_at = time.perf_counter()
+        for decoder in self.decoders:
+            decoder.end()
+
+
+def _observe_generation(streamer: TokenStreamer, contexts: List[List[int]]):
+    """Record the prefill and decode time and the tokens of each answer of a generate call."""
+    if streamer.first_token_at is None or streamer.ended_at is None:
+        return
+    prefill = streamer.first_token_at - streamer.started_at
+    decode = streamer.ended_at - streamer.first_token_at
+    for decoder, context in zip(streamer.decoders, contexts):
+        STAGE_SECONDS.observe(prefill, stage="prefill")
+        STAGE_SECONDS.observe(decode, stage="decode")
+        PROMPT_TOKENS.inc(len(context))
+        COMPLETION_TOKENS.inc(len(decoder.token_ids))
+        if decode > 0 and len(decoder.token_ids) > 1:
+            # the first token comes from the prefill
+            DECODE_TOKENS_PER_SECOND.observe((len(decoder.token_ids) - 1) / decode)
+
+
+def _image_spans(token_ids: List[int], image_start_id: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    The positions of the start and end tokens of each image, Qwen-VL ends an image with ``image_start_id + 1``.
+    :returns: None when an image is cut off, e.g. the tokens start inside an image.
+    """
+    starts = [index for index, token_id in enumerate(token_ids) if token_id == image_start_id]
+    ends = [index for index, token_id in enumerate(token_ids) if token_id == image_start_id + 1]
+    if len(starts) != len(ends) or any(start > end for start, end in zip(starts, ends)):
+        return None
+    return list(zip(starts, ends))
+
+
+def _embed_images(model: AutoModelForCausalLM, token_ids: List[int], spans: List[Tuple[int, int]],
+                  image_start_id: int) -> torch.Tensor:
+    """
+    The input embeddings of the tokens with the visual encoder outputs of their images in place,
+    as the Qwen-VL forward makes them when it has no past key values.
+    """
+    embeds = model.transformer.wte(torch.tensor([token_ids], device=model.device))
+    paths = []
+    for start, end in spans:
+        # the url bytes, padded with image_start_id + 2 up to the end token
+        image = token_ids[start + 1:end - 1]
+        paths.append(bytes(image[:image.index(image_start_id + 2)]).decode("utf-8"))
+    for (start, end), image in zip(spans, model.transformer.visual.encode(paths)):
+        embeds[0, start + 1:end] = image
+    return embeds
+
+
+@torch.no_grad()
+def _prefill(model: AutoModelForCausalLM, context: List[int], prefix_cache: PrefixCache) -> PastKeyValues:
+    """
+    Compute the past key values of the context but its last token, starting from the longest cached prefix.
+
+    The vision tower of Qwen-VL only runs when there are no past key values,
+    so after a cached prefix the images of the new tokens are encoded here and passed as input embeddings.
+    """
+    prompt = context[:-1]
+    length, past_key_values = prefix_cache.longest_prefix(prompt)
+    image_start_id = (getattr(model.config, "visual", None) or {}).get("image_start_id")
+    inputs_embeds = None
+    if past_key_values is not None and image_start_id is not None:
+        spans = _image_spans(prompt[length:], image_start_id)
+        if spans is None:
+            # the cached prefix ends inside an image
+            length, past_key_values = 0, None
+        elif spans:
+            inputs_embeds = _embed_images(model, prompt[length:], spans, image_start_id)
+    if length < len(prompt):
+        if inputs_embeds is not None:
+            outputs = model(inputs_embeds=inputs_embeds, past_key_values=past_key_values, use_cache=True)
+        else:
+            outputs = model(input_ids=torch.tensor([prompt[length:]], device=model.device),
+                            past_key_values=past_key_values, use_cache=True)
+        past_key_values = outputs.past_key_values
+        prefix_cache.put(prompt, past_key_values)
+    logging.debug("Prefill %d tokens, reuse %d cached tokens", len(prompt) - length, length)
+    return past_key_values
+
+
+def _seq_dim(model: AutoModelForCausalLM, past_key_values: PastKeyValues, length: int) -> int:
+    """The dimension of the positions in the key tensors, 1 for Qwen, 2 for most of the transformers models."""
+    shape = past_key_values[0][0].shape
+    if shape[1] == length and shape[2] != length:
+        return 1
+    if shape[2] == length and shape[1] != length:
+        return 2
+    return 1 if getattr(model.config, "model_type", None) == "qwen" else 2
+
+
+def _crop(past_key_values: PastKeyValues, length: int, dim: int) -> PastKeyValues:
+    """The past key values of the first ``length`` positions."""
+    return tuple(tuple(tensor.narrow(dim, 0, length) for tensor in layer) for layer in past_key_values)
+
+
+@torch.no_grad()
+def assisted_generate(model: AutoModelForCausalLM, draft: AutoModelForCausalLM, context: List[int],
+                      past_key_values: Optional[PastKeyValues], logits_processor: LogitsProcessorList,
+                      streamer: BaseStreamer, max_new_tokens: int, stop_token_ids: Set[int],
+                      should_stop: Callable[[], bool]) -> torch.Tensor:
+    """
+    Greedy generation of one conversation, where the draft model proposes the next tokens and one forward
+    of the model checks them all. The answer is the one of a greedy generate, in fewer forwards of the model.
+
+    :param past_key_values: The past key values of the context but its last token, None to start from scratch.
+    :param logits_processor: Applied to the scores of the model, as in generate, the draft is greedy on its own.
+    :param should_stop: Stop before the next forward, e.g. the answer is complete or the request is cancelled.
+    :returns: The context and the answer.
+    """
+    tokens = torch.tensor([context], device=model.device)
+    streamer.put(tokens.cpu())
+    length = len(context) - 1 if past_key_values is not None else 0  # positions in the past key values
+    draft_past, draft_length = None, 0
+    target_dim = draft_dim = None
+    proposed = tools.qwen_chat.DRAFT_TOKENS
+    generated = 0
+    while generated < max_new_tokens and not should_stop():
+        # the draft proposes up to `proposed` tokens, one at a time
+        candidates = tokens
+        for _ in range(min(proposed, max_new_tokens - generated - 1)):
+            outputs = draft(candidates[:, draft_length:], past_key_values=draft_past, use_cache=True)
+            draft_past, draft_length = outputs.past_key_values, candidates.shape[1]
+            next_token = outputs.logits[:, -1].argmax(dim=-1, keepdim=True).to(tokens.device)
+            candidates = torch.cat([candidates, next_token], dim=-1)
+            if next_token.item() in stop_token_ids:
+                break
+        drafted = candidates.shape[1] - tokens.shape[1]
+
+        # the model scores the last token and the proposed ones in one forward,
+        # its tokens are kept up to the first one it disagrees on, which it replaces
+        outputs = model(candidates[:, length:], past_key_values=past_key_values, use_cache=True)
+        logits = outputs.logits[:, -(drafted + 1):]
+        selected = []
+        for i in range(drafted + 1):
+            scores = logits_processor(candidates[:, :tokens.shape[1] + i], logits[:, i, :])
+            selected.append(int(scores.argmax(dim=-1)))
+            if selected[-1] in stop_token_ids or len(selected) >= max_new_tokens - generated or \
+                    (i < drafted and selected[-1] != int(candidates[0, tokens.shape[1] + i])):
+                break
+        accepted = sum(1 for i, token in enumerate(selected[:drafted]) if token == candidates[0, tokens.shape[1] + i])
+        _ASSISTED["drafted"] += drafted
+        _ASSISTED["accepted"] += accepted
+        proposed = proposed + 2 if drafted and accepted == drafted else max(proposed - 1, 1)
+
+        tokens = torch.cat([tokens, torch.tensor([selected], device=tokens.device)], dim=-1)
+        for token in selected:
+            # one at a time as in generate, the stop strings are checked after each token
+            streamer.put(torch.tensor([token]))
+        generated += len(selected)
+
+        # the past key values of the rejected tokens are dropped, the last token is not in them yet
+        target_dim = target_dim or _seq_dim(model, outputs.past_key_values, candidates.shape[1])
+        length = tokens.shape[1] - 1
+        past_key_values = _crop(outputs.past_key_values, length, target_dim)
+        if draft_past is not None:
+            draft_dim = draft_dim or _seq_dim(draft, draft_past, draft_length)
+            draft_length = min(draft_length, length)
+            draft_past = _crop(draft_past, draft_length, draft_dim)
+    streamer.end()
+    return tokens
+
+
+def generate_batch(model: AutoModelForCausalLM, tokenizer: AutoTokenizer, prefix_cache: Optional[PrefixCache],
+                   draft: Optional[AutoModelForCausalLM], generation_kwargs: dict,
+                   batch: List[dict]) -> List[ChatResult]:
+    """
+    Answer several conversations with one left padded generate call, meant to be run on the inference worker thread.
+
+    :param prefix_cache: The past key values of earlier prompts, reused when a single conversation is answered.
+    :param draft: A small model with the same tokens, which speeds up the greedy answer of a single conversation.
+    :param generation_kwargs: Generation parameters shared by the batch, e.g. top_p and temperature.
+    :param batch: The keyword arguments of each conversation: query, history, system, cancel_event
+        and optional on_text, which is called with every new piece of the answer on the worker thread,
+        stop and max_tokens, see IncrementalDecoder, and seed.
+    """
+    utils = _generation_utils(model)
+    generation_config = model.generation_config
+    contexts = [utils.make_context(tokenizer, item["query"], history=item["history"], system=item["system"],
+                                   max_window_size=generation_config.max_window_size,
+                                   chat_format=generation_config.chat_format)[1] for item in batch]
+    stop_words_ids = utils.get_stop_words_ids(generation_config.chat_format, tokenizer)
+    stop_token_ids = {generation_config.eos_token_id, *[ids[0] for ids in stop_words_ids if len(ids) == 1]}
+
+    # left padding, so the new tokens of every row are appended at the same position
+    max_length = max(len(context) for context in contexts)
+    input_ids = torch.tensor([[generation_config.pad_token_id] * (max_length - len(context)) + context
+                              for context in contexts], device=model.device)
+    attention_mask = torch.tensor([[0] * (max_length - len(context)) + [1] * len(context)
+                                   for context in contexts], device=model.device)
+
+    decoders = [IncrementalDecoder(tokenizer, stop_token_ids, on_text=item.get("on_text"), stop=item.get("stop") or (),
+                                   max_tokens=item.get("max_tokens")) for item in batch]
+    streamer = TokenStreamer(decoders)
+    # the rows with a smaller max_tokens are stopped by the logits processor
+    max_new_tokens = max(item.get("max_tokens") or generation_config.max_new_tokens for item in batch)
+    if prefix_cache is not None and len(batch) == 1:
+        generation_kwargs = dict(generation_kwargs, past_key_values=_prefill(model, contexts[0], prefix_cache))
+
+    # a finished row only gets eos from now on, generate returns once every row is finished
+    logits_processor = LogitsProcessorList([ForceEosLogitsProcessor(
+        lambda row: batch[row]["cancel_event"].is_set() or decoders[row].stopped,
+        eos_token_id=generation_config.eos_token_id)])
+    # each row samples with its own generator, generate itself only picks the sampled tokens,
+    # its sampling parameters are reset to the greedy defaults, the sampler has applied them
+    generation_kwargs = dict(generation_kwargs)
+    sampler = _sampler(generation_config, batch, temperature=generation_kwargs.pop("temperature", None),
+                       top_p=generation_kwargs.pop("top_p", None))
+    if sampler is not None:
+        logits_processor.append(sampler)
+    if draft is not None and sampler is None and len(batch) == 1:
+        # the processors generate adds from the generation config, e.g. a repetition penalty
+        logits_processor = model._get_logits_processor(
+            generation_config=generation_config, input_ids_seq_length=input_ids.shape[1], encoder_input_ids=input_ids,
+            prefix_allowed_tokens_fn=None, logits_processor=logits_processor)
+        assisted_generate(model, draft, contexts[0], generation_kwargs.get("past_key_values"), logits_processor,
+                          streamer, max_new_tokens, stop_token_ids,
+                          should_stop=lambda: batch[0]["cancel_event"].is_set() or decoders[0].stopped)
+    else:
+        model.generate(input_ids, attention_mask=attention_mask, stop_words_ids=stop_words_ids,
+                       generation_config=generation_config, logits_processor=logits_processor, do_sample=False,
+                       temperature=1.0, top_k=50, top_p=1.0, streamer=streamer, max_new_tokens=max_new_tokens,
+                       **generation_kwargs)
+    _observe_generation(streamer, contexts)
+    return [ChatResult(decoder.text, finish_reason=decoder.finish_reason or "length",
+                       prompt_tokens=len(context), completion_tokens=len(decoder.token_ids))
+            for decoder, context in zip(decoders, contexts)]
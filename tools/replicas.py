@@ -0,0 +1,158 @@
+"""A front end process forwarding the chat requests to several model worker processes."""
+
+import asyncio
+import logging
+import os
+import shutil
+import subprocess
+import sys
+from typing import List, Dict, Optional, AsyncIterator
+
+import httpx
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+from tools.logging_utils import REQUEST_ID
+from tools.metrics import Counter, Gauge
+
+# hop-by-hop headers, and the ones httpx and uvicorn set again
+_SKIPPED_HEADERS = {"host", "connection", "keep-alive", "transfer-encoding", "content-length", "upgrade"}
+
+WORKER_REQUESTS = Counter("qwen_worker_requests_total", "Requests forwarded to each model worker.",
+                          labelnames=("worker", "status"))
+WORKER_IN_FLIGHT = Gauge("qwen_worker_requests_in_flight", "Requests being answered by each model worker.",
+                         labelnames=("worker",))
+
+
+class WorkersUnavailable(Exception):
+    def __init__(self, workers: int = None):
+        self.workers = workers
+
+
+class WorkerPool:
+    """
+    Forward requests to the least busy model worker.
+
+    A worker which can not be reached or whose queue is full (503) is skipped for the next one,
+    both happen before the worker starts on the request, so the request is never run twice.
+    """
+
+    def __init__(self, urls: List[str], connect_timeout: float = 5):
+        self.urls = [url.rstrip("/") for url in urls]
+        self.in_flight: Dict[str, int] = {url: 0 for url in self.urls}
+        # generations are bounded by the request timeout of the workers
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=connect_timeout),
+                                         limits=httpx.Limits(max_connections=None, max_keepalive_connections=64))
+
+    async def close(self):
+        await self._client.aclose()
+
+    def _acquire(self, url: str):
+        self.in_flight[url] += 1
+        WORKER_IN_FLIGHT.inc(worker=url)
+
+    def _release(self, url: str):
+        self.in_flight[url] -= 1
+        WORKER_IN_FLIGHT.dec(worker=url)
+
+    async def _relay(self, response: httpx.Response, url: str) -> AsyncIterator[bytes]:
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        finally:
+            await response.aclose()
+            self._release(url)
+
+    async def ready(self) -> List[str]:
+        """The workers whose /readyz is OK."""
+        async def check(url: str) -> bool:
+            try:
+                return (await self._client.get(url + "/readyz", timeout=2)).status_code == 200
+            except httpx.TransportError:
+                return False
+
+        results = await asyncio.gather(*(check(url) for url in self.urls))
+        return [url for url, ready in zip(self.urls, results) if ready]
+
+    async def forward(self, request: Request) -> StreamingResponse:
+        """
+        Send the request to a worker and stream its response back, server-sent events included.
+        :raises WorkersUnavailable: No worker has accepted the request.
+        """
+        body = await request.body()
+        headers = {name: value for name, value in request.headers.items() if name.lower() not in _SKIPPED_HEADERS}
+        # the worker logs the request under the same id
+        if REQUEST_ID.get() is not None:
+            headers["x-request-id"] = REQUEST_ID.get()
+        candidates = sorted(self.urls, key=lambda url: self.in_flight[url])
+        for index, url in enumerate(candidates):
+            self._acquire(url)
+            try:
+                response = await self._client.send(self._client.build_request(
+                    request.method, url + request.url.path, params=request.query_params, headers=headers,
+                    content=body), stream=True)
+            except httpx.TransportError as e:
+                self._release(url)
+                WORKER_REQUESTS.inc(worker=url, status="unreachable")
+                logging.warning(f"Model worker {url} is unreachable: {e!r}")
+                continue
+            WORKER_REQUESTS.inc(worker=url, status=str(response.status_code))
+            if response.status_code == 503 and index < len(candidates) - 1:
+                await response.aclose()
+                self._release(url)
+                continue
+            return StreamingResponse(self._relay(response, url), status_code=response.status_code,
+                                     headers={name: value for name, value in response.headers.items()
+                                              if name.lower() not in _SKIPPED_HEADERS})
+        raise WorkersUnavailable(workers=len(self.urls))
+
+
+def visible_gpus() -> List[str]:
+    """
+    The GPUs the workers can use, from CUDA_VISIBLE_DEVICES or else nvidia-smi,
+    without torch, which the front end does not need.
+    """
+    if "CUDA_VISIBLE_DEVICES" in os.environ:
+        return [device.strip() for device in os.environ["CUDA_VISIBLE_DEVICES"].split(",") if device.strip()]
+    if shutil.which("nvidia-smi") is None:
+        return []
+    try:
+        output = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return []
+    return [str(index) for index, line in enumerate(line for line in output.splitlines() if line.startswith("GPU "))]
+
+
+def spawn_workers(count: int, host: str, port: int, argv: List[str]) -> List[subprocess.Popen]:
+    """
+    Start ``count`` model worker processes of this server on the ports following ``port``.
+
+    Each worker gets its own GPU when there are enough of them.
+
+    :param argv: The command line arguments of the front end, passed on to the workers.
+    """
+    gpus = visible_gpus()
+    processes = []
+    for index in range(count):
+        env = dict(os.environ)
+        if len(gpus) >= count:
+            env["CUDA_VISIBLE_DEVICES"] = gpus[index]
+        command = [sys.executable, os.path.abspath(sys.argv[0]), *argv,
+                   "--role", "worker", "--workers", "0", "--server-name", host, "--server-port", str(port + index)]
+        processes.append(subprocess.Popen(command, env=env))
+        logging.info(f"Start model worker {index}, pid: {processes[-1].pid}, port: {port + index}")
+    return processes
+
+
+def worker_urls(count: int, host: str, port: int) -> List[str]:
+    return [f"http://{host}:{port + index}" for index in range(count)]
+
+
+def stop_workers(processes: List[subprocess.Popen], timeout: Optional[float] = 30):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
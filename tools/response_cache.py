@@ -0,0 +1,89 @@
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
+
+from tools.image_cache import image_digest
+
+_IMAGE_TAG = re.compile(r"<img>(.*?)</img>")
+
+
+def request_key(model: str, query: str, history: Optional[List[Tuple[str, str]]], system: str, **params) -> str:
+    """
+    The canonical hash of a formatted chat request, blocking as it may hash image files.
+
+    The images are hashed by content, the same image sent from another url or as base64 gives the same key.
+
+    :param params: The sampling parameters, e.g. temperature, top_p, seed, max_tokens and stop.
+    """
+    def canonical(text: Optional[str]) -> Optional[str]:
+        if text is None:
+            return None
+        return _IMAGE_TAG.sub(lambda match: f"<img>sha256:{image_digest(match.group(1))}</img>", text)
+
+    payload = {"model": model, "system": system, "query": canonical(query),
+               "history": [[canonical(prompt), response] for prompt, response in history or []], "params": params}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    LRU cache of the answers of deterministic chat requests, keyed by request_key and bounded by their size.
+
+    Entries older than ``ttl`` seconds are not returned. Only used from the event loop.
+    """
+
+    def __init__(self, max_bytes: int = 0, ttl: float = 3600):
+        """
+        :param max_bytes: The size budget of the answers, 0 to disable the cache.
+        :param ttl: How long in seconds an answer is returned, 0 for no limit.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self._entries: "OrderedDict[str, Tuple[Any, int, float]]" = OrderedDict()  # key -> (value, bytes, saved at)
+        self._bytes: int = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl > 0 and entry[2] < time.time() - self.ttl:
+            self._remove(key)
+            self.evictions += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: str, value: Any, size: int):
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (value, size, time.time())
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self._entries), "bytes": self._bytes}
@@ -0,0 +1,209 @@
+"""
+The order in which the inference worker takes the queued chat requests, and the quotas of the API keys.
+
+Interactive requests go before bulk ones, e.g. the requests of /v1/batches, and are never shed to make room for them.
+Within a class, the API keys share the model in proportion to their weights, by start-time fair queuing
+on the max tokens of the requests: a key sending many requests at once does not delay the others more than its share.
+"""
+
+import itertools
+import math
+import queue
+import threading
+import time
+from typing import Dict, Hashable, List, Literal, Mapping, Optional
+
+from starlette.datastructures import Headers
+
+from tools.metrics import Counter, Gauge, Histogram
+
+Priority = Literal["interactive", "bulk"]
+PRIORITIES = ("interactive", "bulk")  # served in this order
+BULK_QUEUE_SHARE: float = 0.5  # part of the queue bulk requests may fill, the rest is kept for interactive ones
+ANONYMOUS = "anonymous"  # the API key of the requests without one
+
+QUEUE_SIZE = Gauge("qwen_scheduler_queue_size", "Jobs waiting for the inference worker.", labelnames=("priority",))
+WAIT_SECONDS = Histogram("qwen_scheduler_wait_seconds", "Time from queued to running.", labelnames=("priority",))
+REJECTED = Counter("qwen_scheduler_rejected_total", "Requests shed before the queue.",
+                   labelnames=("priority", "reason"))
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, api_key: str = None, reason: str = None, retry_after: float = None):
+        self.api_key = api_key
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def request_priority(headers: Headers) -> Priority:
+    """The class of the request from its ``X-Priority`` header, interactive unless it says bulk."""
+    return "bulk" if headers.get("x-priority", "").strip().lower() == "bulk" else "interactive"
+
+
+def request_api_key(headers: Headers) -> str:
+    """The API key of the ``Authorization: Bearer`` header, the keys are not checked, only told apart."""
+    scheme, _, key = headers.get("authorization", "").partition(" ")
+    return key.strip() if scheme.lower() == "bearer" and key.strip() else ANONYMOUS
+
+
+def parse_weights(weights: str) -> Dict[str, float]:
+    """
+    Parse the API key weights from their comma separated list.
+
+    :param weights: ``key=weight`` items, the other keys have a weight of 1.
+    :returns: API key -> weight.
+    """
+    parsed = {}
+    for item in filter(None, (item.strip() for item in weights.split(","))):
+        key, _, weight = item.rpartition("=")
+        parsed[key] = float(weight)
+        if parsed[key] <= 0:
+            raise ValueError(f"The weight of the API key {key!r} should be positive, got {weight}")
+    return parsed
+
+
+class FairQueue:
+    """
+    A bounded queue of the inference jobs, thread safe, taken in order of priority class then of virtual finish time.
+
+    The jobs need ``priority``, ``api_key``, ``cost`` and ``batch_key`` attributes.
+    """
+
+    def __init__(self, maxsize: int, weights: Optional[Mapping[str, float]] = None):
+        self.maxsize = maxsize
+        self.weights: Mapping[str, float] = weights or {}
+        self._jobs: List = []
+        self._order: Dict[int, tuple] = {}  # id of a job -> its sort key
+        self._virtual_time: Dict[str, float] = {priority: 0.0 for priority in PRIORITIES}
+        self._last_finish: Dict[tuple, float] = {}  # (priority, api key) -> virtual finish of its last job
+        self._counter = itertools.count()
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def qsize(self, priority: Optional[Priority] = None) -> int:
+        with self._condition:
+            return sum(1 for job in self._jobs if priority is None or job.priority == priority)
+
+    def put_nowait(self, job):
+        """:raises queue.Full: The queue, or the share of bulk jobs, is full."""
+        with self._condition:
+            limit = self.maxsize if job.priority != "bulk" else max(int(self.maxsize * BULK_QUEUE_SHARE), 1)
+            if len(self._jobs) >= self.maxsize or \
+                    sum(1 for queued in self._jobs if queued.priority == job.priority) >= limit:
+                raise queue.Full
+            flow = (job.priority, job.api_key)
+            start = max(self._virtual_time[job.priority], self._last_finish.get(flow, 0.0))
+            finish = start + max(job.cost, 1) / self.weights.get(job.api_key, 1.0)
+            self._last_finish[flow] = finish
+            self._order[id(job)] = (PRIORITIES.index(job.priority), finish, next(self._counter), start)
+            self._jobs.append(job)
+            self._condition.notify()
+
+    def _pop(self, job):
+        self._jobs.remove(job)
+        _, _, _, start = self._order.pop(id(job))
+        self._virtual_time[job.priority] = max(self._virtual_time[job.priority], start)
+        if len(self._last_finish) > 4 * self.maxsize + 1024:
+            # the keys idle since then start again at the virtual time anyway
+            self._last_finish = {flow: finish for flow, finish in self._last_finish.items()
+                                 if finish > self._virtual_time[flow[0]]}
+        return job
+
+    def _wait_for(self, match, timeout: Optional[float]):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if self._closed:
+                    return None
+                jobs = [job for job in self._jobs if match(job)]
+                if jobs:
+                    return self._pop(min(jobs, key=lambda job: self._order[id(job)]))
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._condition.wait(remaining)
+
+    def get(self, timeout: Optional[float] = None):
+        """
+        Take the next job, waiting for one.
+        :returns: The job, None once the queue is closed.
+        :raises queue.Empty: No job is queued within ``timeout`` seconds.
+        """
+        return self._wait_for(lambda job: True, timeout)
+
+    def take(self, batch_key: Hashable, timeout: Optional[float] = None):
+        """Take the next job which can run in the same batch, see get."""
+        return self._wait_for(lambda job: job.batch_key == batch_key, timeout)
+
+    def close(self):
+        """Wake up the worker waiting for a job, the queued jobs are left to their timeouts."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class KeyQuotas:
+    """
+    The concurrency and token rate quotas of each API key, thread safe.
+
+    The token rate is a bucket holding a minute of tokens: a request is admitted while the bucket is not empty,
+    and its prompt and answer tokens are taken once it is answered, so the bucket may go below zero for a while.
+    """
+
+    def __init__(self, tokens_per_minute: int = 0, max_concurrency: int = 0,
+                 weights: Optional[Mapping[str, float]] = None):
+        """
+        :param tokens_per_minute: The token rate of a key of weight 1, 0 for no limit.
+        :param max_concurrency: The requests of a key of weight 1 queued or running at once, 0 for no limit.
+        :param weights: API key -> weight, the quotas of a key are in proportion to its weight.
+        """
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.weights: Mapping[str, float] = weights or {}
+        self._in_flight: Dict[str, int] = {}
+        self._buckets: Dict[str, tuple] = {}  # api key -> (tokens, updated at)
+        self._lock = threading.Lock()
+
+    def _rate(self, api_key: str) -> float:
+        """Tokens per second."""
+        return self.tokens_per_minute * self.weights.get(api_key, 1.0) / 60
+
+    def _tokens(self, api_key: str, now: float) -> float:
+        capacity = self._rate(api_key) * 60
+        tokens, updated_at = self._buckets.get(api_key, (capacity, now))
+        return min(tokens + (now - updated_at) * self._rate(api_key), capacity)
+
+    def admit(self, api_key: str, priority: Priority = "interactive", retry_after: float = 1):
+        """
+        Count a request of the key as in flight, until release.
+        :param retry_after: The seconds until a request of the key is likely to finish.
+        :raises QuotaExceeded: The key has too many requests in flight, or has used its tokens.
+        """
+        with self._lock:
+            limit = math.ceil(self.max_concurrency * self.weights.get(api_key, 1.0))
+            if self.max_concurrency > 0 and self._in_flight.get(api_key, 0) >= limit:
+                REJECTED.inc(priority=priority, reason="concurrency")
+                raise QuotaExceeded(api_key=api_key, reason=f"more than {limit} concurrent requests",
+                                    retry_after=retry_after)
+            if self.tokens_per_minute > 0:
+                tokens = self._tokens(api_key, time.monotonic())
+                if tokens <= 0:
+                    REJECTED.inc(priority=priority, reason="token_rate")
+                    raise QuotaExceeded(api_key=api_key,
+                                        reason=f"more than {self._rate(api_key) * 60:.0f} tokens per minute",
+                                        retry_after=(1 - tokens) / self._rate(api_key))
+            self._in_flight[api_key] = self._in_flight.get(api_key, 0) + 1
+
+    def release(self, api_key: str, tokens: int = 0):
+        """The request is finished, take its tokens."""
+        with self._lock:
+            self._in_flight[api_key] -= 1
+            if not self._in_flight[api_key]:
+                del self._in_flight[api_key]
+            if self.tokens_per_minute > 0:
+                now = time.monotonic()
+                self._buckets[api_key] = (self._tokens(api_key, now) - tokens, now)
+                if len(self._buckets) > 4096:
+                    # the full buckets are the same as no bucket
+                    self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                                     if self._tokens(key, now) < self._rate(key) * 60}
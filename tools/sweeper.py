@@ -0,0 +1,127 @@
+"""Periodic clean up of expired files, their database rows, orphaned files and stale cached images."""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Tuple, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+import routers.files
+from tools.DB import init_db, SessionLocal, FileRecord
+from tools.metrics import Counter, Gauge
+from tools.tools import IMAGE_CACHE
+
+SWEEP_BATCH_SIZE: int = 500
+SWEEP_MAX_BATCHES: int = 20  # at most SWEEP_BATCH_SIZE * SWEEP_MAX_BATCHES rows are deleted per run
+SWEEP_BATCH_PAUSE: float = 0.1  # seconds between two batches, so uploads get the write lock in between
+ORPHAN_GRACE = timedelta(hours=1)  # files younger than this may still be uploading
+
+FILES_RECLAIMED = Counter("qwen_sweeper_files_reclaimed_total", "Files removed by the sweeper.", labelnames=("kind",))
+BYTES_RECLAIMED = Counter("qwen_sweeper_bytes_reclaimed_total", "Bytes removed by the sweeper.", labelnames=("kind",))
+ROWS_DELETED = Counter("qwen_sweeper_rows_deleted_total", "Expired file records deleted by the sweeper.")
+SWEEP_RUNS = Counter("qwen_sweeper_runs_total", "Sweeper runs.")
+SWEEP_SECONDS = Gauge("qwen_sweeper_last_run_seconds", "Duration of the last sweeper run.")
+
+
+def delete_expired_batch(now: datetime, batch_size: int = SWEEP_BATCH_SIZE) -> Tuple[int, int, int]:
+    """
+    Delete one batch of expired file records and their files.
+    :returns: rows deleted, files removed, bytes reclaimed
+    """
+    init_db()
+    db = SessionLocal()
+    try:
+        file_ids = [row.id for row in db.query(FileRecord.id).filter(FileRecord.expiration <= now).limit(batch_size)]
+        if not file_ids:
+            return 0, 0, 0
+        db.query(FileRecord).filter(FileRecord.id.in_(file_ids)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+    file_store = routers.files.FILE_STORE
+    sizes = [size for size in (file_store.remove(file_id) for file_id in file_ids) if size is not None]
+    return len(file_ids), len(sizes), sum(sizes)
+
+
+def delete_orphans(now: datetime) -> Tuple[int, int]:
+    """
+    Remove uploaded files without a record and leftover temp files, older than ORPHAN_GRACE.
+    :returns: files removed, bytes reclaimed
+    """
+    file_store = routers.files.FILE_STORE
+    candidates = file_store.stale((now - ORPHAN_GRACE).timestamp())
+    if not candidates:
+        return 0, 0
+
+    init_db()
+    db = SessionLocal()
+    try:
+        file_ids = [name for name in candidates if not name.endswith(".tmp")]
+        known = set()
+        for start in range(0, len(file_ids), SWEEP_BATCH_SIZE):
+            batch = file_ids[start:start + SWEEP_BATCH_SIZE]
+            known.update(row.id for row in db.query(FileRecord.id).filter(FileRecord.id.in_(batch)))
+    finally:
+        db.close()
+
+    sizes = [size for size in (file_store.remove(name) for name in candidates if name not in known)
+             if size is not None]
+    return len(sizes), sum(sizes)
+
+
+def _evict_images() -> Tuple[int, int]:
+    before = IMAGE_CACHE.stats()["bytes"]
+    removed = IMAGE_CACHE.evict()
+    return len(removed), max(before - IMAGE_CACHE.stats()["bytes"], 0)
+
+
+async def sweep():
+    """One sweeper run, the blocking parts run in the threadpool."""
+    start = time.perf_counter()
+    now = datetime.now()
+
+    rows = files = reclaimed = 0
+    for _ in range(SWEEP_MAX_BATCHES):
+        batch_rows, batch_files, batch_bytes = await run_in_threadpool(delete_expired_batch, now, SWEEP_BATCH_SIZE)
+        rows, files, reclaimed = rows + batch_rows, files + batch_files, reclaimed + batch_bytes
+        if batch_rows < SWEEP_BATCH_SIZE:
+            break
+        await asyncio.sleep(SWEEP_BATCH_PAUSE)
+    ROWS_DELETED.inc(rows)
+    FILES_RECLAIMED.inc(files, kind="expired")
+    BYTES_RECLAIMED.inc(reclaimed, kind="expired")
+
+    orphan_files, orphan_bytes = await run_in_threadpool(delete_orphans, now)
+    FILES_RECLAIMED.inc(orphan_files, kind="orphan")
+    BYTES_RECLAIMED.inc(orphan_bytes, kind="orphan")
+
+    image_files, image_bytes = await run_in_threadpool(_evict_images)
+    FILES_RECLAIMED.inc(image_files, kind="image")
+    BYTES_RECLAIMED.inc(image_bytes, kind="image")
+
+    SWEEP_RUNS.inc()
+    SWEEP_SECONDS.set(time.perf_counter() - start)
+    logging.info(f"Sweep expired files, rows: {rows}, files: {files + orphan_files + image_files}, "
+                 f"bytes: {reclaimed + orphan_bytes + image_bytes}, seconds: {time.perf_counter() - start:.3f}")
+
+
+async def _sweep_every(interval: int):
+    while True:
+        await asyncio.sleep(interval * 60)
+        try:
+            await sweep()
+        except Exception as e:
+            logging.error(f"Sweep failed: {e!r}")
+
+
+def start_sweeper(interval: int) -> Optional[asyncio.Task]:
+    """
+    Run the sweeper every ``interval`` minutes, must be called from the event loop.
+    :returns: The sweeper task, None if the interval is 0.
+    """
+    if interval <= 0:
+        return None
+    return asyncio.create_task(_sweep_every(interval))
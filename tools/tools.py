@@ -1,12 +1,24 @@
+import asyncio
+import binascii
+import hashlib
 import logging
-import os
-import re
-from base64 import b64decode, b64encode
-from uuid import uuid4
+from base64 import b64encode
+from typing import Optional, Tuple, Iterable, Dict
 
-from requests import get as requests_get
+import httpx
 
+import routers.files
 from routers.files import check_file_exists, FILE_CACHE_DIR
+from tools.image_cache import ImageCache
+from tools.image_preprocess import preprocess_image, preprocess_image_data
+from tools.openai_types import ChatImageNotAvailable
+
+IMAGE_CACHE = ImageCache(FILE_CACHE_DIR if FILE_CACHE_DIR else "")
+
+IMAGE_FETCH_TIMEOUT: float = 10
+IMAGE_MAX_BYTES: int = 20 * 1024 * 1024
+DATA_URL_CHUNK: int = 1 << 20  # base64 characters of a data: url decoded at a time, a multiple of 4
+_HTTP_CLIENT: Optional[httpx.AsyncClient] = None
 
 
 def img_to_base64(img_path: str) -> str:
@@ -15,35 +27,121 @@ def img_to_base64(img_path: str) -> str:
         return b64encode(f.read()).decode()
 
 
-def download_img_from_url(url: str, save_dir: str = FILE_CACHE_DIR if FILE_CACHE_DIR else "") -> str:
+def get_http_client() -> httpx.AsyncClient:
+    """The shared connection pooled client for image downloads."""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+        _HTTP_CLIENT = httpx.AsyncClient(timeout=IMAGE_FETCH_TIMEOUT, follow_redirects=True,
+                                         limits=httpx.Limits(max_connections=64, max_keepalive_connections=16))
+    return _HTTP_CLIENT
+
+
+async def close_http_client():
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is not None:
+        await _HTTP_CLIENT.aclose()
+        _HTTP_CLIENT = None
+
+
+def decode_data_url(url: str) -> Tuple[str, bytearray, str]:
+    """
+    Decode a ``data:image/...;base64,`` url chunk by chunk into one preallocated buffer, hashing the content
+    on the way, so the payload is neither matched by a regex nor copied as a whole.
+
+    :returns: The extension of the image, its content, and its digest as in the names of the image cache.
+    :raises ChatImageNotAvailable: The url is not a base64 image, or is too large.
+    """
+    comma = url.find(",", 0, 256)
+    media_type = url[len("data:"):comma].lower() if comma != -1 else ""
+    if not media_type.startswith("image/") or not media_type.endswith(";base64"):
+        raise ChatImageNotAvailable(url=url, reason="not a base64 image data url")
+    max_size = (len(url) - comma - 1) * 3 // 4
+    if max_size > IMAGE_MAX_BYTES:
+        raise ChatImageNotAvailable(url=url, reason=f"larger than {IMAGE_MAX_BYTES} bytes")
+
+    data, size, sha256, rest = bytearray(max_size), 0, hashlib.sha256(), ""
+    try:
+        for start in range(comma + 1, len(url), DATA_URL_CHUNK):
+            # whitespace shifts the chunks off the 4 characters groups, the remainder goes with the next one
+            text = rest + "".join(url[start:start + DATA_URL_CHUNK].split())
+            end = len(text) - len(text) % 4 if start + DATA_URL_CHUNK < len(url) else len(text)
+            chunk, rest = binascii.a2b_base64(text[:end]), text[end:]
+            data[size:size + len(chunk)] = chunk
+            size += len(chunk)
+            sha256.update(chunk)
+    except binascii.Error as e:
+        raise ChatImageNotAvailable(url=url, reason=f"invalid base64, {e}")
+    del data[size:]
+    extension = media_type.split(";")[0].split("/")[1]
+    return extension, data, sha256.hexdigest()[:32]
+
+
+async def _fetch(url: str, client: httpx.AsyncClient) -> Tuple[bytes, str]:
+    """Stream the image body, giving up as soon as it is larger than IMAGE_MAX_BYTES."""
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        try:
+            content_length = int(response.headers.get("content-length", 0))
+        except ValueError:
+            raise ChatImageNotAvailable(url=url, reason="invalid Content-Length header")
+        if content_length > IMAGE_MAX_BYTES:
+            raise ChatImageNotAvailable(url=url, reason=f"larger than {IMAGE_MAX_BYTES} bytes")
+        chunks, size = [], 0
+        async for chunk in response.aiter_bytes():
+            size += len(chunk)
+            if size > IMAGE_MAX_BYTES:
+                raise ChatImageNotAvailable(url=url, reason=f"larger than {IMAGE_MAX_BYTES} bytes")
+            chunks.append(chunk)
+        return b"".join(chunks), response.headers.get("content-type", "image/jpeg")
+
+
+async def download_img_from_url(url: str, cache: ImageCache = IMAGE_CACHE, client: httpx.AsyncClient = None) -> str:
     """
-    Download the image from the url.
+    Download the image from the url, the ``data:`` urls are decoded by decode_data_url instead.
 
     :param url: The image url.
-    :param save_dir: The image save directory.
+    :param cache: The image cache, a repeated url or image content resolves to the same file.
+    :param client: The http client, default to the shared one.
     :return: The image save path.
     """
-    match = re.match(r'^data:(?P<mime_type>image/.+);base64,(?P<base64_data>.+)', url)
-    if match:
-        # base64 data
-        img_data = b64decode(match.group('base64_data'))
-        extension = match.group('mime_type').split('/')[1]
-    elif 'seetacloud.com' in url or '127.0.0.1' in url or 'localhost' in url:
+    if 'seetacloud.com' in url or '127.0.0.1' in url or 'localhost' in url:
         # todo: 待优化本地匹配逻辑
         # 针对 autodl 的 'seetacloud.com' 进行特殊处理
         # 解析url中的路径部分，匹配file_id
         file_id = url.split('/')[-2]
         check_file_exists(file_id)
-        return os.path.join(FILE_CACHE_DIR, file_id)
-    else:
-        # url
-        response = requests_get(url)
-        img_data = response.content
-        extension = response.headers['content-type'].split('/')[1]
-        logging.info(f"Download Image, url: {url}, extension: {extension}")
+        return routers.files.FILE_STORE.path(file_id)
+
+    img_path = cache.get(url)
+    if img_path is not None:
+        logging.debug("Image cache hit, path: %s", img_path)
+        return img_path
+
+    # url
+    try:
+        img_data, content_type = await asyncio.wait_for(_fetch(url, client or get_http_client()),
+                                                        IMAGE_FETCH_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise ChatImageNotAvailable(url=url, reason=f"not downloaded in {IMAGE_FETCH_TIMEOUT} seconds")
+    except httpx.HTTPError as e:
+        raise ChatImageNotAvailable(url=url, reason=str(e))
+    extension = content_type.split(';')[0].split('/')[-1]
+    logging.info(f"Download Image, url: {url}, extension: {extension}")
     # save image
-    os.makedirs(save_dir, exist_ok=True)
-    img_path = os.path.join(save_dir, f"image_{uuid4().hex[:8]}.{extension}")
-    with open(img_path, 'wb') as f:
-        f.write(img_data)
-    return img_path
+    return await asyncio.to_thread(cache.put, img_data, extension, url)
+
+
+async def _prepare_image(url: str, cache: ImageCache = IMAGE_CACHE, **kwargs) -> str:
+    if url.startswith("data:"):
+        # decoded in memory, only the preprocessed image is written
+        extension, data, digest = await asyncio.to_thread(decode_data_url, url)
+        return await preprocess_image_data(data, digest, extension, url, cache)
+    path = await download_img_from_url(url, cache=cache, **kwargs)
+    return await preprocess_image(path, url, cache)
+
+
+async def download_images(urls: Iterable[str], **kwargs) -> Dict[str, str]:
+    """Download and preprocess the images concurrently, return url -> path."""
+    urls = list(dict.fromkeys(urls))
+    paths = await asyncio.gather(*[_prepare_image(url, **kwargs) for url in urls])
+    return dict(zip(urls, paths))
@@ -0,0 +1,156 @@
+"""Parse multipart/form-data uploads straight from the request stream into the file store."""
+
+import hashlib
+import os
+from typing import Dict, Optional, Tuple
+from uuid import uuid4
+
+import aiofiles
+from fastapi import Request
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+
+UPLOAD_CHUNK_SIZE: int = 1024 * 1024  # bytes written per await
+UPLOAD_MAX_BYTES: int = 512 * 1024 * 1024
+FORM_FIELD_MAX_BYTES: int = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_bytes: int = None):
+        self.max_bytes = max_bytes
+
+
+class UploadMalformed(Exception):
+    def __init__(self, reason: str = None):
+        self.reason = reason
+
+
+class UploadedFile:
+    def __init__(self, filename: str, content_type: Optional[str], size: int, sha256: str):
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.sha256 = sha256
+
+
+class _MultipartReceiver:
+    """Callbacks of the multipart parser, the file part is hashed and buffered for the next write."""
+
+    def __init__(self, file_field: str, max_bytes: int):
+        self.file_field = file_field
+        self.max_bytes = max_bytes
+        self.fields: Dict[str, str] = {}
+        self.file: Optional[UploadedFile] = None
+        self.pending = bytearray()  # file bytes waiting to be written
+        self._hash = hashlib.sha256()
+        self._size: int = 0
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._content_type: Optional[str] = None
+        self._name: Optional[str] = None
+        self._filename: Optional[str] = None
+        self._data = bytearray()
+
+    def on_part_begin(self):
+        self._disposition, self._content_type, self._data = b"", None, bytearray()
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        name = self._header_name.lower()
+        if name == b"content-disposition":
+            self._disposition = self._header_value
+        elif name == b"content-type":
+            self._content_type = self._header_value.decode("latin-1")
+        self._header_name, self._header_value = b"", b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        if b"name" not in options:
+            raise UploadMalformed('The Content-Disposition header field "name" must be provided.')
+        self._name = options[b"name"].decode("utf-8", errors="replace")
+        self._filename = options[b"filename"].decode("utf-8", errors="replace") if b"filename" in options else None
+        if self._filename is not None and (self._name != self.file_field or self.file is not None):
+            raise UploadMalformed(f"Only one file is accepted, in the `{self.file_field}` field.")
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self._filename is None:
+            self._data += data[start:end]
+            if len(self._data) > FORM_FIELD_MAX_BYTES:
+                raise UploadMalformed(f"The form field `{self._name}` is too large.")
+            return
+        self._size += end - start
+        if self._size > self.max_bytes:
+            raise UploadTooLarge(max_bytes=self.max_bytes)
+        chunk = memoryview(data)[start:end]
+        self._hash.update(chunk)
+        self.pending += chunk
+
+    def on_part_end(self):
+        if self._filename is None:
+            self.fields[self._name] = self._data.decode("utf-8", errors="replace")
+        else:
+            self.file = UploadedFile(self._filename, self._content_type, self._size, self._hash.hexdigest())
+
+
+async def receive_upload(request: Request, dest_path: str, file_field: str = "file",
+                         max_bytes: int = None, chunk_size: int = None) -> Tuple[Dict[str, str], UploadedFile]:
+    """
+    Receive a multipart/form-data upload, its file part is streamed to dest_path with a sha256 computed on the way.
+
+    The file is written to a temp file next to dest_path and renamed once complete,
+    so a rejected upload or a disconnected client never leaves a partial file behind.
+
+    :returns: The other form fields and the uploaded file.
+    :raises UploadTooLarge: As soon as the file is larger than max_bytes.
+    :raises UploadMalformed: The body is not a form with exactly one file, or its Content-Length is not a number.
+    """
+    max_bytes = UPLOAD_MAX_BYTES if max_bytes is None else max_bytes
+    chunk_size = UPLOAD_CHUNK_SIZE if chunk_size is None else chunk_size
+
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadMalformed("The body should be multipart/form-data.")
+    try:
+        content_length = int(request.headers.get("content-length", 0))
+    except ValueError:
+        raise UploadMalformed("The Content-Length header should be a number of bytes.")
+    if content_length > max_bytes + FORM_FIELD_MAX_BYTES:
+        raise UploadTooLarge(max_bytes=max_bytes)
+
+    receiver = _MultipartReceiver(file_field, max_bytes)
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": receiver.on_part_begin,
+        "on_part_data": receiver.on_part_data,
+        "on_part_end": receiver.on_part_end,
+        "on_header_field": receiver.on_header_field,
+        "on_header_value": receiver.on_header_value,
+        "on_header_end": receiver.on_header_end,
+        "on_headers_finished": receiver.on_headers_finished,
+    })
+
+    tmp_path = f"{dest_path}.{uuid4().hex[:8]}.tmp"
+    try:
+        async with aiofiles.open(tmp_path, "wb") as buffer:
+            try:
+                async for chunk in request.stream():
+                    parser.write(chunk)
+                    if len(receiver.pending) >= chunk_size:
+                        await buffer.write(receiver.pending)
+                        receiver.pending.clear()
+                parser.finalize()
+            except MultipartParseError as e:
+                raise UploadMalformed(str(e))
+            await buffer.write(receiver.pending)
+        if receiver.file is None:
+            raise UploadMalformed(f"The `{file_field}` field should be a file.")
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return receiver.fields, receiver.file
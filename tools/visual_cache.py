@@ -0,0 +1,117 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Callable
+from uuid import uuid4
+
+import torch
+
+from tools.image_cache import image_digest
+
+
+class VisualCache:
+    """
+    Cache of the visual encoder output of each image, keyed by its content, see tools.image_cache.image_digest.
+
+    Kept in memory up to ``max_bytes`` in LRU order, and optionally saved to ``cache_dir``
+    so an evicted or restarted entry is loaded instead of running the vision tower again.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, cache_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.hits: int = 0
+        self.disk_hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self._entries: "OrderedDict[str, torch.Tensor]" = OrderedDict()  # LRU first
+        self._bytes: int = 0
+        self._lock = threading.Lock()
+
+    def _disk_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, f"visual_{digest}.pt")
+
+    def _put(self, digest: str, embedding: torch.Tensor):
+        size = embedding.numel() * embedding.element_size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if digest in self._entries:
+                return
+            self._entries[digest] = embedding
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.numel() * evicted.element_size()
+                self.evictions += 1
+
+    def _get(self, digest: str, device: torch.device) -> Optional[torch.Tensor]:
+        with self._lock:
+            embedding = self._entries.get(digest)
+            if embedding is not None:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return embedding
+        if self.cache_dir is not None and os.path.exists(self._disk_path(digest)):
+            embedding = torch.load(self._disk_path(digest), map_location=device)
+            self._put(digest, embedding)
+            self.disk_hits += 1
+            return embedding
+        self.misses += 1
+        return None
+
+    def _save(self, digest: str, embedding: torch.Tensor):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self._disk_path(digest)}.{uuid4().hex[:8]}.tmp"
+        torch.save(embedding.cpu(), tmp_path)
+        os.replace(tmp_path, self._disk_path(digest))
+
+    def wrap(self, encode: Callable[[List[str]], torch.Tensor],
+             device: torch.device) -> Callable[[List[str]], torch.Tensor]:
+        """
+        Wrap ``VisionTransformer.encode`` of Qwen-VL, which maps image paths to their embeddings.
+
+        :param device: The device of the vision tower, where the embeddings are returned.
+        """
+
+        def cached_encode(image_paths: List[str]) -> torch.Tensor:
+            digests = [None if path.startswith(("http://", "https://")) else image_digest(path)
+                       for path in image_paths]
+            embeddings: List[Optional[torch.Tensor]] = []
+            for digest in digests:
+                embeddings.append(None if digest is None else self._get(digest, device=device))
+
+            missing = [index for index, embedding in enumerate(embeddings) if embedding is None]
+            if missing:
+                encoded = encode([image_paths[index] for index in missing])
+                for index, embedding in zip(missing, encoded):
+                    # a copy, so the cache does not keep the whole batch alive
+                    embedding = embedding.detach().clone()
+                    embeddings[index] = embedding
+                    if digests[index] is not None:
+                        self._put(digests[index], embedding)
+                        if self.cache_dir is not None:
+                            self._save(digests[index], embedding)
+            logging.debug("Encode %d of %d images, the others are cached", len(missing), len(image_paths))
+            return torch.stack([embedding.to(device) for embedding in embeddings], dim=0)
+
+        return cached_encode
+
+    def install(self, model) -> bool:
+        """Put the cache in front of the vision tower of a Qwen-VL model, return False if the model has none."""
+        visual = getattr(getattr(model, "transformer", None), "visual", None)
+        if visual is None or not hasattr(visual, "encode"):
+            return False
+        visual.encode = self.wrap(visual.encode, device=next(visual.parameters()).device)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "evictions": self.evictions, "entries": len(self._entries), "bytes": self._bytes}